@@ -2,4 +2,9 @@
 set -e
 set -x
 
-nosetests -v test
+if python -c 'import sys; sys.exit(sys.version_info >= (3, 7))'; then
+    # rlundo.apity and rlundo.server are asyncio modules for Python 3.7 on
+    nosetests -v test --ignore-files='^(memory_monitor|test_apity|test_server)\.py$'
+else
+    nosetests -v test
+fi
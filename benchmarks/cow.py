@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+cow
+
+Measure how much memory a chain of forked interpreters shares, the way the
+Python shims fork one process per command. Linux only, since it reads
+/proc/<pid>/smaps_rollup.
+
+From the command line:
+    `python benchmarks/cow.py --megabytes 200 --commands 10`
+
+A process builds a heap of small lists and strings, then runs the given
+number of commands. Each command forks, parks the parent waiting for the
+child, and in the child allocates some new objects, reads a slice of the
+old heap and runs a full collection, as a long session eventually would.
+After the last command every process in the chain is measured:
+
+    plain      os.fork(), the way the shims used to fork
+    frozen     rlundo.forking.fork(): collect first, and gc.freeze() in the
+               root, with the collector off in parked parents
+
+Shared and private are summed over the chain; PSS is the chain's real
+footprint, with each shared page split between the processes sharing it.
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import gc
+import json
+import os
+import signal
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+MODES = ['plain', 'frozen']
+FIELDS = ['Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty']
+
+
+def memory(pid):
+    """{field: kilobytes} from /proc/pid/smaps_rollup"""
+    usage = {}
+    with open('/proc/%d/smaps_rollup' % (pid, )) as f:
+        for line in f:
+            name, _, rest = line.partition(':')
+            if name in FIELDS:
+                usage[name] = int(rest.split()[0])
+    return usage
+
+
+def chain(mode, megabytes, commands):
+    """Runs in a process of its own; the last child prints the measurements"""
+    from rlundo import forking
+    fork = os.fork if mode == 'plain' else forking.fork
+    # lists are always tracked by the collector, unlike dicts of strings;
+    # each of these is about 200 bytes with its string and int
+    heap = [[i, 'object %d' % (i, )] for i in range(megabytes * 5000)]
+    pids = [os.getpid()]
+    for command in range(commands):
+        read_fd, write_fd = os.pipe()
+        if fork() != 0:
+            os.read(read_fd, 1)  # parked until killed
+            os._exit(0)
+        pids.append(os.getpid())
+        new = [{'command': command, 'i': i} for i in range(20000)]
+        start = len(heap) * command // commands
+        sum(item[0] for item in heap[start:start + len(heap) // 100])
+        gc.collect()
+        del new
+    print(json.dumps([memory(pid) for pid in pids]))
+    sys.stdout.flush()
+    for pid in pids[:-1]:
+        os.kill(pid, signal.SIGKILL)
+    os._exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megabytes', type=int, default=200)
+    parser.add_argument('--commands', type=int, default=10)
+    parser.add_argument('--modes', nargs='*', default=MODES, choices=MODES)
+    parser.add_argument('--chain', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.chain:
+        chain(args.chain, args.megabytes, args.commands)
+
+    print('%d MB heap, %d commands, %d processes' % (args.megabytes, args.commands,
+                                                     args.commands + 1))
+    print('%-8s %10s %10s %10s %10s' % ('mode', 'rss', 'pss', 'shared', 'private'))
+    for mode in args.modes:
+        # the first process of the chain is killed by the last one
+        output, _ = subprocess.Popen([sys.executable, __file__, '--chain', mode,
+                                      '--megabytes', str(args.megabytes),
+                                      '--commands', str(args.commands)],
+                                     stdout=subprocess.PIPE).communicate()
+        usages = json.loads(output.decode('ascii'))
+        total = dict((field, sum(u[field] for u in usages) // 1024) for field in FIELDS)
+        print('%-8s %8dMB %8dMB %8dMB %8dMB' % (
+            mode, total['Rss'], total['Pss'],
+            total['Shared_Clean'] + total['Shared_Dirty'],
+            total['Private_Clean'] + total['Private_Dirty']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+restore_latency
+
+Time writing the escape sequences for an undo to a terminal, comparing a
+flushed write per escape sequence (the way termrewrite used to restore)
+with the single composed write termrewrite does now.
+
+From the command line:
+    `python benchmarks/restore_latency.py --height 200 --repeat 100`
+
+The terminal is a pty whose master end is drained by a thread, so the
+numbers include the cost of the pty but not of rendering.
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import io
+import os
+import pty
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import blessings
+
+from rlundo import termrewrite
+
+
+def drain(fd):
+    while True:
+        try:
+            if not os.read(fd, 65536):
+                return
+        except OSError:
+            return
+
+
+def legacy_rewind(terminal, n):
+    """The writes the old restore made to rewind n lines"""
+    return ([terminal.move_up] * n + [terminal.move_left] * 200 +
+            [terminal.clear_eos])
+
+
+def legacy_history_broken(terminal, lines_available, lines):
+    """The writes the old restore made when history contiguity was broken"""
+    writes = [terminal.move_left] * 200 + [terminal.clear_eol]
+    writes += [terminal.move_up, terminal.clear_eol] * lines_available
+    writes += [termrewrite.HISTORY_BROKEN_MSG[:terminal.width], '\n']
+    writes += [terminal.move_down] * (terminal.height - 2)
+    writes += [terminal.move_left] * 200 + ['\n']
+    writes += [terminal.move_up] * (terminal.height - 1)
+    writes += [(line + b'\r\n').decode('utf8') for line in lines]
+    return writes
+
+
+def time_legacy(stream, writes, repeat):
+    t0 = time.time()
+    for _ in range(repeat):
+        for data in writes:
+            stream.write(data)
+            stream.flush()
+    return (time.time() - t0) / repeat
+
+
+def time_composed(sequence, repeat):
+    t0 = time.time()
+    for _ in range(repeat):
+        termrewrite.write(sequence)
+    return (time.time() - t0) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--height', type=int, default=200)
+    parser.add_argument('--width', type=int, default=120)
+    parser.add_argument('--repeat', type=int, default=100)
+    args = parser.parse_args()
+
+    master, slave = pty.openpty()
+    threading.Thread(target=drain, args=(master, ), daemon=True).start()
+    stream = io.open(slave, 'w', encoding='utf8', closefd=False)
+
+    class Sized(blessings.Terminal):
+        height = args.height
+        width = args.width
+
+    termrewrite.terminal = Sized(kind='xterm-256color', stream=stream,
+                                 force_styling=True)
+    del termrewrite._capabilities[:]
+    sys.stdout = stream
+
+    lines = [b'x' * 60] * (args.height // 2)
+    n = args.height // 2
+    cases = [
+        ('rewind %d lines' % (n, ),
+         legacy_rewind(termrewrite.terminal, n),
+         termrewrite.rewind_sequence(n)),
+        ('history broken',
+         legacy_history_broken(termrewrite.terminal, args.height - 1, lines),
+         termrewrite.history_broken_sequence(args.height - 1, lines)),
+    ]
+    results = sys.__stdout__
+    print('%-20s %8s %12s %8s %12s %8s' % (
+        'case', 'writes', 'legacy ms', 'writes', 'composed ms', 'speedup'),
+        file=results)
+    for name, writes, sequence in cases:
+        legacy = time_legacy(stream, writes, args.repeat)
+        composed = time_composed(sequence, args.repeat)
+        print('%-20s %8d %12.3f %8d %12.3f %7.1fx' % (
+            name, len(writes), legacy * 1000, 1, composed * 1000,
+            legacy / composed), file=results)
+    sys.stdout = sys.__stdout__
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+startup
+
+Measure how long `python rlundo <interpreter>` takes to start, in
+milliseconds, for each interpreter given.
+
+From the command line:
+    `python benchmarks/startup.py python ipython irb --runs 5`
+
+Two numbers for each interpreter, medians over the runs:
+
+    resolve    a fresh Python importing rlundo.interps and choosing the
+               command to run, the part every interpreter pays for
+    output     starting rlundo in a pty until the interpreter's first output,
+               answering rlundo's cursor position query on the way
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import pty
+import re
+import select
+import signal
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+RESOLVE = r'''
+import sys
+sys.path.insert(0, %(root)r)
+from rlundo import interps
+interps.undoable_command(%(interpreter)r, [], {})
+'''
+
+CURSOR_QUERY = re.compile(b'\x1b\\[6n')
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def time_resolve(interpreter):
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c',
+                           RESOLVE % dict(root=ROOT, interpreter=interpreter)])
+    return time.time() - start
+
+
+def time_first_output(interpreter, timeout=30):
+    """Seconds until the interpreter writes something, None if it doesn't"""
+    master, slave = pty.openpty()
+    start = time.time()
+    p = subprocess.Popen([sys.executable, os.path.join(ROOT, 'rlundo'), interpreter],
+                         stdin=slave, stdout=slave, stderr=slave,
+                         start_new_session=True)
+    os.close(slave)
+    try:
+        while time.time() - start < timeout:
+            if not select.select([master], [], [], .1)[0]:
+                continue
+            try:
+                data = os.read(master, 4096)
+            except OSError:
+                return None
+            output, queries = CURSOR_QUERY.subn(b'', data)
+            for _ in range(queries):
+                os.write(master, b'\x1b[1;1R')
+            if output.strip():
+                return time.time() - start
+        return None
+    finally:
+        os.killpg(p.pid, signal.SIGKILL)
+        p.wait()
+        os.close(master)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('interpreters', nargs='*', default=['python', 'ipython', 'adventure'])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    print('%-12s %10s %10s' % ('interpreter', 'resolve', 'output'))
+    for interpreter in args.interpreters:
+        resolve = median([time_resolve(interpreter) for _ in range(args.runs)])
+        outputs = [time_first_output(interpreter) for _ in range(args.runs)]
+        if None in outputs:
+            output = '    failed'
+        else:
+            output = '%8.0fms' % (median(outputs) * 1000, )
+        print('%-12s %8.0fms %s' % (interpreter, resolve * 1000, output))
+
+
+if __name__ == '__main__':
+    main()
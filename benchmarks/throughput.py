@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+throughput
+
+Measure how fast output from a child process gets through pity.spawn, in
+MB/s, compared with plain `cat` writing straight to a pipe.
+
+From the command line:
+    `python benchmarks/throughput.py --megabytes 64`
+
+Each mode runs `cat` on a file of printable lines under pity.spawn with
+standard output a pipe read by this process:
+
+    legacy     os.read(fd, 1024) per chunk, the way pity used to read
+    forward    reads into a reused buffer, no recording
+    splice     splice(2) from the pty straight into the stdout pipe
+    record     termrewrite's journal sees every byte, as in an rlundo session
+
+forward and splice are what pity.spawn does without a master_read; an
+rlundo session always records, reading into a reused buffer like forward
+but copying each read out of it for the journal.
+
+With --check, exits with an error if recording takes more than that many
+times as long as forwarding, to catch work creeping back onto the path
+every byte of output takes:
+    `python benchmarks/throughput.py --check 2`
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+CHILD = r'''
+import os, pty, sys
+sys.path.insert(0, %(root)r)
+from rlundo import pity
+mode = %(mode)r
+if mode == 'legacy':
+    master_read = pty._read
+elif mode == 'record':
+    from rlundo import termrewrite
+    termrewrite.configure_journal(None, None)
+    master_read = termrewrite.master_read
+else:
+    master_read = None
+    pity.SPLICE = mode == 'splice'
+pity.spawn(['cat', %(path)r], master_read=master_read)
+'''
+
+MODES = ['legacy', 'forward', 'splice', 'record']
+
+
+def make_file(megabytes):
+    f = tempfile.NamedTemporaryFile(delete=False, suffix='.txt')
+    line = b''.join(bytes(bytearray([32 + i % 95])) for i in range(79)) + b'\n'
+    block = line * (1024 * 1024 // len(line) + 1)
+    for _ in range(megabytes):
+        f.write(block[:1024 * 1024])
+    f.close()
+    return f.name
+
+
+def timed(argv):
+    """Seconds taken by argv, reading its stdout from a pipe"""
+    start = time.time()
+    p = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                         stdin=open(os.devnull), stderr=subprocess.DEVNULL)
+    total = 0
+    while True:
+        data = p.stdout.read(65536)
+        if not data:
+            break
+        total += len(data)
+    p.wait()
+    return time.time() - start, total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megabytes', type=int, default=32)
+    parser.add_argument('--modes', nargs='*', default=MODES, choices=MODES)
+    parser.add_argument('--check', type=float, default=None, metavar='RATIO',
+                        help='fail if record is this many times slower than forward')
+    args = parser.parse_args()
+    if args.check is not None:
+        args.modes = ['forward', 'record']
+
+    path = make_file(args.megabytes)
+    seconds_taken = {}
+    try:
+        size = os.path.getsize(path)
+        baseline, _ = timed(['cat', path])
+        print('%-8s %8.1f MB/s' % ('cat', size / baseline / 1e6))
+        for mode in args.modes:
+            child = CHILD % dict(root=ROOT, mode=mode, path=path)
+            seconds, total = timed([sys.executable, '-c', child])
+            seconds_taken[mode] = seconds
+            # the pty turns \n into \r\n
+            print('%-8s %8.1f MB/s  %5.1fx cat' % (
+                mode, size / seconds / 1e6, seconds / baseline))
+            if total < size:
+                print('  only %d of %d bytes arrived' % (total, size))
+    finally:
+        os.remove(path)
+    if args.check is not None:
+        ratio = seconds_taken['record'] / seconds_taken['forward']
+        if ratio > args.check:
+            sys.exit('recording is %.1fx slower than forwarding, more than %sx' % (
+                ratio, args.check))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+undo_latency
+
+Measure how long rlundo takes to get back to the prompt, in milliseconds,
+by driving interpreters in a pty and timestamping what they write.
+
+From the command line:
+    `python benchmarks/undo_latency.py --heaps 0 100 --depths 1 20 --runs 20`
+    `python benchmarks/undo_latency.py --json results.json`
+
+Each interpreter runs under termrewrite.run_with_listeners, as
+`python rlundo` would run it, in a pty made with pity.fork; cursor position
+queries are answered from a screen model. For each heap size (MB of small
+objects made before measuring) and undo depth (commands run before
+measuring) a fresh session is started and measured:
+
+    first_prompt   starting rlundo until the first prompt
+    command        Enter on a print() until the next prompt
+    fork           os.fork() in the shim, from its state records
+    save           the printed output until the prompt: the save round trip
+    restore        Enter on undo until the restored prompt
+
+Interpreters:
+
+    python         the undoablepython shim
+    undoreadline   the generic shim used by interpreters with an input()
+    plain          python without undo, a baseline for command
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import fcntl
+import json
+import os
+import platform
+import select
+import signal
+import struct
+import sys
+import termios
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from rlundo import pity
+from rlundo import ps
+from rlundo.screen import Screen
+
+RUNNER = ('import sys; sys.path.insert(0, %r); from rlundo import termrewrite; '
+          'termrewrite.run_with_listeners(sys.argv[1:])' % (ROOT, ))
+
+INTERPRETERS = {
+    'python': [sys.executable, '-m', 'rlundo.interps.undoablepython'],
+    'undoreadline': [sys.executable, '-c',
+                     'from rlundo import undoreadline as u; '
+                     'u.init_terminal_rewriting(); u.ForkUndoConsole().interact()'],
+    'plain': [sys.executable, '-q', '-i'],
+}
+
+PROMPT = b'>>> '
+WIDTH, HEIGHT = 100, 40
+QUIET = .05  # seconds without output before the prompt counts as final
+TIMEOUT = 60
+
+METRICS = ['first_prompt', 'command', 'fork', 'save', 'restore']
+
+
+class Session(object):
+    """An interpreter under rlundo in a pty, with timestamped output"""
+
+    def __init__(self, argv, env):
+        self.started = time.time()
+        self.pid, self.fd, _ = pity.fork(False)
+        if self.pid == pity.CHILD:
+            os.environ.update(env)
+            os.execv(sys.executable, [sys.executable, '-c', RUNNER] + argv)
+        fcntl.ioctl(self.fd, termios.TIOCSWINSZ, struct.pack('HHHH', HEIGHT, WIDTH, 0, 0))
+        self.screen = Screen(WIDTH, HEIGHT)
+        self.screen.reset()
+        self.output = b''
+
+    def read(self, timeout):
+        """Read what's available within timeout, returning when it arrived"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return None
+        now = time.time()
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            data = b''
+        if not data:
+            raise EOFError('session ended: %r' % (self.output[-500:], ))
+        parts = data.split(b'\x1b[6n')
+        for i, part in enumerate(parts):
+            self.screen.feed(part)
+            if i < len(parts) - 1:
+                os.write(self.fd, b'\x1b[%d;%dR' % (self.screen.cursor_row + 1,
+                                                    self.screen.cursor_col + 1))
+        self.output += b''.join(parts)
+        return now
+
+    def wait_for(self, marker=None):
+        """Time the prompt appeared, and the time marker did if given
+
+        Waits until there's been no output for QUIET seconds after it."""
+        start = len(self.output)
+        deadline = time.time() + TIMEOUT
+        marked = prompted = None
+        while time.time() < deadline:
+            arrived = self.read(QUIET if prompted else deadline - time.time())
+            if arrived is None:
+                if prompted:
+                    return prompted, marked
+                continue
+            if marker is not None and marked is None and marker in self.output[start:]:
+                marked = arrived
+            prompted = arrived if self.output.endswith(PROMPT) else None
+        raise RuntimeError('no prompt: %r' % (self.output[-500:], ))
+
+    def type(self, line, marker=None):
+        """Send line and wait for the prompt; returns (sent, prompted, marked)"""
+        sent = time.time()
+        os.write(self.fd, line + b'\r')
+        return (sent, ) + self.wait_for(marker)
+
+    def last_fork(self):
+        """fork_seconds of the newest process of the chain"""
+        prefix = '%d-' % (self.pid, )
+        for state_dir in ps.state_dirs():
+            if os.path.basename(state_dir).startswith(prefix):
+                records = ps.chain(state_dir)
+                if records:
+                    return max(records, key=lambda r: r['created'])['fork_seconds']
+        return None
+
+    def close(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        os.waitpid(self.pid, 0)
+        os.close(self.fd)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def measure(interpreter, heap_mb, depth, runs):
+    """{metric: [seconds, ...]} for one session"""
+    samples = dict((metric, []) for metric in METRICS)
+    env = {'PYTHONPATH': ROOT, 'TERM': 'xterm'}
+    session = Session(INTERPRETERS[interpreter], env)
+    try:
+        prompted, _ = session.wait_for()
+        samples['first_prompt'].append(prompted - session.started)
+        if heap_mb:
+            session.type(b'_heap = [[i, str(i)] for i in range(%d)]' % (heap_mb * 5000, ))
+        for _ in range(depth):
+            session.type(b'pass')
+        for i in range(runs):
+            sent, prompted, marked = session.type(b'print("mark%d")' % (i, ),
+                                                  b'\nmark%d\r' % (i, ))
+            samples['command'].append(prompted - sent)
+            if interpreter == 'plain':
+                continue
+            samples['save'].append(prompted - marked)
+            fork = session.last_fork()
+            if fork is not None:
+                samples['fork'].append(fork)
+            sent, prompted, _ = session.type(b'undo')
+            samples['restore'].append(prompted - sent)
+    finally:
+        session.close()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--interpreters', nargs='*', default=['python', 'undoreadline', 'plain'],
+                        choices=sorted(INTERPRETERS))
+    parser.add_argument('--heaps', nargs='*', type=int, default=[0, 100],
+                        help='MB of objects on the heap')
+    parser.add_argument('--depths', nargs='*', type=int, default=[1, 20],
+                        help='commands run before measuring')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--json', metavar='PATH', help='also write results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    print('%-13s %6s %6s %-13s %8s %8s %8s %5s' % (
+        'interpreter', 'heap', 'depth', 'metric', 'p50', 'p90', 'p99', 'n'))
+    for interpreter in args.interpreters:
+        for heap_mb in args.heaps:
+            for depth in args.depths:
+                samples = measure(interpreter, heap_mb, depth, args.runs)
+                for metric in METRICS:
+                    values = samples[metric]
+                    if not values:
+                        continue
+                    result = {'interpreter': interpreter, 'heap_mb': heap_mb,
+                              'depth': depth, 'metric': metric, 'n': len(values)}
+                    for p in (50, 90, 99):
+                        result['p%d_ms' % (p, )] = percentile(values, p) * 1000
+                    results.append(result)
+                    print('%-13s %4dMB %6d %-13s %6.1fms %6.1fms %6.1fms %5d' % (
+                        interpreter, heap_mb, depth, metric, result['p50_ms'],
+                        result['p90_ms'], result['p99_ms'], len(values)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'time': time.time(),
+                       'runs': args.runs,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
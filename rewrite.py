@@ -1,13 +1,21 @@
 import argparse
 
-from rlundo.termrewrite import run_with_listeners
+from rlundo import journal
+from rlundo.termrewrite import run_with_listeners, configure_journal
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Run a command in a pty, saving and restoring the terminal state")
     parser.add_argument('--save-addr', action='store', default=None)
     parser.add_argument('--restore-addr', action='store', default=None)
+    parser.add_argument('--max-snapshot-bytes', action='store', type=int,
+                        default=journal.DEFAULT_MAX_SNAPSHOT_BYTES,
+                        help="bytes of output kept for each snapshot")
+    parser.add_argument('--max-session-bytes', action='store', type=int,
+                        default=journal.DEFAULT_MAX_SESSION_BYTES,
+                        help="bytes of output kept for the whole session")
     parser.add_argument('command', nargs='*')
     args = parser.parse_args()
+    configure_journal(args.max_snapshot_bytes, args.max_session_bytes)
     if args.command == []:
         args.command = ['python', '-c', "while True: (raw_input if '' == b'' else input)('>')"]
     run_with_listeners(args.command, save_addr=args.save_addr, restore_addr=args.restore_addr)
@@ -14,7 +14,6 @@ import argparse
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import rlundo
 
-from rlundo.rlundoable import modify_env_with_modified_rl
 from rlundo.termrewrite import run_with_listeners
 
 from rlundo import interps
@@ -26,15 +25,14 @@ def start_undoable_rl(interpreter, interparg):
     If an interpreter matches the first argument, run script like that.
     Otherwise run that command in an environment where a modified readline will
     be used instead of the standard one."""
-    for command, predicate in interps.interpreters:
-        if predicate(interpreter):
-            return run_with_listeners(command + interparg)
-    else:
-        modify_env_with_modified_rl()
-        return run_with_listeners([interpreter] + interparg)
+    return run_with_listeners(interps.undoable_command(interpreter, interparg, os.environ))
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['ps']:
+        from rlundo import ps
+        ps.main(sys.argv[2:])
+        sys.exit()
     parser = argparse.ArgumentParser(description='accepting an interpreter and any interpreter arguments into rlundo')
     parser.add_argument('interpreter', metavar='I', help='command to call the interpreter')
     parser.add_argument('interparg', nargs=argparse.REMAINDER, help='any arguments you can feed into the interpreter')
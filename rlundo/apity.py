@@ -0,0 +1,326 @@
+"""
+asyncio counterpart of pity: runs a command in a pty without blocking the
+calling thread, so one event loop can host many sessions.
+
+    proc = await aspawn(['python'])
+    proc.write(b'1 + 1\r')
+    output = await proc.read()
+    status = await proc.wait()
+
+It needs Python 3.7, and is only imported there: termrewrite.arun, which
+runs a rewriting session on the event loop, lives here.
+"""
+
+import asyncio
+import collections
+import errno
+import fcntl
+import os
+import pty
+import signal
+import struct
+import termios
+import tty
+
+from . import pity
+
+# stop reading from the pty while this much output is waiting for read()
+OUTPUT_BUFFER_LIMIT = 64 * 1024
+
+# for each loop, futures of the children to reap on SIGCHLD, by pid
+_sigchld_waiting = {}
+
+
+class PtyProcess(object):
+    """A child process in a pty, served by the asyncio event loop
+
+    Attached to the terminal, output is copied to standard output and
+    keystrokes from standard input to the child, as pity.spawn does.
+    Otherwise output is passed to output if it's given, or kept for read(),
+    and input comes from write().
+
+    master_read and stdin_read are called with a readable fd and return the
+    bytes read, like the callbacks of pity.spawn. listeners maps listening
+    sockets to handlers that are called with no arguments each time a
+    connection is accepted; the connection is closed when the handler
+    returns, or when the coroutine it returns finishes. channels maps
+    connected sockets to functions called each time they're readable,
+    until they return False."""
+
+    def __init__(self, pid, master_fd, slave_name, master_read=None,
+                 stdin_read=pty._read, listeners=None, terminal=False,
+                 handle_window_size=False, output=None, loop=None, channels=None):
+        self.pid = pid
+        self.master_fd = master_fd
+        self.slave_name = slave_name
+        self.master_read = master_read or pity.AdaptiveReader()
+        self.stdin_read = stdin_read
+        self.listeners = listeners or {}
+        self.channels = dict(channels or {})
+        self.terminal = terminal
+        self.handle_window_size = handle_window_size
+        self.output_callback = output
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.output = collections.deque()
+        self.buffered = 0  # bytes in output
+        self.paused = False  # not reading the pty until output is read
+        self.eof = False
+        self.to_child = b''  # input the pty hasn't accepted yet
+        self.readable = asyncio.Event()
+        self.exited = self.loop.create_future()
+        self.tasks = set()
+        self.terminal_mode = None
+        self.stdin_flags = None
+
+    def start(self):
+        pity.set_nonblocking(self.master_fd)
+        self.loop.add_reader(self.master_fd, self._on_output)
+        for sock in self.listeners:
+            sock.setblocking(False)
+            self.loop.add_reader(sock, self._on_connection, sock)
+        for sock in self.channels:
+            self.loop.add_reader(sock, self._on_channel, sock)
+        if self.terminal:
+            try:
+                self.terminal_mode = tty.tcgetattr(pity.STDIN_FILENO)
+                tty.setraw(pity.STDIN_FILENO)
+            except tty.error:
+                pass
+            self.stdin_flags = pity.set_nonblocking(pity.STDIN_FILENO)
+            self.loop.add_reader(pity.STDIN_FILENO, self._on_input)
+            if self.handle_window_size:
+                self.loop.add_signal_handler(
+                    signal.SIGWINCH, pity._winch, self.slave_name, self.pid)
+
+    async def read(self):
+        """Next chunk of output, or b'' once the child has closed the pty"""
+        while not self.output and not self.eof:
+            self.readable.clear()
+            await self.readable.wait()
+        if not self.output:
+            return b''
+        data = self.output.popleft()
+        self.buffered -= len(data)
+        if self.paused and self.buffered < OUTPUT_BUFFER_LIMIT:
+            self.paused = False
+            self.loop.add_reader(self.master_fd, self._on_output)
+        return data
+
+    def write(self, data):
+        """Send data to the child as if it had been typed"""
+        if self.eof or not data:
+            return
+        if self.to_child:
+            self.to_child += data
+            return
+        self.to_child = data[pity._write_some(self.master_fd, data):]
+        if self.to_child:
+            self.loop.add_writer(self.master_fd, self._on_writable)
+
+    def resize(self, rows, columns):
+        """Set the size of the pty, which sends the child SIGWINCH"""
+        fcntl.ioctl(self.master_fd, termios.TIOCSWINSZ,
+                    struct.pack('HHHH', rows, columns, 0, 0))
+
+    def drain(self, timeout=None):
+        """Deliver all output waiting on the pty, for save and restore hooks
+
+        Returns False if output was still arriving after timeout seconds."""
+        if self.eof:
+            return True
+        return pity.drain(self.master_fd, self.master_read, timeout,
+                          self._deliver)
+
+    def kill(self, sig=signal.SIGTERM):
+        """Send the child sig, unless it has already exited"""
+        try:
+            os.kill(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    async def wait(self):
+        """Wait for the child to exit and return its exit status"""
+        return await self.exited
+
+    def _deliver(self, data):
+        if self.terminal:
+            pity.write_stdout(data)
+            return
+        if self.output_callback is not None:
+            self.output_callback(data)
+            return
+        self.output.append(data)
+        self.buffered += len(data)
+        self.readable.set()
+        if self.buffered >= OUTPUT_BUFFER_LIMIT and not self.paused:
+            self.paused = True
+            self.loop.remove_reader(self.master_fd)
+
+    def _on_output(self):
+        data = pity.copy_output(self.master_fd, self.master_read, self._deliver)
+        if data == b'':
+            self._close()
+
+    def _on_writable(self):
+        self.to_child = self.to_child[pity._write_some(self.master_fd, self.to_child):]
+        if not self.to_child:
+            self.loop.remove_writer(self.master_fd)
+
+    def _on_input(self):
+        try:
+            data = self.stdin_read(pity.STDIN_FILENO)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            return
+        if data is None:
+            return  # nothing for the child
+        if not data:
+            self.loop.remove_reader(pity.STDIN_FILENO)
+        else:
+            self.write(data)
+
+    def _on_connection(self, sock):
+        try:
+            conn, _ = sock.accept()
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            return
+        try:
+            result = self.listeners[sock]()
+        except BaseException:
+            conn.close()
+            raise
+        if asyncio.iscoroutine(result):
+            task = asyncio.ensure_future(result)
+            self.tasks.add(task)
+            task.add_done_callback(lambda t: (self.tasks.discard(t), conn.close()))
+        else:
+            conn.close()
+
+    def _on_channel(self, sock):
+        if not self.channels[sock]():
+            self.loop.remove_reader(sock)
+            del self.channels[sock]
+
+    def _close(self):
+        self.eof = True
+        self.readable.set()
+        if not self.paused:
+            self.loop.remove_reader(self.master_fd)
+        self.loop.remove_writer(self.master_fd)
+        for sock in self.listeners:
+            self.loop.remove_reader(sock)
+        for sock in self.channels:
+            self.loop.remove_reader(sock)
+        if self.terminal:
+            self.loop.remove_reader(pity.STDIN_FILENO)
+            if self.handle_window_size:
+                self.loop.remove_signal_handler(signal.SIGWINCH)
+            fcntl.fcntl(pity.STDIN_FILENO, fcntl.F_SETFL, self.stdin_flags)
+            if self.terminal_mode is not None:
+                tty.tcsetattr(pity.STDIN_FILENO, tty.TCSAFLUSH, self.terminal_mode)
+        os.close(self.master_fd)
+        _when_exited(self.loop, self.pid, self.exited)
+
+
+def _when_exited(loop, pid, exited):
+    """Set future exited to the wait status of child pid once it exits
+
+    The child is reaped with WNOHANG once its pidfd is readable, or where
+    there are no pidfds (before Linux 5.3, or on macOS) on SIGCHLD, so no
+    thread is kept in a blocking waitpid."""
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        waiting = _sigchld_waiting.setdefault(loop, {})
+        if not waiting:
+            loop.add_signal_handler(signal.SIGCHLD, _reap_waiting, loop)
+        waiting[pid] = exited
+        _reap_waiting(loop)  # it may have exited already
+        return
+
+    def readable():
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+        _reap(pid, exited)
+    loop.add_reader(pidfd, readable)
+
+
+def _reap_waiting(loop):
+    waiting = _sigchld_waiting[loop]
+    for pid, exited in list(waiting.items()):
+        if _reap(pid, exited):
+            del waiting[pid]
+    if not waiting:
+        loop.remove_signal_handler(signal.SIGCHLD)
+        del _sigchld_waiting[loop]
+
+
+def _reap(pid, exited):
+    """Whether child pid has exited, setting exited to its status if it has"""
+    try:
+        done, status = os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError as e:  # reaped by someone else
+        if not exited.done():
+            exited.set_exception(e)
+        return True
+    if done and not exited.done():
+        exited.set_result(status)
+    return bool(done)
+
+
+async def aspawn(argv, master_read=None, stdin_read=pty._read,
+                 handle_window_size=False, listeners=None, terminal=False,
+                 size=None, output=None, env=None, channels=None):
+    """Start argv in a pty and return its PtyProcess without waiting for it
+
+    terminal attaches the process to this process's terminal, in which case
+    handle_window_size keeps the pty the same size as the terminal.
+    Otherwise size can be a (rows, columns) pair to start the pty with.
+    env replaces the environment of the child."""
+    if type(argv) == type(''):
+        argv = (argv,)
+    pid, master_fd, slave_name = pity.fork(terminal and handle_window_size)
+    if pid == pity.CHILD:
+        try:
+            if env is None:
+                os.execlp(argv[0], *argv)
+            else:
+                os.execvpe(argv[0], argv, env)
+        finally:
+            # never return to the parent's event loop in the child
+            os._exit(127)
+    proc = PtyProcess(pid, master_fd, slave_name, master_read, stdin_read,
+                      listeners, terminal, handle_window_size, output,
+                      asyncio.get_event_loop(), channels)
+    if size is not None:
+        proc.resize(*size)
+    proc.start()
+    return proc
+
+
+async def arun(argv, listeners=None, channel=None):
+    """Like termrewrite.run, but on the running asyncio event loop
+
+    Returns the exit status of the child."""
+    from . import termrewrite
+    termrewrite.sync_screen()
+    session = termrewrite.session
+    proc = await aspawn(argv,
+                        master_read=termrewrite.master_read,
+                        stdin_read=termrewrite.stdin_read,
+                        handle_window_size=True,
+                        listeners=listeners,
+                        terminal=True,
+                        channels=termrewrite._channels(channel))
+    if channel is not None:
+        channel.spawned()
+    termrewrite.set_master_fd(proc.pid, proc.master_fd)
+    # anything typed before the child started is waiting in child_input
+    proc.write(session.child_input.pending)
+    session.child_input.pending = b''
+    session.send_input = proc.write
+    return await proc.wait()
@@ -0,0 +1,346 @@
+"""
+Control channel between an interpreter's undo shim and the rewriter.
+
+Before starting the interpreter the rewriter makes a socketpair; the
+interpreter inherits one end as the file descriptor in RLUNDO_CONTROL_FD,
+and every process of its undo chain shares it. Requests are
+protocol.REQUEST frames,
+
+    {"op": "save", "id": "1234.7"}     -> {"id": "1234.7", "snapshots": 7}
+    {"op": "save", "id": "1234.8", "levels": 6}
+                                       -> {"id": "1234.8", "snapshots": 7,
+                                           "release": 1}
+    {"op": "restore", "id": "1234.8"}  -> {"id": "1234.8", "snapshots": 5}
+    {"op": "redo", "id": "1234.9"}     -> {"id": "1234.9", "snapshots": 5}
+    {"op": "exit", "id": "1234.10"}    -> {"id": "1234.10", "snapshots": 5}
+    {"op": "ps", "id": "1234.11"}      -> {"id": "1234.11", "snapshots": 5,
+                                           "processes": [...]}
+
+each answered, in order, by a protocol.REPLY frame with the same id and
+the number of snapshots the rewriter holds afterwards (and for ps, the
+records of the undo chain, as rlundo.ps.chain returns them), or with an "error"
+message if the request couldn't be read or carried out. A save with levels,
+the number of processes the sender has parked, is answered with how many
+of the oldest of them to release for memory (see rlundo.retention). A process can send
+a request without waiting for its reply: replies it never reads are
+skipped by whichever process waits on the channel next, since ids start
+with the pid of the process that sent them.
+
+Without RLUNDO_CONTROL_FD, as under a rewriter started by hand with
+rewrite.py, requests fall back to a connection to RLUNDO_SAVE or
+RLUNDO_RESTORE each.
+
+With RLUNDO_MARKERS set, requests are instead written to standard output
+as a private OSC sequence, \x1b]7701;<op>;<id>\x07, which the rewriter
+takes out of the output it reads from the pty. A marker sits at exactly
+the byte the snapshot belongs at, needs no reply, and gets through
+anything that passes the output on, like ssh or another pty, so an
+interpreter on another machine can be undone by the rewriter of the
+terminal it's shown in.
+"""
+
+import os
+import socket
+import sys
+
+from . import protocol
+
+CONTROL_FD_VAR = 'RLUNDO_CONTROL_FD'
+MARKERS_VAR = 'RLUNDO_MARKERS'
+
+MARKER = b'\x1b]7701;'
+MAX_MARKER = 256  # longer sequences starting like a marker aren't ours
+
+
+class ControlError(Exception):
+    pass
+
+
+def _flush():
+    # output written before the request has to reach the pty first, since
+    # the rewriter waits for the pty to drain rather than for a fixed time
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+class Client(object):
+    """The interpreter's end of the control channel"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sent = 0
+
+    def send(self, op, **fields):
+        """Send a request without waiting for the reply, returning its id"""
+        _flush()
+        self.sent += 1
+        id = '%d.%d' % (os.getpid(), self.sent)
+        request = dict(fields, op=op, id=id)
+        self.sock.sendall(protocol.message(protocol.REQUEST, request))
+        return id
+
+    def wait(self, id):
+        """The reply to request id, skipping replies to earlier requests
+
+        Replies are read a frame at a time, since whatever follow this one
+        belong to the next process of the chain to wait."""
+        while True:
+            f = protocol.recv_frame(self.sock)
+            if f is None:
+                raise ControlError('the rewriter closed the control channel')
+            kind, payload = f
+            if kind != protocol.REPLY:
+                raise protocol.ProtocolError('unexpected frame kind %d' % (kind, ))
+            reply = protocol.decode(payload)
+            if reply.get('id') == id:
+                if 'error' in reply:
+                    raise ControlError(reply['error'])
+                return reply
+
+    def request(self, op, **fields):
+        return self.wait(self.send(op, **fields))
+
+
+class AddressClient(object):
+    """Requests to a rewriter that only listens on RLUNDO_SAVE and RLUNDO_RESTORE"""
+
+    def __init__(self, save_addr, restore_addr):
+        self.addrs = {'save': save_addr, 'restore': restore_addr}
+
+    def send(self, op, **fields):
+        _flush()
+        addr = self.addrs.get(op)
+        if addr is None:
+            return None  # nothing to tell these rewriters
+        s = socket.socket(family=socket.AF_UNIX)
+        try:
+            s.connect(addr)
+            s.recv(1024)  # closed once the request has been handled
+        finally:
+            s.close()
+        return None
+
+    def wait(self, id):
+        return {}
+
+    def request(self, op, **fields):
+        return self.wait(self.send(op, **fields))
+
+
+class MarkerClient(object):
+    """Requests written into the interpreter's output, without their fields"""
+
+    def __init__(self, fd=1):
+        self.fd = fd
+        self.sent = 0
+
+    def send(self, op, **fields):
+        _flush()
+        self.sent += 1
+        id = '%d.%d' % (os.getpid(), self.sent)
+        os.write(self.fd, marker(op, id))
+        return id
+
+    def wait(self, id):
+        return {}
+
+    def request(self, op, **fields):
+        return self.wait(self.send(op, **fields))
+
+
+def marker(op, id):
+    return MARKER + ('%s;%s' % (op, id)).encode('ascii') + b'\x07'
+
+
+def _terminator(data, start):
+    """(start, end) of the BEL or ST ending the sequence at start, or None"""
+    found = []
+    for terminator in (b'\x07', b'\x1b\\'):
+        i = data.find(terminator, start)
+        if i != -1:
+            found.append((i, i + len(terminator)))
+    return min(found) if found else None
+
+
+class MarkerParser(object):
+    """Picks markers out of output as it arrives
+
+    feed returns the output as a list of bytes, with an (op, id) pair where
+    each marker was. The end of the output is held back until the next feed
+    while it could be the start of a marker, or until flush if no more
+    output is coming."""
+
+    def __init__(self):
+        self.held = b''
+
+    def feed(self, data):
+        if self.held:
+            data, self.held = self.held + data, b''
+        pieces = []
+        start = 0
+        while True:
+            i = data.find(MARKER, start)
+            if i == -1:
+                break
+            end = _terminator(data, i + len(MARKER))
+            if end is None:
+                if len(data) - i < MAX_MARKER:
+                    self.held = data[i:]
+                    data = data[:i]
+                    break
+                # too long to be a marker, so it's output
+                pieces.append(data[start:i + len(MARKER)])
+                start = i + len(MARKER)
+                continue
+            if i > start:
+                pieces.append(data[start:i])
+            op, _, id = data[i + len(MARKER):end[0]].decode('ascii', 'replace').partition(';')
+            pieces.append((op, id))
+            start = end[1]
+        rest = data[start:]
+        if not self.held and b'\x1b' in rest[-(len(MARKER) - 1):]:
+            for n in range(len(MARKER) - 1, 0, -1):
+                if rest.endswith(MARKER[:n]):
+                    rest, self.held = rest[:-n], rest[-n:]
+                    break
+        if rest:
+            pieces.append(rest)
+        return pieces
+
+    def flush(self):
+        """The output being held back, as output after all"""
+        held, self.held = self.held, b''
+        return held
+
+
+def connect(environ=os.environ):
+    """Client for the rewriter this process is running under
+
+    Raises KeyError if there isn't one."""
+    if environ.get(MARKERS_VAR):
+        return MarkerClient()
+    if CONTROL_FD_VAR in environ:
+        fd = int(environ[CONTROL_FD_VAR])
+        return Client(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, fileno=fd))
+    return AddressClient(environ['RLUNDO_SAVE'], environ['RLUNDO_RESTORE'])
+
+
+_client = None
+
+
+def client():
+    """The client of this process, connected on first use"""
+    global _client
+    if _client is None:
+        _client = connect()
+    return _client
+
+
+def save(levels=None):
+    """Ask the rewriter to snapshot the terminal, waiting until it has
+
+    Returns the reply, which is empty from rewriters that can't send one.
+    levels is how many processes this one has parked, for the rewriter to
+    say how many to release (see forking.save)."""
+    if levels is None:
+        return client().request('save')
+    return client().request('save', levels=levels)
+
+
+def restore():
+    """Ask the rewriter to restore the second-to-last snapshot
+
+    Doesn't wait: the next process to use the channel is behind it in line,
+    so the restore is done by the time that process hears back."""
+    client().send('restore')
+
+
+def redo():
+    """Ask the rewriter to put back what the last restore took away
+
+    Doesn't wait, like restore."""
+    client().send('redo')
+
+
+def exit():
+    """Tell the rewriter the interpreter is exiting, without waiting"""
+    client().send('exit')
+
+
+def ps():
+    """Records of the processes of this session's undo chain, see rlundo.ps
+
+    Empty if the rewriter isn't keeping them or can't be asked."""
+    return client().request('ps').get('processes', [])
+
+
+class Server(object):
+    """The rewriter's end of the control channel
+
+    handlers maps ops to functions called with the request's other fields
+    as keyword arguments, which can return a dict of more to put in the
+    reply, and snapshots is a function
+    returning the number of snapshots held. Pass child_fd to
+    the interpreter in its environment and call spawned() once it has
+    started; then call serve() whenever sock is readable."""
+
+    def __init__(self, handlers, snapshots):
+        self.handlers = handlers
+        self.snapshots = snapshots
+        self.sock, child = socket.socketpair()
+        child.set_inheritable(True)
+        self.child = child
+        self.child_fd = child.fileno()
+        self.reader = protocol.FrameReader()
+
+    def environ(self):
+        return {CONTROL_FD_VAR: str(self.child_fd)}
+
+    def spawned(self):
+        """Close the interpreter's end here, so the channel ends with it"""
+        if self.child is not None:
+            self.child.close()
+            self.child = None
+
+    def serve(self):
+        """Answer the requests that have arrived; False once the channel is closed"""
+        try:
+            data = self.sock.recv(65536)
+        except ConnectionError:
+            data = b''
+        if not data:
+            return False
+        replies = []
+        for kind, payload in self.reader.feed(data):
+            if kind != protocol.REQUEST:
+                replies.append({'id': None, 'error': 'unexpected frame kind %d' % (kind, )})
+                continue
+            try:
+                request = protocol.decode(payload)
+            except protocol.ProtocolError as e:
+                replies.append({'id': None, 'error': str(e)})
+                continue
+            replies.append(self.handle(request))
+        try:
+            self.sock.sendall(b''.join(protocol.message(protocol.REPLY, r) for r in replies))
+        except ConnectionError:
+            return False  # nobody waited, as after an exit
+        return True
+
+    def handle(self, request):
+        handler = self.handlers.get(request.get('op'))
+        if handler is None:
+            return {'id': request.get('id'), 'error': 'unknown op %r' % (request.get('op'), )}
+        fields = dict((str(k), v) for k, v in request.items() if k not in ('op', 'id'))
+        try:
+            result = handler(**fields)
+        except Exception as e:
+            return {'id': request.get('id'), 'error': '%s: %s' % (type(e).__name__, e)}
+        reply = {'id': request.get('id'), 'snapshots': self.snapshots()}
+        if isinstance(result, dict):
+            reply.update(result)
+        return reply
+
+    def close(self):
+        self.spawned()
+        self.sock.close()
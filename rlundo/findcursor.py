@@ -1,6 +1,22 @@
+import collections
+import errno
+import os
+import re
+import select
 import termios
+import time
 import tty
-import re
+
+from .termhelpers import Blocking
+
+QUERY_CURSOR_POSITION = b'\x1b[6n'
+CURSOR_POSITION_TIMEOUT = 1.0  # seconds to wait for the terminal to reply
+LATE_REPORT_GRACE = 5.0  # seconds a reply that timed out may still arrive in
+
+_REPORT = re.compile(br'\x1b\[(\d{1,5});(\d{1,5})R')
+# the start of a report cut off by the end of a read
+_PARTIAL_REPORT = re.compile(br'\x1b(\[(\d{1,5}(;(\d{1,5})?)?)?)?\Z')
+_LONGEST_PARTIAL = len(b'\x1b[99999;99999')
 
 
 class Cbreak(object):
@@ -31,43 +47,171 @@ class Termmode(object):
         termios.tcsetattr(self.stream, termios.TCSANOW, self.original_stty)
 
 
+class CursorPositionTimeout(Exception):
+    pass
+
+
+class CursorReportParser(object):
+    """Finds cursor position reports (ESC [ row ; col R) in terminal input
+
+    Input is fed in whatever chunks it was read in; the start of a report
+    at the end of a chunk is held back until the rest arrives."""
+
+    def __init__(self):
+        self.held = b''
+
+    def feed(self, data):
+        """Returns (the other bytes, [(row, column), ...]), counting from 0"""
+        data = self.held + data
+        other = []
+        reports = []
+        start = 0
+        for m in _REPORT.finditer(data):
+            other.append(data[start:m.start()])
+            reports.append((int(m.group(1)) - 1, int(m.group(2)) - 1))
+            start = m.end()
+        rest = data[start:]
+        m = _PARTIAL_REPORT.search(rest, max(0, len(rest) - _LONGEST_PARTIAL))
+        if m:
+            self.held = rest[m.start():]
+            rest = rest[:m.start()]
+        else:
+            self.held = b''
+        other.append(rest)
+        return b''.join(other), reports
+
+    def flush(self):
+        """Bytes held back, which aren't going to be a report after all"""
+        held, self.held = self.held, b''
+        return held
+
+
+class InputDemux(object):
+    """Separates replies to cursor position queries from keystrokes
+
+    Everything read from the terminal goes through feed, whether by the
+    event loop copying stdin to the child or by get_cursor_position while it
+    waits for a reply. Keystrokes come out in the order they were typed and
+    bytes that get_cursor_position reads are passed to forward.
+
+    Reports are only looked for while a query is outstanding, because some
+    keys (like shift-F3) send the same bytes. The terminal answers queries
+    in order, so a query that timed out has its reply, if it comes late,
+    discarded rather than taken as the reply to the next one."""
+
+    def __init__(self, forward):
+        self.forward = forward
+        self.parser = CursorReportParser()
+        self.reports = collections.deque()
+        self.expecting = 0  # queries without replies
+        self.stale = 0  # how many of those were given up on
+        self.expect_until = 0
+
+    def feed(self, data):
+        """Bytes of data that aren't replies to our queries"""
+        if not self.expecting and not self.parser.held:
+            return data
+        if self.expecting and time.time() > self.expect_until:
+            self.expecting = self.stale = 0  # those replies aren't coming
+        data, reports = self.parser.feed(data)
+        if reports:
+            # ESC [ r ; c R typed with nothing outstanding goes to the child
+            extra = []
+            for row, col in reports:
+                if self.stale:
+                    self.stale -= 1
+                    self.expecting -= 1
+                elif self.expecting:
+                    self.expecting -= 1
+                    self.reports.append((row, col))
+                else:
+                    extra.append(b'\x1b[%d;%dR' % (row + 1, col + 1))
+            data += b''.join(extra)
+        if not self.expecting:
+            data += self.parser.flush()
+        return data
+
+    def flush_keys(self):
+        """Bytes held back that are keystrokes, now nothing more is coming
+
+        Call when there's nothing more to read. A terminal writes a report
+        in one go, so ESC or ESC [ on its own at the end of the input is the
+        Escape key or an Alt-prefixed one, not the start of a late report,
+        and the program shouldn't have to wait for the grace to run out."""
+        if self.parser.held in (b'\x1b', b'\x1b['):
+            return self.parser.flush()
+        return b''
+
+    def get_cursor_position(self, to_fd, from_fd, timeout=CURSOR_POSITION_TIMEOUT):
+        """Ask the terminal where the cursor is, forwarding keystrokes meanwhile
+
+        from_fd should already be in raw or cbreak mode. Raises
+        CursorPositionTimeout if the terminal doesn't reply within timeout
+        seconds."""
+        self.reports.clear()  # any left over are replies to an earlier query
+        self.stale = self.expecting  # and so are any still to come
+        self.expecting += 1
+        self.expect_until = time.time() + timeout + LATE_REPORT_GRACE
+        _write_all(to_fd, QUERY_CURSOR_POSITION)
+        deadline = time.time() + timeout
+        while not self.reports:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.forward(self.parser.flush())
+                raise CursorPositionTimeout('no reply to cursor position query in %ss'
+                                            % (timeout, ))
+            if not select.select([from_fd], [], [], remaining)[0]:
+                continue
+            try:
+                data = os.read(from_fd, 1024)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                continue
+            if not data:
+                raise CursorPositionTimeout('end of input while waiting for cursor position')
+            data = self.feed(data)
+            if data:
+                self.forward(data)
+        return self.reports.popleft()
+
+
+def _write_all(fd, data):
+    while data:
+        try:
+            data = data[os.write(fd, data):]
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            select.select([], [fd], [])
+
+
 def get_cursor_position(to_terminal, from_terminal):
-    with Cbreak(from_terminal):
+    # the terminal may be non-blocking while rewrite's event loop is running
+    with Cbreak(from_terminal), Blocking(to_terminal.fileno()), Blocking(from_terminal.fileno()):
         return _inner_get_cursor_position(to_terminal, from_terminal)
 
 
 def _inner_get_cursor_position(to_terminal, from_terminal):
-    query_cursor_position = u"\x1b[6n"
-    to_terminal.write(query_cursor_position)
-    to_terminal.flush()
+    """Reads the reply a byte at a time, so nothing after it is consumed
 
-    def retrying_read():
-        while True:
-            try:
-                c = from_terminal.read(1)
-                if c == '':
-                    raise ValueError("Stream should be blocking - should't"
-                                     " return ''. Returned %r so far", (resp,))
-                return c
-            except IOError as e:
-                raise ValueError('cursor get pos response read interrupted: %r' % (resp, ))
-
-    resp = ''
+    Use InputDemux where there's somewhere to send bytes typed before the
+    reply; here they're an error."""
+    to_terminal.flush()
+    _write_all(to_terminal.fileno(), QUERY_CURSOR_POSITION)
+    parser = CursorReportParser()
+    extra = []
     while True:
-        c = retrying_read()
-        resp += c
-        m = re.search('(?P<extra>.*)'
-                      '(?P<CSI>\x1b\[|\x9b)'
-                      '(?P<row>\\d+);(?P<column>\\d+)R', resp, re.DOTALL)
-        if m:
-            row = int(m.groupdict()['row'])
-            col = int(m.groupdict()['column'])
-            extra = m.groupdict()['extra']
-            if extra:  # TODO send these to child process
+        c = os.read(from_terminal.fileno(), 1)
+        if not c:
+            raise ValueError("Stream should be blocking - should't"
+                             " return ''. Got %r so far" % (b''.join(extra) + parser.held, ))
+        other, reports = parser.feed(c)
+        extra.append(other)
+        if reports:
+            if any(extra):
                 raise ValueError(("Bytes preceding cursor position "
                                   "query response thrown out:\n%r\n"
-                                  "Pass an extra_bytes_callback to "
-                                  "CursorAwareWindow to prevent this")
-                                 % (extra,))
-            return (row - 1, col - 1)
-
+                                  "Use an InputDemux to forward them instead")
+                                 % (b''.join(extra), ))
+            return reports[0]
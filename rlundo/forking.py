@@ -0,0 +1,379 @@
+"""
+Forking for undo in the Python shims, keeping as much memory shared as possible.
+
+Every prompt forks the interpreter and parks the parent until the child is
+undone or exits. Their pages stay shared only until one of them writes to
+them, and CPython writes to an object's memory whenever its reference count
+changes or the cyclic garbage collector looks at it. So before forking:
+
+* collect, so garbage isn't copied into every process of the chain
+* in the root, gc.freeze(), moving everything alive into a generation the
+  collector never scans again, so collections further down the chain only
+  touch objects created since. Frozen objects aren't collected even once
+  they're garbage, so only the root's heap, which the whole chain shares,
+  is frozen; freezing at every prompt would keep the cycles each line
+  leaves behind alive for the rest of the session
+
+and in the parked parent, which does nothing but wait, the collector stays
+off until it's resumed by an undo. Reference counts still change for
+whatever the child touches; nothing short of immortal objects avoids that.
+
+If RLUNDO_STATE_DIR is set, each process of the chain has a record there,
+<pid>.json, saying how deep it is, which line it was forked to run and how
+long the fork took, for `rlundo ps` (see rlundo.ps).
+
+Each new child releases the oldest parked processes if the retention
+policy says there's too much history (see rlundo.retention). Under memory
+pressure the rewriter says how many to release instead, in answer to
+save(), so that it lets go of the output of just those. A process whose
+parent was released can't be undone; can_undo() says so.
+
+A child tells its parent how it ended with tell_parent() on a pipe made for
+that fork, which the parent reads with wait_for_child(). A process keeps the
+write end of the pipe to its parent, the write end of the root's pipe and,
+while it's parked, the read end of the pipe from its child, and nothing
+else from the forks before it, so the chain can be thousands of processes
+deep without each one holding more file descriptors than the last.
+
+Exiting doesn't go back up the chain a process at a time, each one running
+interpreter shutdown: end_chain() kills the parked processes between the
+exiting one and the root, which have nothing left to do, and tells the root
+over its pipe, so only the root and the exiting process shut down.
+
+With RLUNDO_MAX_REDO set (see rlundo.retention), an undone child doesn't
+exit but parks too, with park_for_redo(), and its parent keeps it. Entering
+"redo", or the line the child ran, resumes it with redo() instead of
+forking to run the line again. Each fork also gets a pipe the other way
+for this, on which the parent tells its child to resume or how many redos
+to keep below it, and closes it to let the child go. Only the live process
+can have a child parked for redo, and that child's own parked child goes
+with it when it's let go; fork() lets them go before running a new line.
+
+A parked process ignores the signals the terminal sends its foreground
+job, SIGINT, SIGTSTP and SIGWINCH, until it's resumed. Every process of the
+chain is in the foreground process group, so otherwise each of them would
+wake up for every Ctrl-C and resize; ignored signals are dropped by the
+kernel without waking anyone, so only the live child handles them however
+deep the chain is. A process resumed after the terminal was resized sends
+itself the SIGWINCH it missed, so it doesn't go on with the old size.
+"""
+
+import fcntl
+import gc
+import json
+import os
+import signal
+import struct
+import termios
+import time
+
+from . import control
+from . import retention
+
+STATE_DIR_VAR = 'RLUNDO_STATE_DIR'
+
+root = os.getpid()  # the first process of the chain
+depth = 0  # forks between this process and the start of the chain
+parent = None  # the process this one was forked from
+ancestors = []  # parked processes after root, oldest first
+_child = None  # pid of the child this process is parked for
+_to_parent = None  # write end of the pipe to the parent
+_to_root = None  # write end of the pipe from the root to its child
+_from_child = None  # read end of the pipe from _child
+_line = None  # the line _child was forked to run
+_to_child = None  # write end of the pipe to _child, with redo on
+_from_parent = None  # read end of the pipe from the parent, with redo on
+_messages = b''  # read from _from_parent but not yet handled
+_redo = None  # (pid, line, from_child, to_child) of a child parked for redo
+_rewriter_releases = False  # whether the rewriter judges memory pressure
+
+# signals for the foreground job, left to the child while parked
+JOB_SIGNALS = [signal.SIGINT, signal.SIGTSTP, signal.SIGWINCH]
+_handlers = {}  # handlers of JOB_SIGNALS to put back when resumed
+_parked_size = None  # the terminal's size when they were ignored
+
+
+def fork(line=None):
+    """os.fork(), with the heap prepared to be shared
+
+    line is the input the child is forked to run."""
+    global depth, parent, _child, _to_parent, _to_root, _from_child
+    global _line, _to_child, _from_parent, _messages
+    release_redo()
+    gc.collect()
+    if depth == 0:
+        gc.freeze()
+    state_dir = os.environ.get(STATE_DIR_VAR)
+    if state_dir and depth == 0 and not os.path.exists(record_path(state_dir, os.getpid())):
+        write_record(state_dir, os.getpid(), None, 0, None, None)
+    me = os.getpid()
+    read_fd, write_fd = os.pipe()
+    redo_read, redo_write = os.pipe() if retention.policy.max_redo else (None, None)
+    # ignored from before the fork, so a Ctrl-C can't reach the parent
+    # between the fork and its being parked
+    _ignore_job_signals()
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        _restore_job_signals()
+        os.close(read_fd)
+        if _to_parent is not None and _to_parent != _to_root:
+            os.close(_to_parent)
+        _to_parent = write_fd
+        if redo_write is not None:
+            os.close(redo_write)
+        if _from_parent is not None:
+            os.close(_from_parent)
+        _from_parent = redo_read
+        _messages = b''
+        if depth == 0:
+            # the root hears about the end of the chain on this pipe, from
+            # whichever process of the chain is live then
+            _to_root = write_fd
+        if depth > 0:
+            ancestors.append(me)
+        depth += 1
+        parent = me
+        _child = None
+        del ancestors[:retention.policy.release(ancestors,
+                                                pressure=not _rewriter_releases)]
+        return pid
+    elapsed = time.time() - start
+    os.close(write_fd)
+    if redo_read is not None:
+        os.close(redo_read)
+    gc.disable()
+    _child = pid
+    _from_child = read_fd
+    _to_child = redo_write
+    _line = line
+    if state_dir:
+        write_record(state_dir, pid, os.getpid(), depth + 1, line, elapsed)
+    return pid
+
+
+def save():
+    """Ask the rewriter for a snapshot, as control.save does
+
+    The oldest parked processes are released if the rewriter says to. A
+    rewriter that doesn't say either way leaves memory pressure to fork()."""
+    global _rewriter_releases
+    reply = control.save(levels=len(ancestors))
+    _rewriter_releases = 'release' in reply
+    release(reply.get('release', 0))
+
+
+def release(n):
+    """Kill the n oldest parked processes"""
+    del ancestors[:retention.kill(ancestors[:n])]
+
+
+def _ignore_job_signals():
+    global _parked_size
+    for sig in JOB_SIGNALS:
+        if signal.getsignal(sig) is None:
+            continue  # set outside of Python, so it couldn't be put back
+        _handlers[sig] = signal.signal(sig, signal.SIG_IGN)
+    _parked_size = _window_size()
+
+
+def _restore_job_signals():
+    resized = signal.SIGWINCH in _handlers and _window_size() != _parked_size
+    for sig, handler in _handlers.items():
+        signal.signal(sig, handler)
+    _handlers.clear()
+    if resized:
+        os.kill(os.getpid(), signal.SIGWINCH)
+
+
+def _window_size():
+    """(rows, columns) of the terminal on standard input, None if there isn't one"""
+    try:
+        return struct.unpack('hh', fcntl.ioctl(0, termios.TIOCGWINSZ, b'\0' * 4))
+    except (IOError, OSError):
+        return None
+
+
+def tell_parent(message):
+    """Tell the parent how this process is ending, b'undo' or b'exit'"""
+    if _to_parent is not None:
+        os.write(_to_parent, message + b'\n')
+
+
+def wait_for_child(reap=True):
+    """How the child this process is parked for ended, once it has
+
+    A child that dies without saying counts as undone. The child is
+    reaped, so undoing doesn't leave a zombie behind each time, unless reap
+    is False, for callers that want its exit status. A child that says
+    b'park' was undone but stays parked, to be redone (see park_for_redo)."""
+    global _child, _from_child, _to_child, _redo
+    message = None
+    try:
+        message = os.read(_from_child, 64).split(b'\n')[0] or b'undo'
+    finally:
+        if message != b'park':
+            _close_child()
+    if message == b'park':
+        _redo = (_child, _line, _from_child, _to_child)
+        _child = _from_child = _to_child = None
+        return message
+    if reap:
+        try:
+            os.waitpid(_child, 0)
+        except OSError:
+            pass  # already reaped
+    return message
+
+
+def _close_child():
+    global _from_child, _to_child
+    for fd in (_from_child, _to_child):
+        if fd is not None:
+            os.close(fd)
+    _from_child = _to_child = None
+
+
+def resume():
+    """Turn the collector back on in a parent whose child was undone"""
+    global _child
+    gc.enable()
+    _restore_job_signals()
+    _close_child()
+    state_dir = os.environ.get(STATE_DIR_VAR)
+    if state_dir and _child is not None:
+        remove_record(state_dir, _child)
+    _child = None
+
+
+def park_for_redo():
+    """Park this process, which is being undone, until it's redone
+
+    Returns True once the parent has resumed it with redo(), or False
+    straight away if redo is off. A process let go while parked exits here,
+    without running interpreter shutdown, like a parked parent that's
+    released."""
+    if _from_parent is None or not can_undo():
+        return False
+    _limit_redo(retention.policy.max_redo - 1)
+    _ignore_job_signals()
+    gc.disable()
+    tell_parent(b'park')
+    while True:
+        message = _next_message()
+        if message == b'redo':
+            break
+        if message.startswith(b'keep '):
+            _limit_redo(int(message.split()[1]))
+            continue
+        # let go, or the parent is gone
+        state_dir = os.environ.get(STATE_DIR_VAR)
+        if state_dir:
+            remove_record(state_dir, os.getpid())
+        os._exit(0)
+    gc.enable()
+    _restore_job_signals()
+    return True
+
+
+def _next_message():
+    """The next line from the parent, b'' if it has closed the pipe"""
+    global _messages
+    while b'\n' not in _messages:
+        data = os.read(_from_parent, 64)
+        if not data:
+            return b''
+        _messages += data
+    message, _, _messages = _messages.partition(b'\n')
+    return message
+
+
+def _limit_redo(n):
+    """Keep at most n processes parked for redo below this one"""
+    if _redo is None:
+        return
+    if n <= 0:
+        release_redo()
+    else:
+        os.write(_redo[3], b'keep %d\n' % (n - 1, ))
+
+
+def can_redo(line):
+    """Whether entering line redoes the child parked for redo
+
+    That's "redo", or the line the child ran."""
+    return _redo is not None and line in ('redo', _redo[1])
+
+
+def redo():
+    """Resume the child parked for redo, parking this process instead
+
+    Returns the child's pid, to wait for as if it had just been forked."""
+    global _child, _line, _from_child, _to_child, _redo
+    _child, _line, _from_child, _to_child = _redo
+    _redo = None
+    _ignore_job_signals()
+    gc.disable()
+    os.write(_to_child, b'redo\n')
+    return _child
+
+
+def release_redo():
+    """Let go of the child parked for redo, and so of everything parked below it"""
+    global _redo
+    if _redo is None:
+        return
+    pid, _, from_child, to_child = _redo
+    _redo = None
+    os.close(from_child)
+    os.close(to_child)
+    try:
+        os.waitpid(pid, 0)
+    except OSError:
+        pass
+
+
+def can_undo():
+    """Whether the process this one would undo to is still there"""
+    return parent is None or os.getppid() == parent
+
+
+def end_chain():
+    """End the session from the live process, which is exiting
+
+    The parked processes after the root are killed and the root is told the
+    chain is exiting, and exits as usual. This works after can_undo() has
+    gone false too, since the root is never released."""
+    if root == os.getpid():
+        return
+    for pid in ancestors:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    del ancestors[:]
+    if _to_root is not None:
+        os.write(_to_root, b'exit\n')
+
+
+def record_path(state_dir, pid):
+    return os.path.join(state_dir, '%d.json' % (pid, ))
+
+
+def write_record(state_dir, pid, parent, depth, line, fork_seconds):
+    record = {'pid': pid, 'parent': parent, 'depth': depth, 'line': line,
+              'created': time.time(), 'fork_seconds': fork_seconds}
+    path = record_path(state_dir, pid)
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(record, f)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        pass  # accounting isn't worth breaking the interpreter over
+
+
+def remove_record(state_dir, pid):
+    try:
+        os.remove(record_path(state_dir, pid))
+    except OSError:
+        pass
@@ -1,18 +1,70 @@
 """Alternate interpreters to use that follow the rlundo protocol.
 
 useful if an interpreter does not dynamically load readline.c
-in an easily interceptable way"""
+in an easily interceptable way
+
+Shims are registered by module name and only run, never imported here, so
+choosing one doesn't pay for importing its interpreter (IPython takes half
+a second). Other packages can add shims with an entry point in the
+"rlundo.interpreters" group named after the interpreter's executable:
+
+    [rlundo.interpreters]
+    irb = undoable_irb.shim
+
+which is run as `python -m undoable_irb.shim` for `python rlundo irb`."""
 
 import os
+import re
+import subprocess
+import sys
+
+ENTRY_POINT_GROUP = 'rlundo.interpreters'
+
+# where rlundo can be imported from, for shims run in other interpreters
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 
 
 def is_python(path):
-    return os.path.basename(path) == "python"
+    """python3, python3.11 and so on, wherever they are, or a python 3 python
+
+    The shim runs in the interpreter it replaces and needs Python 3, so
+    python2 gets the modified readline like any other program."""
+    name = os.path.basename(path)
+    if re.match(r'python3[0-9.]*$', name):
+        return True
+    return name == 'python' and _python_major_version(path) == 3
+
+
+def _python_major_version(path):
+    """Major version of the Python at path, or None if it doesn't run"""
+    found = _which(path)
+    if found is None:
+        return None
+    if os.path.realpath(found) == os.path.realpath(sys.executable):
+        return sys.version_info[0]
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(
+                [found, '-c', 'import sys; print(sys.version_info[0])'],
+                stderr=devnull)
+        return int(output)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+
+def _which(path):
+    if os.sep in path:
+        return path
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        candidate = os.path.join(directory, path)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
 
 
 def is_ipython(path):
     """Check if the terminal to be opened is ipython."""
-    return os.path.basename(path) == "ipython"
+    return re.match(r'ipython[0-9.]*$', os.path.basename(path)) is not None
 
 def is_adventure(path):
     return path == 'adventure'
@@ -21,12 +73,75 @@ def is_adventure_no_rewrite(path):
     return path == 'adventure_no_rewrite'
 
 
-from . import undoablepython
-from . import undoableipython
+class Shim(object):
+    """An interpreter with undo, run as `python -m module`
+
+    With same_interpreter the shim runs in the interpreter it replaces,
+    otherwise in the Python running rlundo."""
+
+    def __init__(self, module, matches, same_interpreter=False):
+        self.module = module
+        self.matches = matches
+        self.same_interpreter = same_interpreter
+
+    def command(self, interpreter):
+        executable = interpreter if self.same_interpreter else sys.executable
+        return [executable, '-m', self.module]
+
+    def __repr__(self):
+        return 'Shim(%r)' % (self.module, )
+
 
 interpreters = [
-    (['python3', '-m', 'rlundo.interps.undoableadventurenorewrite'], is_adventure_no_rewrite),
-    (['python3', '-m', 'rlundo.interps.undoableadventure'], is_adventure),
-    (['python', os.path.abspath(undoablepython.__file__)], is_python),
-    (['python', os.path.abspath(undoableipython.__file__)], is_ipython),
+    Shim('rlundo.interps.undoableadventurenorewrite', is_adventure_no_rewrite),
+    Shim('rlundo.interps.undoableadventure', is_adventure),
+    Shim('rlundo.interps.undoablepython', is_python, same_interpreter=True),
+    Shim('rlundo.interps.undoableipython', is_ipython),
 ]
+
+
+def register(shim):
+    """Use shim ahead of the shims already registered"""
+    interpreters.insert(0, shim)
+
+
+def _entry_point_shims():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+    try:
+        found = entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:  # before Python 3.10
+        found = entry_points().get(ENTRY_POINT_GROUP, [])
+    return [Shim(ep.value.partition(':')[0],
+                 lambda path, name=ep.name: os.path.basename(path) == name)
+            for ep in found]
+
+
+def find_shim(interpreter):
+    """The shim for interpreter, or None if it should use the modified readline
+
+    Entry points are only looked at if no registered shim matches."""
+    for shim in interpreters:
+        if shim.matches(interpreter):
+            return shim
+    for shim in _entry_point_shims():
+        if shim.matches(interpreter):
+            return shim
+    return None
+
+
+def undoable_command(interpreter, args, env):
+    """Command that runs interpreter with undo, updating env if it needs to
+
+    Interpreters with a shim run the shim; anything else is run with the
+    modified readline."""
+    shim = find_shim(interpreter)
+    if shim is not None:
+        path = env.get('PYTHONPATH')
+        env['PYTHONPATH'] = ROOT + os.pathsep + path if path else ROOT
+        return shim.command(interpreter) + args
+    from ..rlundoable import modify_env_with_modified_rl
+    modify_env_with_modified_rl(env)
+    return [interpreter] + args
@@ -14,13 +14,16 @@ Use it from the command line: `python undoableipython.py`
 """
 
 from __future__ import unicode_literals
+import atexit
 import os
 import sys
-import time
 from IPython.utils import py3compat
 from IPython.terminal.interactiveshell import TerminalInteractiveShell
 from IPython import start_ipython
 
+from .. import control
+from .. import forking
+
 
 def raw_input_original(prompt):
     """Replace raw_input_original property in TerminalInteractiveShell.
@@ -35,26 +38,8 @@ def raw_input_original(prompt):
         The input from the user processed.
     """
 
-    from functools import partial
-    import socket
-
-    if sys.version_info.major == 2:
-        ConnectionRefusedError = socket.error
-
-    def connect_and_wait_for_close(addr):
-        s = socket.socket(family=socket.AF_UNIX)
-        try:
-            s.connect(addr)
-        except ConnectionRefusedError:
-            pass
-        else:
-            assert b'' == s.recv(1024)
-
-    save = partial(connect_and_wait_for_close, addr=os.environ['RLUNDO_SAVE'])
-    restore = partial(connect_and_wait_for_close, addr=os.environ['RLUNDO_RESTORE'])
-
     while True:
-        save()
+        forking.save()
         try:
             # **********************************************
             # --------BEGIN of Original IPython code--------
@@ -70,11 +55,16 @@ def raw_input_original(prompt):
             line = "undo"
 
         if line == "undo":
-            time.sleep(.001) # race condition, see issue #29
-            restore()
-            os._exit(42)
-
-        pid = os.fork()
+            control.restore()
+            if not forking.park_for_redo():
+                os._exit(42)
+            continue  # redone
+
+        if forking.can_redo(line):
+            control.redo()
+            pid = forking.redo()
+        else:
+            pid = forking.fork(line)
         is_child = pid == 0
 
         # if the process is not the parent, just carry on
@@ -82,15 +72,13 @@ def raw_input_original(prompt):
             break
 
         else:
-            while True:
-                try:
-                    status = os.waitpid(pid, 0)
-                    break
-                except KeyboardInterrupt:
-                    pass
-            exit_code = status[1] // 256
-            if not exit_code == 42:
-                os._exit(exit_code)
+            # Ctrl-C is ignored while parked, so this isn't interrupted
+            if forking.wait_for_child(reap=False) != b'park':
+                status = os.waitpid(pid, 0)
+                exit_code = status[1] // 256
+                if not exit_code == 42:
+                    os._exit(exit_code)
+            forking.resume()
 
     return line
 
@@ -108,6 +96,9 @@ def start_undoable_ipython(args=None):
         args: Arguments passed to the undoable instance to be started.
     """
     patch_ipython()
+    # IPython exits however it likes, but never through os._exit, which is
+    # how undone and parked processes go
+    atexit.register(forking.end_chain)
 
     if args:
         sys.argv = args
@@ -3,9 +3,11 @@
 import code
 import logging
 import os
-import socket
 import sys
-from functools import partial
+
+from .. import control
+from .. import forking
+from ..retention import HISTORY_DROPPED_MSG
 
 # read about copy-on-write for Python processes - I feel like I've heard
 # this doesn't work well
@@ -13,25 +15,15 @@ from functools import partial
 py2 = False
 if sys.version_info.major == 2:
     input = raw_input
-    ConnectionRefusedError = socket.error
     py2 = True
 
 logger = logging.getLogger(__name__)
 
 DEBUG = False
 
-def connect_and_wait_for_close(addr):
-    s = socket.socket(family=socket.AF_UNIX)
-    try:
-        s.connect(addr)
-    except ConnectionRefusedError:
-        pass
-    else:
-        assert b'' == s.recv(1024)
-
-
 save = None
 restore = None
+redo = None
 
 
 def log(msg):
@@ -52,29 +44,38 @@ def readline(prompt):
         try:
             s = input(prompt)
         except EOFError:
+            control.exit()
             readline.on_exit()
         except KeyboardInterrupt:
             s = 'undo'
         if s == 'undo':
+            if not forking.can_undo():
+                print(HISTORY_DROPPED_MSG)
+                continue
             restore()
             readline.on_undo()
-        read_fd, write_fd = os.pipe()
-        pid = os.fork()
+            continue  # redone
+        if forking.can_redo(s):
+            redo()
+            pid = forking.redo()
+        else:
+            pid = forking.fork(s)
         is_child = pid == 0
-        log('created read/write fd pair: %r %r' % (read_fd, write_fd))
 
         if is_child:
 
             def on_undo():
                 log('undoing command')
-                log('writing line to say done on fd %r' % (write_fd,))
-                os.write(write_fd, b'done\n')
-                log('wrote, exiting')
+                if forking.park_for_redo():
+                    log('redone')
+                    return
+                forking.tell_parent(b'undo')
+                log('told parent, exiting')
                 sys.exit()
 
             def on_exit():
                 log('exiting!')
-                os.write(write_fd, b'exit\n')
+                forking.end_chain()
                 sys.exit()
 
             readline.on_undo = on_undo
@@ -83,12 +84,13 @@ def readline(prompt):
             log('child returning to loop')
             return s
         else:
-            log('Waiting for child %r by reading on fd %r' % (pid, read_fd))
-            from_child = os.read(read_fd, 1)
-            if from_child == b'e':
+            log('Waiting for child %r' % (pid, ))
+            from_child = forking.wait_for_child()
+            if from_child == b'exit':
                 readline.on_exit()
             log('parent %r received response from child %r: %r' %
                 (os.getpid(), pid, from_child))
+            forking.resume()
             continue
 
 
@@ -118,12 +120,15 @@ def start_undoable_python(args=None):
     console = ForkUndoConsole()
     global save
     global restore
+    global redo
     try:
-        save = partial(connect_and_wait_for_close, addr=os.environ['RLUNDO_SAVE'])
-        restore = partial(connect_and_wait_for_close, addr=os.environ['RLUNDO_RESTORE'])
+        control.client()
     except KeyError:
         print(sorted(os.environ.keys()))
         raise
+    save = forking.save
+    restore = control.restore
+    redo = control.redo
 
 
     if args:
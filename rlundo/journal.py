@@ -0,0 +1,287 @@
+"""
+Record of everything the child process has written to the terminal,
+divided into one segment per save.
+
+Appending is O(1): chunks read from the pty are kept as they are and only
+joined when a segment is actually needed (on restore). Memory use is bounded
+by a per-snapshot cap and a per-session cap; when a cap is exceeded the
+oldest bytes are discarded and the affected segment is marked incomplete so
+restore knows it can't trust the bytes kept for it. The number of segments
+can be capped too, in which case the oldest are merged into one that can't
+be restored to.
+
+Each segment also keeps an index of the visible width of each logical line
+it contains, updated as bytes arrive, so the number of rows a segment takes
+up at any terminal width can be computed without decoding it again. Moving
+the cursor back up, as a program making a blank row below its prompt does,
+takes lines off the index again.
+"""
+
+import codecs
+import collections
+import re
+
+DEFAULT_MAX_SNAPSHOT_BYTES = 4 * 1024 * 1024
+DEFAULT_MAX_SESSION_BYTES = 32 * 1024 * 1024
+
+# More rows than any terminal has; line widths beyond this many lines back
+# are forgotten since output that long can't be rewound anyway.
+MAX_INDEXED_LINES = 1000
+
+COLOUR_CODE = re.compile(u"\x1b\\[0(;\\d\\d)?m")
+# backspace, reverse index and the CSI cursor moves and erases
+CURSOR_MOTION = re.compile(u"\b|\x1bM|\x1b\\[(\\d*)([ACDFJK])")
+_PARTIAL_ESCAPE = re.compile(u"\x1b(\\[[\\d;]*)?\\Z")
+
+
+class LineIndex(object):
+    """Visible widths of the logical lines of some output
+
+    Widths don't include colour escape codes, and follow backspaces and
+    cursor moves along a line. Moving up a row goes back to the end of the
+    line before, or counts a row above the first line. Only the most recent
+    MAX_INDEXED_LINES completed lines are kept; older ones are just counted.
+    """
+
+    def __init__(self, encoding='utf8'):
+        self.decoder = codecs.getincrementaldecoder(encoding)('replace')
+        self.widths = collections.deque(maxlen=MAX_INDEXED_LINES)
+        self.forgotten = 0  # completed lines no longer in widths
+        self.current = 0  # width of the unfinished last line
+        self.column = 0  # where on it the cursor is
+        self.above = 0  # rows moved up past the first line
+        self.pending = u''  # possible beginning of an escape sequence
+
+    def feed(self, data):
+        text = self.pending + self.decoder.decode(data)
+        m = _PARTIAL_ESCAPE.search(text, max(0, len(text) - 8))
+        if m:
+            self.pending = text[m.start():]
+            text = text[:m.start()]
+        else:
+            self.pending = u''
+        text = COLOUR_CODE.sub(u'', text)
+        if u'\b' not in text and u'\x1b' not in text:
+            self._write(text)
+            return
+        start = 0
+        for m in CURSOR_MOTION.finditer(text):
+            self._write(text[start:m.start()])
+            self._move(m)
+            start = m.end()
+        self._write(text[start:])
+
+    def _write(self, text):
+        lines = text.split(u'\n')
+        self.column += len(lines[0])
+        if len(lines) == 1:
+            self.current = max(self.current, self.column)
+            return
+        if len(self.widths) + len(lines) - 1 > MAX_INDEXED_LINES:
+            self.forgotten += len(self.widths) + len(lines) - 1 - MAX_INDEXED_LINES
+        self.widths.append(max(self.current, self.column))
+        self.widths.extend(map(len, lines[1:-1]))
+        self.current = self.column = len(lines[-1])
+
+    def _move(self, m):
+        if m.group() == u'\b':
+            self.column = max(0, self.column - 1)
+            return
+        if m.group() == u'\x1bM':
+            n, final = 1, u'A'
+        else:
+            n, final = max(1, int(m.group(1) or 1)), m.group(2)
+        if final in u'AF':
+            self._up(n)
+            if final == u'F':
+                self.column = 0
+        elif final == u'C':
+            self.column += n
+        elif final == u'D':
+            self.column = max(0, self.column - n)
+        # J and K erase without moving the cursor
+
+    def _up(self, n):
+        while n and self.widths:
+            self.current = max(self.widths.pop(), self.column)
+            n -= 1
+        forgotten = min(n, self.forgotten)
+        self.forgotten -= forgotten
+        if forgotten:
+            self.current = self.column
+        self.above += n - forgotten
+
+    @property
+    def lines(self):
+        """Number of newlines fed, less those moved back up past"""
+        return self.forgotten + len(self.widths)
+
+
+def _rows(visible_width, width):
+    return max(0, (visible_width - 1) // width) + 1
+
+
+def count_rows(indexes, width):
+    """Number of lines the cursor moves down printing consecutive indexed outputs
+
+    A lower bound if any of the indexes has forgotten lines."""
+    rows = 0
+    current = 0
+    for index in indexes:
+        if index.above:
+            rows -= index.above
+            current = 0
+        if index.lines:
+            rows += index.forgotten
+            widths = iter(index.widths)
+            if not index.forgotten:
+                rows += _rows(current + next(widths), width)
+            rows += sum(_rows(w, width) for w in widths)
+            current = 0
+        current += index.current + len(index.pending)
+    return max(0, rows + _rows(current, width) - 1)
+
+
+class Segment(object):
+    """Output written between two saves, stored as a list of chunks"""
+
+    def __init__(self, offset, encoding='utf8'):
+        self.offset = offset  # journal offset of the first byte of the segment
+        self.chunks = collections.deque()
+        self.size = 0  # bytes currently retained
+        self.dropped = 0  # bytes discarded from the front of the segment
+        self.index = LineIndex(encoding)
+        self.snapshot = None  # screen.Snapshot taken when the segment began
+
+    def append(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        self.index.feed(data)
+
+    def merge(self, later):
+        """Append the output of the segment that followed this one
+
+        The snapshot is forgotten, since the merged segment doesn't begin at
+        a save that can be restored to any more."""
+        for chunk in later.chunks:
+            self.append(chunk)
+        self.dropped += later.dropped
+        self.snapshot = None
+
+    def drop_front(self, n):
+        """Discard the first n retained bytes of the segment"""
+        n = min(n, self.size)
+        self.size -= n
+        self.dropped += n
+        while n:
+            chunk = self.chunks[0]
+            if len(chunk) <= n:
+                self.chunks.popleft()
+                n -= len(chunk)
+            else:
+                self.chunks[0] = chunk[n:]
+                n = 0
+
+    @property
+    def complete(self):
+        return self.dropped == 0
+
+    def bytes(self):
+        if len(self.chunks) > 1:
+            joined = b''.join(self.chunks)
+            self.chunks.clear()
+            self.chunks.append(joined)
+        return self.chunks[0] if self.chunks else b''
+
+    def __repr__(self):
+        return '<Segment at %d: %d bytes%s>' % (
+            self.offset, self.size,
+            '' if self.complete else ' (%d dropped)' % (self.dropped, ))
+
+
+class OutputJournal(object):
+    """Stack of output segments, one started by each save
+
+    Iterating over a journal yields the bytes of each segment, oldest first.
+    """
+
+    def __init__(self, max_snapshot_bytes=DEFAULT_MAX_SNAPSHOT_BYTES,
+                 max_session_bytes=DEFAULT_MAX_SESSION_BYTES, encoding='utf8',
+                 max_snapshots=None):
+        self.max_snapshot_bytes = max_snapshot_bytes
+        self.max_session_bytes = max_session_bytes
+        self.max_snapshots = max_snapshots
+        self.encoding = encoding
+        self.segments = collections.deque([Segment(0, encoding)])
+        self.end = 0  # total bytes ever appended
+        self.size = 0  # bytes currently retained
+        self.evicted = 0  # number of whole segments discarded
+        self.released = 0  # number of segments merged into the one before
+
+    def append(self, data):
+        if not data:
+            return
+        if not self.segments:
+            self.segments.append(Segment(self.end, self.encoding))
+        current = self.segments[-1]
+        current.append(data)
+        self.end += len(data)
+        self.size += len(data)
+
+        if (self.max_snapshot_bytes is not None and
+                current.size > self.max_snapshot_bytes):
+            self._drop_front(current, current.size - self.max_snapshot_bytes)
+        if self.max_session_bytes is not None:
+            while self.size > self.max_session_bytes and len(self.segments) > 1:
+                self.size -= self.segments.popleft().size
+                self.evicted += 1
+            if self.size > self.max_session_bytes:
+                self._drop_front(self.segments[0],
+                                 self.size - self.max_session_bytes)
+
+    def _drop_front(self, segment, n):
+        before = segment.size
+        segment.drop_front(n)
+        self.size -= before - segment.size
+
+    def save(self):
+        """Start a new segment"""
+        self.segments.append(Segment(self.end, self.encoding))
+        if self.max_snapshots is not None and len(self.segments) > self.max_snapshots:
+            self.release(len(self.segments) - self.max_snapshots)
+
+    def release(self, n):
+        """Merge the oldest n + 1 segments, keeping the output but not the saves
+
+        The current segment is never merged."""
+        n = min(n, len(self.segments) - 2)
+        if n <= 0:
+            return
+        first = self.segments[0]
+        for _ in range(n):
+            first.merge(self.segments[1])
+            del self.segments[1]
+        self.released += n
+
+    def pop(self):
+        """Remove and return the most recent segment, or None if there are none"""
+        if not self.segments:
+            return None
+        segment = self.segments.pop()
+        self.size -= segment.size
+        return segment
+
+    def push(self, segment):
+        """Put back a segment taken off with pop, as the most recent"""
+        self.segments.append(segment)
+        self.size += segment.size
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __iter__(self):
+        return (segment.bytes() for segment in list(self.segments))
+
+    def __repr__(self):
+        return '<OutputJournal: %d segments, %d of %d bytes retained, %d evicted, %d released>' % (
+            len(self.segments), self.size, self.end, self.evicted, self.released)
@@ -1,44 +1,16 @@
+import array
 import errno
 import fcntl
 import os
 import pty
 import select
+import selectors
 import signal
-import sys
+import socket
+import stat
 import termios
-import threading
+import time
 import tty
-import logging
-logging.basicConfig(filename='debug.log', level=logging.INFO)
-from .termhelpers import Nonblocking
-
-class TerminalLock(object):
-    """Lock that can be over-released
-
-    Every master write to the pty should be followed
-    by a pty write to the terminal, but not every pty write
-    is initiated by a master write."""
-
-    def __init__(self):
-        self.rlock = threading.RLock()
-        self.lock_count = 0
-
-    def acquire(self):
-        self.rlock.acquire()
-        self.lock_count += 1
-
-    def release(self):
-        if self.lock_count > 0:
-            self.rlock.release()
-            self.lock_count -= 1
-
-    def __enter__(self):
-        return self.rlock.__enter__()
-
-    def __exit__(self, *args, **kwargs):
-        return self.rlock.__exit__(*args, **kwargs)
-
-
 
 CHILD = pty.CHILD
 STDIN_FILENO = pty.STDIN_FILENO
@@ -78,49 +50,278 @@ def fork(handle_window_size=False):
 def openpty():
     return pty.openpty()
 
-def _copy(master_fd, master_read=pty._read, stdin_read=pty._read,
-          terminal_output_lock=None):
+
+def pending_bytes(fd):
+    """Number of bytes that can be read from fd without blocking"""
+    # The kernel moves data written to a pty slave to the master's read
+    # buffer in deferred work, which polling flushes but FIONREAD doesn't.
+    select.select([fd], [], [], 0)
+    buf = array.array('i', [0])
+    fcntl.ioctl(fd, termios.FIONREAD, buf)
+    return buf[0]
+
+
+def set_nonblocking(fd):
+    """Make fd non-blocking, returning its previous flags"""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    return flags
+
+
+def write_all(fd, data):
+    """Write all of data to fd, waiting for it if it's non-blocking"""
+    while data:
+        try:
+            n = os.write(fd, data)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            select.select([], [fd], [])
+        else:
+            data = data[n:]
+
+
+class AdaptiveReader(object):
+    """Reads an fd into one reusable buffer
+
+    The read size doubles while reads fill it, up to the size of the
+    buffer, and halves again when output slows down."""
+
+    def __init__(self, minimum=1024, maximum=65536):
+        self.minimum = minimum
+        self.size = minimum
+        self.view = memoryview(bytearray(maximum))
+
+    def readinto(self, fd):
+        """Read from fd, returning a view of the data that's only valid
+        until the next read"""
+        n = os.readv(fd, [self.view[:self.size]])
+        if n == self.size:
+            self.size = min(self.size * 2, len(self.view))
+        elif n < self.size // 4:
+            self.size = max(self.size // 2, self.minimum)
+        return self.view[:n]
+
+    def __call__(self, fd):
+        """Read from fd, returning bytes, as a master_read callback
+
+        The bytes are a copy, to keep after the next read."""
+        return self.readinto(fd).tobytes()
+
+
+# splice(2) output to standard output when it's a pipe and nothing needs
+# to see the bytes
+SPLICE = hasattr(os, 'splice')
+
+
+def can_splice(fd):
+    return SPLICE and stat.S_ISFIFO(os.fstat(fd).st_mode)
+
+
+def splice_output(master_fd):
+    """Move output from the pty master to standard output inside the kernel
+
+    Returns like copy_output, with the number of bytes moved instead of
+    the bytes."""
+    try:
+        n = os.splice(master_fd, STDOUT_FILENO, 65536)
+    except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return None
+        if e.errno == errno.EIO:
+            return b''
+        raise
+    return n or b''
+
+
+def write_stdout(data):
+    write_all(STDOUT_FILENO, data)
+
+
+def copy_output(master_fd, master_read, output=write_stdout):
+    """Copy one read's worth of output from the pty master to output
+
+    Returns the bytes copied: b'' once the child has closed the pty,
+    None if there was nothing to read or master_read passed nothing on."""
+    try:
+        data = master_read(master_fd)
+    except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return None
+        if e.errno == errno.EIO:  # Linux reports a closed pty this way
+            return b''
+        raise
+    if data:
+        output(data)
+    return data
+
+
+def drain(master_fd, master_read, timeout=None, output=write_stdout):
+    """Copy output until there is none waiting on the pty master
+
+    Returns False if output was still arriving after timeout seconds."""
+    deadline = None if timeout is None else time.time() + timeout
+    while pending_bytes(master_fd):
+        if copy_output(master_fd, master_read, output) == b'':
+            break  # the child has closed the pty
+        if deadline is not None and time.time() > deadline:
+            return False
+    return True
+
+
+class ChildInput(object):
+    """Input on its way to the child, sent in the order it arrives
+
+    Whatever the pty doesn't accept right away waits in pending, as does
+    input sent before there is a pty, until the copy loop can write it."""
+
+    def __init__(self):
+        self.master_fd = None
+        self.pending = b''
+        self.on_pending = None  # called with whether anything is waiting
+
+    def send(self, data):
+        if not data:
+            return
+        if self.pending or self.master_fd is None:
+            self.pending += data
+        else:
+            self.pending = data[_write_some(self.master_fd, data):]
+        self._changed()
+
+    def flush(self):
+        if self.pending and self.master_fd is not None:
+            self.pending = self.pending[_write_some(self.master_fd, self.pending):]
+        self._changed()
+
+    def _changed(self):
+        if self.on_pending is not None:
+            self.on_pending(bool(self.pending))
+
+
+def _copy(master_fd, master_read=None, stdin_read=pty._read,
+          listeners=None, child_input=None, channels=None):
     """Parent copy loop.
     Copies
             pty master -> standard output   (master_read)
-            standard input -> pty master    (stdin_read)"""
-    logging.debug('starting _copy loop')
-    fds = [master_fd, STDIN_FILENO]
-    while True:
-        logging.debug('calling select in copy')
-        rfds, wfds, xfds = select.select(fds, [], [])
-        logging.debug('select call in copy finished! %r %r %r' % (rfds, wfds, xfds, ))
-        if master_fd in rfds:
-            logging.debug('master_fd is ready, so calling read')
-            data = master_read(master_fd)
-            logging.debug('master_fd master_read call done, got data: %r' % (data, ))
-            if not data:  # Reached EOF.
-                fds.remove(master_fd)
-            else:
-                os.write(STDOUT_FILENO, data)
-                if terminal_output_lock is not None:
-                    terminal_output_lock.release()
-
-        if STDIN_FILENO in rfds:
-            logging.debug('stdin is ready, dealing...')
-
-            with Nonblocking(STDIN_FILENO):
-                try:
-                    data = stdin_read(STDIN_FILENO)
-                except OSError as e:
-                    if e.errno != errno.EAGAIN:
-                        raise
-                else:
+            standard input -> pty master    (stdin_read)
+
+    Without a master_read, output is forwarded without being copied into
+    Python objects: spliced if standard output is a pipe, otherwise read
+    into a reused buffer. A master_read that keeps the output, like an
+    rlundo session's, needs its own copy of every read however it reads.
+
+    The loop also calls listeners[sock]() each time a connection to one of
+    the listening sockets is accepted, closing the connection afterwards,
+    and channels[sock]() each time one of the connected sockets is
+    readable, until it returns False.
+    Everything happens on this thread, so handlers can read and write the
+    terminal and the pty directly. Input for the child goes through
+    child_input, so anything a handler sends to it stays in order with
+    keystrokes; stdin_read can return None when nothing it read is for the
+    child.
+
+    The pty master and standard input have to be non-blocking."""
+    if master_read is not None:
+        forward = lambda: copy_output(master_fd, master_read)
+    elif can_splice(STDOUT_FILENO):
+        forward = lambda: splice_output(master_fd)
+    else:
+        reader = AdaptiveReader()
+        forward = lambda: copy_output(master_fd, reader.readinto)
+    listeners = listeners or {}
+    if child_input is None:
+        child_input = ChildInput()
+    child_input.master_fd = master_fd
+    sel = selectors.DefaultSelector()
+    try:
+        sel.register(STDIN_FILENO, selectors.EVENT_READ)
+    except PermissionError:
+        # epoll refuses regular files and /dev/null, which are always
+        # readable anyway
+        child_input.send(_read_until_eof(STDIN_FILENO, stdin_read))
+    sel.register(master_fd, selectors.EVENT_READ)
+    writing = [False]
+
+    def on_pending(pending):
+        if pending != writing[0]:
+            writing[0] = pending
+            sel.modify(master_fd, selectors.EVENT_READ |
+                       (selectors.EVENT_WRITE if pending else 0))
+    child_input.on_pending = on_pending
+    channels = channels or {}
+    for sock in listeners:
+        sel.register(sock, selectors.EVENT_READ)
+    for sock in channels:
+        sel.register(sock, selectors.EVENT_READ)
+    try:
+        child_input.flush()
+        while True:
+            for key, events in sel.select():
+                if key.fileobj == master_fd:
+                    if events & selectors.EVENT_READ:
+                        data = forward()
+                        if data == b'':  # Reached EOF.
+                            return
+                    if events & selectors.EVENT_WRITE:
+                        child_input.flush()
+
+                elif key.fileobj == STDIN_FILENO:
+                    try:
+                        data = stdin_read(STDIN_FILENO)
+                    except OSError as e:
+                        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            raise
+                        continue
+                    if data is None:
+                        continue
                     if not data:
-                        fds.remove(STDIN_FILENO)
+                        sel.unregister(STDIN_FILENO)
                     else:
-                        if terminal_output_lock is not None:
-                            terminal_output_lock.acquire()
-                        pty._writen(master_fd, data)
-            logging.debug('done dealing with stdin')
+                        child_input.send(data)
+
+                elif key.fileobj in channels:
+                    if not channels[key.fileobj]():
+                        sel.unregister(key.fileobj)
+
+                else:
+                    try:
+                        conn, _ = key.fileobj.accept()
+                    except (OSError, socket.error) as e:
+                        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            raise
+                        continue
+                    try:
+                        listeners[key.fileobj]()
+                    finally:
+                        conn.close()
+    finally:
+        child_input.on_pending = None
+        sel.close()
+
+
+def _read_until_eof(fd, read):
+    chunks = []
+    while True:
+        data = read(fd)
+        if data is None:
+            continue
+        if not data:
+            return b''.join(chunks)
+        chunks.append(data)
+
+
+def _write_some(fd, data):
+    try:
+        return os.write(fd, data)
+    except OSError as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+        return 0
+
 
-def spawn(argv, master_read=pty._read, stdin_read=pty._read, handle_window_size=False,
-          terminal_output_lock=None):
+def spawn(argv, master_read=None, stdin_read=pty._read, handle_window_size=False,
+          listeners=None, on_spawn=None, child_input=None, channels=None):
     # copied from pty.py, with modifications
     # note that it references a few private functions - would be nice to not
     # do that, but you know
@@ -129,6 +330,8 @@ def spawn(argv, master_read=pty._read, stdin_read=pty._read, handle_window_size=
     pid, master_fd, slave_name = fork(handle_window_size)
     if pid == CHILD:
         os.execlp(argv[0], *argv)
+    if on_spawn is not None:
+        on_spawn(pid, master_fd)
     try:
         mode = tty.tcgetattr(STDIN_FILENO)
         tty.setraw(STDIN_FILENO)
@@ -142,21 +345,19 @@ def spawn(argv, master_read=pty._read, stdin_read=pty._read, handle_window_size=
             lambda signum, frame: _winch(slave_name, pid)
         )
 
-    while True:
-        try:
-            _copy(master_fd, master_read, stdin_read, terminal_output_lock)
-        except OSError as e:
-            if e.errno == errno.EINTR:
-                continue
-            if restore:
-                tty.tcsetattr(STDIN_FILENO, tty.TCSAFLUSH, mode)
-        except select.error as e:
-            if not sys.version_info.major == 2:  # in Python 2 EINTR is a select.error
-                raise
-            if e[0] == errno.EINTR:
-                continue
-            raise
-        break
+    # stdin and stdout usually share one open file description, so stdout
+    # becomes non-blocking too; everything written to it goes through
+    # write_all.
+    stdin_flags = set_nonblocking(STDIN_FILENO)
+    set_nonblocking(master_fd)
+    for sock in listeners or ():
+        sock.setblocking(False)
+    try:
+        _copy(master_fd, master_read, stdin_read, listeners, child_input, channels)
+    finally:
+        fcntl.fcntl(STDIN_FILENO, fcntl.F_SETFL, stdin_flags)
+        if restore:
+            tty.tcsetattr(STDIN_FILENO, tty.TCSAFLUSH, mode)
 
     os.close(master_fd)
     return os.waitpid(pid, 0)[1]
@@ -0,0 +1,102 @@
+"""
+Framing for messages over rlundo's UNIX sockets.
+
+A frame is a one byte kind, the payload length as a four byte big-endian
+unsigned int, then the payload. Requests, replies and events are JSON
+objects encoded as UTF-8; input and output are raw terminal bytes.
+"""
+
+import json
+import struct
+
+HEADER = struct.Struct('!BI')
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+REQUEST = 1  # client to server, an object with an "op"
+REPLY = 2  # server to client, the answer to the last request
+INPUT = 3  # client to server, keystrokes for the attached session
+OUTPUT = 4  # server to client, output of the attached session
+EVENT = 5  # server to client, something that happened to a session
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def frame(kind, payload):
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError('payload of %d bytes is too large' % (len(payload), ))
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+def encode(obj):
+    return json.dumps(obj).encode('utf8')
+
+
+def message(kind, obj):
+    """Frame containing obj as JSON"""
+    return frame(kind, encode(obj))
+
+
+def decode(payload):
+    try:
+        obj = json.loads(payload.decode('utf8'))
+    except ValueError:
+        raise ProtocolError('payload is not JSON: %r' % (payload[:100], ))
+    if not isinstance(obj, dict):
+        raise ProtocolError('payload is not an object: %r' % (obj, ))
+    return obj
+
+
+def check_length(length):
+    if length > MAX_PAYLOAD:
+        raise ProtocolError('payload of %d bytes is too large' % (length, ))
+
+
+class FrameReader(object):
+    """Splits a byte stream into (kind, payload) frames as it arrives"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add data, returning the frames it completes"""
+        self.buffer += data
+        frames = []
+        start = 0
+        while len(self.buffer) - start >= HEADER.size:
+            kind, length = HEADER.unpack_from(self.buffer, start)
+            check_length(length)
+            end = start + HEADER.size + length
+            if end > len(self.buffer):
+                break
+            frames.append((kind, bytes(self.buffer[start + HEADER.size:end])))
+            start = end
+        del self.buffer[:start]
+        return frames
+
+
+def _recv_exactly(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def recv_frame(sock):
+    """Next (kind, payload) from a blocking socket, None at EOF
+
+    Reads exactly one frame, leaving any after it for whoever reads next."""
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    kind, length = HEADER.unpack(header)
+    check_length(length)
+    payload = _recv_exactly(sock, length)
+    if payload is None:
+        raise ProtocolError('connection closed in the middle of a frame')
+    return kind, payload
+
@@ -0,0 +1,181 @@
+"""
+rlundo ps: what the undo history of each session costs.
+
+    python rlundo ps [--json] [STATE_DIR ...]
+
+Every session gets a state directory, passed to its interpreter as
+RLUNDO_STATE_DIR, where the Python shims record each process of the fork
+chain (see rlundo.forking). For each process still alive this lists its
+undo depth, the line it was forked to run, its age, how long its fork
+took, and from /proc (so on Linux only):
+
+    rss    resident memory, counting pages shared with the rest of the chain
+    pss    its share of resident memory, each shared page split evenly
+    uss    memory only it uses, what killing it would free
+    pte    page tables, which fork copies and which grow with the heap
+
+The rlundo server answers {"op": "ps", "session": id} with the same records.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from . import forking
+
+STATE_ROOT = os.path.join(tempfile.gettempdir(), 'rlundo-state-%d' % (os.getuid(), ))
+
+SMAPS_FIELDS = {'Rss': 'rss', 'Pss': 'pss', 'Private_Clean': 'uss', 'Private_Dirty': 'uss'}
+
+
+def new_state_dir():
+    """A state directory for a new session, removed with remove_state_dir"""
+    if not os.path.isdir(STATE_ROOT):
+        os.makedirs(STATE_ROOT, 0o700)
+    return tempfile.mkdtemp(prefix='%d-' % (os.getpid(), ), dir=STATE_ROOT)
+
+
+def remove_state_dir(state_dir):
+    shutil.rmtree(state_dir, ignore_errors=True)
+
+
+def state_dirs():
+    """State directories of every session of this user"""
+    try:
+        names = sorted(os.listdir(STATE_ROOT))
+    except OSError:
+        return []
+    return [os.path.join(STATE_ROOT, name) for name in names]
+
+
+def alive(pid):
+    """Whether pid is running, not counting zombies"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    try:
+        with open('/proc/%d/stat' % (pid, )) as f:
+            # the state follows the command name, which is in parentheses
+            return f.read().rpartition(')')[2].split()[0] != 'Z'
+    except (IOError, OSError, IndexError):
+        return True
+
+
+def memory(pid):
+    """{'rss', 'pss', 'uss', 'pte'} in kilobytes, empty if /proc can't say"""
+    usage = {}
+    try:
+        with open('/proc/%d/smaps_rollup' % (pid, )) as f:
+            for line in f:
+                name, _, rest = line.partition(':')
+                if name in SMAPS_FIELDS:
+                    key = SMAPS_FIELDS[name]
+                    usage[key] = usage.get(key, 0) + int(rest.split()[0])
+        with open('/proc/%d/status' % (pid, )) as f:
+            for line in f:
+                if line.startswith('VmPTE:'):
+                    usage['pte'] = int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return usage
+
+
+def chain(state_dir):
+    """Records of the live processes of a session, shallowest first
+
+    Records of processes that have died are removed."""
+    records = []
+    try:
+        names = os.listdir(state_dir)
+    except OSError:
+        return records
+    now = time.time()
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(state_dir, name)
+        try:
+            with open(path) as f:
+                record = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        if not alive(record['pid']):
+            forking.remove_record(state_dir, record['pid'])
+            continue
+        record['age'] = now - record['created']
+        record.update(memory(record['pid']))
+        records.append(record)
+    records.sort(key=lambda r: (r['depth'], r['created']))
+    return records
+
+
+def _kilobytes(n):
+    if n is None:
+        return '-'
+    if n >= 1024 * 1024:
+        return '%.1fG' % (n / 1024.0 / 1024)
+    if n >= 1024:
+        return '%.1fM' % (n / 1024.0)
+    return '%dK' % (n, )
+
+
+def _duration(seconds):
+    if seconds >= 3600:
+        return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%.1fs' % (seconds, )
+
+
+def format_chain(records):
+    """Lines of a table of records, with a line of totals"""
+    lines = ['%5s %7s %7s %7s %7s %7s %7s %7s  %s' % (
+        'depth', 'pid', 'age', 'fork', 'rss', 'pss', 'uss', 'pte', 'line')]
+    for r in records:
+        fork = r['fork_seconds']
+        lines.append('%5d %7d %7s %7s %7s %7s %7s %7s  %s' % (
+            r['depth'], r['pid'], _duration(r['age']),
+            '-' if fork is None else '%.1fms' % (fork * 1000, ),
+            _kilobytes(r.get('rss')), _kilobytes(r.get('pss')),
+            _kilobytes(r.get('uss')), _kilobytes(r.get('pte')),
+            '' if r['line'] is None else r['line'][:40]))
+    totals = [sum(r.get(key, 0) for r in records) for key in ('pss', 'uss', 'pte')]
+    lines.append('%d processes, %s pss, %s uss, %s page tables' % (
+        (len(records), ) + tuple(_kilobytes(n) for n in totals)))
+    return lines
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='rlundo ps',
+                                     description='memory used by undo history')
+    parser.add_argument('--json', action='store_true', help='print records as JSON')
+    parser.add_argument('state_dirs', nargs='*', metavar='STATE_DIR',
+                        help='sessions to show, all of them by default')
+    args = parser.parse_args(args)
+
+    sessions = [(d, chain(d)) for d in args.state_dirs or state_dirs()]
+    if args.json:
+        json.dump(dict(sessions), sys.stdout, indent=2)
+        print()
+        return
+    for state_dir, records in sessions:
+        if not records:
+            owner = os.path.basename(state_dir).partition('-')[0]
+            if owner.isdigit() and not alive(int(owner)):
+                remove_state_dir(state_dir)  # left behind by a crash
+            continue
+        print(state_dir)
+        for line in format_chain(records):
+            print('  ' + line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+How much undo history to keep.
+
+Every line run by the Python shims leaves a parked process behind to undo
+to, and every save starts a segment of the output journal. Limits are set
+in the environment, so the shims and rlundo agree on them:
+
+    RLUNDO_MAX_UNDO=100              # undos to keep
+    RLUNDO_MAX_UNDO_MEMORY=2G        # private memory of the parked processes
+    RLUNDO_MIN_AVAILABLE=5%          # of MemAvailable, or a size like 500M
+    RLUNDO_MAX_MEMORY_PRESSURE=20    # "some avg10" of /proc/pressure/memory
+    RLUNDO_MAX_REDO=5                # undone lines to keep for redo, none by default
+
+When a limit is hit the oldest history is released: parked processes are
+killed, starting with the one just above the first process of the chain
+(which leads the pty's session, so it stays), and journal segments are
+merged. Under memory pressure one more process goes each time pressure is
+checked, at most every PRESSURE_CHECK_SECONDS, until there's RECOVERED
+times as much room as the limit asks for. Undoing past what was released
+prints HISTORY_DROPPED_MSG instead.
+
+Pressure is judged in one place. A shim on the control channel says how
+many processes it has parked when it asks for a save, and the rewriter
+answers with how many of them to release, merging the journal segments
+of just those (see termrewrite.Session.save_request). A shim that can't
+get a reply, writing markers or connecting to RLUNDO_SAVE, judges it
+itself, and then the rewriter leaves the journal alone.
+
+Redo history is only ever cut short from its far end, the line undone
+first, and all of it goes when a new line is run (see rlundo.forking).
+"""
+
+import os
+import signal
+import time
+
+HISTORY_DROPPED_MSG = ('rlundo: undo history before this point was dropped '
+                       'to save memory (see RLUNDO_MAX_UNDO)')
+
+DEFAULT_MIN_AVAILABLE = '5%'
+
+# /proc is read at most this often to decide whether to release history
+PRESSURE_CHECK_SECONDS = 1.0
+# once under pressure, how far past the limits memory has to get to be over it
+RECOVERED = 1.25
+
+_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(text):
+    """Bytes in a size like 512M or 2G"""
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in _SUFFIXES:
+        return int(float(text[:-1]) * _SUFFIXES[text[-1]])
+    return int(text)
+
+
+def meminfo():
+    """{field: bytes} from /proc/meminfo, empty if there isn't one"""
+    info = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, _, rest = line.partition(':')
+                info[name] = int(rest.split()[0]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return info
+
+
+def memory_pressure():
+    """Percent of the last 10s some task waited for memory, None if unknown"""
+    try:
+        with open('/proc/pressure/memory') as f:
+            for line in f:
+                if line.startswith('some '):
+                    fields = dict(item.split('=') for item in line.split()[1:])
+                    return float(fields['avg10'])
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+class Policy(object):
+    """Limits on undo history, None meaning no limit
+
+    min_available is in bytes, or a fraction of total memory if 1 or below.
+    max_redo is how many undone lines can be redone, None meaning none.
+
+    The private memory of each parked process is only looked up once,
+    since a parked process doesn't run; only the one most recently parked,
+    whose child is still writing to pages they share, is looked up again."""
+
+    def __init__(self, max_depth=None, max_memory=None, min_available=None,
+                 max_pressure=None, max_redo=None):
+        self.max_depth = max_depth
+        self.max_memory = max_memory
+        self.min_available = min_available
+        self.max_pressure = max_pressure
+        self.max_redo = max_redo
+        self.pressure = False  # whether memory was short when last checked
+        self.checked = None  # time.time() of that check
+        self.uss = {}  # private bytes of parked processes, by pid
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        def get(name, parse):
+            value = environ.get(name)
+            return parse(value) if value else None
+
+        def available(text):
+            if text.strip().endswith('%'):
+                return float(text.strip()[:-1]) / 100
+            return parse_size(text)
+        return cls(max_depth=get('RLUNDO_MAX_UNDO', int),
+                   max_memory=get('RLUNDO_MAX_UNDO_MEMORY', parse_size),
+                   min_available=available(environ.get('RLUNDO_MIN_AVAILABLE',
+                                                       DEFAULT_MIN_AVAILABLE)),
+                   max_pressure=get('RLUNDO_MAX_MEMORY_PRESSURE', float),
+                   max_redo=get('RLUNDO_MAX_REDO', int))
+
+    def under_pressure(self):
+        """Whether to release one more piece of history for memory's sake
+
+        True at most once every PRESSURE_CHECK_SECONDS, so history goes a
+        little at a time while memory is short, however fast it's asked."""
+        now = time.time()
+        if self.checked is not None and now - self.checked < PRESSURE_CHECK_SECONDS:
+            return False
+        self.checked = now
+        self.pressure = self.memory_short(RECOVERED if self.pressure else 1)
+        return self.pressure
+
+    def memory_short(self, margin=1):
+        """Whether memory is short of the limits times margin"""
+        if self.min_available is not None:
+            info = meminfo()
+            if 'MemAvailable' in info:
+                minimum = self.min_available
+                if minimum <= 1:
+                    minimum *= info['MemTotal']
+                if info['MemAvailable'] < minimum * margin:
+                    return True
+        if self.max_pressure is not None:
+            pressure = memory_pressure()
+            if pressure is not None and pressure > self.max_pressure / margin:
+                return True
+        return False
+
+    def private_memory(self, pids):
+        """Private bytes of each of pids, parked processes oldest first"""
+        from .ps import memory
+        usage = []
+        for i, pid in enumerate(pids):
+            if pid not in self.uss or i == len(pids) - 1:
+                self.uss[pid] = memory(pid).get('uss', 0) * 1024
+            usage.append(self.uss[pid])
+        for pid in set(self.uss) - set(pids):
+            del self.uss[pid]
+        return usage
+
+    def excess(self, pids, pressure=True):
+        """How many of pids, parked processes oldest first, to release
+
+        Memory pressure is left out unless pressure is True."""
+        n = 0
+        if self.max_depth is not None:
+            n = max(n, len(pids) - self.max_depth)
+        if self.max_memory is not None:
+            usage = self.private_memory(pids)
+            total = sum(usage)
+            dropped = 0
+            while dropped < len(usage) and total > self.max_memory:
+                total -= usage[dropped]
+                dropped += 1
+            n = max(n, dropped)
+        if pressure and pids and self.under_pressure():
+            n = max(n, 1)
+        return n
+
+    def release(self, pids, pressure=True):
+        """Kill the oldest parked processes beyond the limits
+
+        Returns how many of pids were killed."""
+        return kill(pids[:self.excess(pids, pressure)])
+
+
+def kill(pids):
+    """Kill parked processes to release them, returning how many there were"""
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    return len(pids)
+
+
+policy = Policy.from_env()
@@ -3,16 +3,18 @@ import os
 from subprocess import Popen
 
 
-def modify_env_with_modified_rl():
+def modify_env_with_modified_rl(env=None):
     """Modifiy enviornment to enable undo features in the repl."""
+    if env is None:
+        env = os.environ
     modified_readline_path = os.path.join(os.path.dirname(os.path.realpath('__file__')),
                                           'rlundoable/modified-readline-6.3/shlib')
 
     if sys.platform == 'darwin':
-        os.environ["DYLD_LIBRARY_PATH"] = modified_readline_path
+        env["DYLD_LIBRARY_PATH"] = modified_readline_path
     else:
-        os.environ["LD_LIBRARY_PATH"] = ':'.join([modified_readline_path])
-        os.environ["LD_PRELOAD"] = '/lib/x86_64-linux-gnu/libtinfo.so.5'
+        env["LD_LIBRARY_PATH"] = ':'.join([modified_readline_path])
+        env["LD_PRELOAD"] = '/lib/x86_64-linux-gnu/libtinfo.so.5'
 
 
 def run_with_modified_rl(args):
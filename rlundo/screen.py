@@ -0,0 +1,585 @@
+"""
+In-process model of the terminal the child process is drawing on.
+
+Everything the child writes is fed through a small VT100/xterm emulator
+that tracks the character and colour of every cell, the cursor, and a
+bounded scrollback. A snapshot of the model is taken at each save; on
+restore the model computes the escape sequences needed to turn what's on
+the screen now back into the snapshot, repainting only the cells that
+differ.
+
+The model only knows about output from the child and rlundo's own restore
+sequences, so it has to be told where the cursor starts (see reset) and
+is checked against a cursor position report before each restore.
+"""
+
+import codecs
+import collections
+import re
+import unicodedata
+
+
+# longest escape sequence kept around while waiting for the rest of it
+MAX_PENDING = 4096
+
+_TOKEN = re.compile(
+    u'(?P<text>[\x20-\x7e]+)'
+    u'|(?P<newline>\r\n)'
+    u'|\x1b\\[(?P<csi_private>[<=>?]?)(?P<csi_params>[\x30-\x3f]*)'
+    u'(?P<csi_intermediate>[\x20-\x2f]*)(?P<csi_final>[\x40-\x7e])'
+    u'|\x1b\\][^\x07\x1b]*(?:\x07|\x1b\\\\)'
+    u'|\x1b(?P<esc_intermediate>[\x20-\x2f]*)(?P<esc_final>[\x30-\x7e])'
+    u'|(?P<control>[\x00-\x1f\x7f])'
+    u'|(?P<char>.)', re.DOTALL)
+_PARTIAL_ESCAPE = re.compile(
+    u'\x1b(\\[[\x30-\x3f]*[\x20-\x2f]*|\\][^\x07\x1b]*\x1b?|[\x20-\x2f]*)\\Z')
+
+Snapshot = collections.namedtuple('Snapshot', [
+    'rows',         # list of Rows
+    'cursor_row',
+    'cursor_col',
+    'attr',
+    'scrolled',     # rows scrolled off the top of the screen before this
+    'generation',   # incremented each time the model is reset
+])
+
+
+class Row(object):
+    """Characters and attrs of one row of cells, as parallel lists
+
+    The cell after a double-width character holds u''."""
+    __slots__ = ('chars', 'attrs')
+
+    def __init__(self, width, chars=None, attrs=None):
+        self.chars = [u' '] * width if chars is None else chars
+        self.attrs = [u''] * width if attrs is None else attrs
+
+    def copy(self):
+        return Row(0, self.chars[:], self.attrs[:])
+
+    def __eq__(self, other):
+        return self.chars == other.chars and self.attrs == other.attrs
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Row(%r)' % (u''.join(self.chars), )
+
+    def write(self, col, text, attr):
+        self.chars[col:col + len(text)] = text
+        self.attrs[col:col + len(text)] = [attr] * len(text)
+
+    def erase(self, start, end):
+        self.chars[start:end] = [u' '] * (end - start)
+        self.attrs[start:end] = [u''] * (end - start)
+
+    def delete(self, col, n):
+        for cells, blank in ((self.chars, u' '), (self.attrs, u'')):
+            del cells[col:col + n]
+            cells.extend([blank] * n)
+
+    def insert(self, col, n):
+        for cells, blank in ((self.chars, u' '), (self.attrs, u'')):
+            width = len(cells)
+            cells[col:col] = [blank] * n
+            del cells[width:]
+
+    def content_end(self):
+        """Index after the last cell that isn't a default blank"""
+        end = len(self.chars)
+        while end and self.chars[end - 1] == u' ' and not self.attrs[end - 1]:
+            end -= 1
+        return end
+
+    def text(self):
+        return u''.join(self.chars)
+
+    def resized(self, width):
+        chars, attrs = self.chars[:width], self.attrs[:width]
+        if len(self.chars) > width and self.chars[width] == u'':
+            chars[-1], attrs[-1] = u' ', u''  # wide character cut in half
+        pad = width - len(chars)
+        return Row(0, chars + [u' '] * pad, attrs + [u''] * pad)
+
+
+def _char_width(c):
+    if unicodedata.combining(c):
+        return 0
+    return 2 if unicodedata.east_asian_width(c) in ('W', 'F') else 1
+
+
+def _sgr_groups(params):
+    """Split SGR parameters into groups, keeping extended colours together"""
+    groups = []
+    i = 0
+    while i < len(params):
+        p = params[i]
+        if p in ('38', '48') and i + 1 < len(params):
+            n = 3 if params[i + 1] == '5' else 5
+            groups.append(params[i:i + n])
+            i += n
+        else:
+            groups.append([p])
+            i += 1
+    return groups
+
+
+def _sgr_key(group):
+    code = group[0]
+    if code in ('39', '38') or (len(code) == 2 and code[0] in '39' and
+                                code[1] in '01234567'):
+        return 'fg'
+    if code in ('49', '48') or (len(code) == 2 and code[0] == '4' and
+                                code[1] in '01234567') or code.startswith('10'):
+        return 'bg'
+    return code
+
+
+_sgr_cache = {}
+
+
+def apply_sgr(attr, params):
+    """New attr string after applying SGR parameters to attr
+
+    attrs are the semicolon-separated parameters that would set the
+    attributes from a reset state; u'' is the default rendition."""
+    key = (attr, params)
+    try:
+        return _sgr_cache[key]
+    except KeyError:
+        pass
+    if len(_sgr_cache) > 1024:
+        _sgr_cache.clear()
+    _sgr_cache[key] = result = _apply_sgr(attr, params)
+    return result
+
+
+def _apply_sgr(attr, params):
+    groups = _sgr_groups([p or '0' for p in params.split(';')] if params else ['0'])
+    current = collections.OrderedDict(
+        (_sgr_key(g), g) for g in _sgr_groups(attr.split(';')) if attr)
+    for group in groups:
+        if group == ['0']:
+            current.clear()
+        else:
+            key = _sgr_key(group)
+            current.pop(key, None)
+            current[key] = group
+    return u';'.join(u';'.join(g) for g in current.values())
+
+
+def sgr(attr):
+    """Escape sequence that sets the rendition to attr"""
+    return u'\x1b[0;%sm' % (attr, ) if attr else u'\x1b[0m'
+
+
+class Screen(object):
+    """Screen grid, cursor and scrollback as the child process left them"""
+
+    def __init__(self, width, height, scrollback=1000, encoding='utf8'):
+        self.width = width
+        self.height = height
+        self.history = collections.deque(maxlen=scrollback)
+        self.decoder = codecs.getincrementaldecoder(encoding)('replace')
+        self.generation = 0
+        self.reset(synced=False)
+
+    def reset(self, cursor_row=0, cursor_col=0, width=None, height=None,
+              synced=True):
+        """Forget the screen contents and start tracking from a known cursor
+
+        Snapshots taken before a reset can't be restored."""
+        if width is not None:
+            self.width = width
+        if height is not None:
+            self.height = height
+        self.rows = [Row(self.width) for _ in range(self.height)]
+        self.cursor_row = max(0, min(cursor_row, self.height - 1))
+        self.cursor_col = max(0, min(cursor_col, self.width - 1))
+        self.wrap_pending = False
+        self.attr = u''
+        self.top = 0
+        self.bottom = self.height - 1
+        self.saved_cursor = (0, 0, u'')
+        self.main_screen = None  # main screen rows while alternate is shown
+        self.history.clear()
+        self.scrolled = 0
+        self.pending = u''
+        self.synced = synced
+        self.generation += 1
+
+    def resize(self, width, height):
+        """Change the size of the screen, keeping as much of it as fits
+
+        If the screen gets shorter, rows above the cursor go into the
+        scrollback. Snapshots taken before a resize can't be restored."""
+        self.rows, self.cursor_row = self._resized_rows(
+            self.rows, self.cursor_row, width, height, self.history)
+        if self.main_screen is not None:
+            rows, cursor_row, cursor_col = self.main_screen
+            rows, cursor_row = self._resized_rows(rows, cursor_row, width, height, None)
+            self.main_screen = rows, cursor_row, min(cursor_col, width - 1)
+        self.width, self.height = width, height
+        self.cursor_col = min(self.cursor_col, width - 1)
+        self.wrap_pending = False
+        self.top, self.bottom = 0, height - 1
+        self.generation += 1
+
+    @staticmethod
+    def _resized_rows(rows, cursor_row, width, height, history):
+        rows = [row.resized(width) for row in rows]
+        lost = max(0, cursor_row + 1 - height)
+        if history is not None:
+            history.extend(rows[:lost])
+        rows = rows[lost:lost + height]
+        rows += [Row(width) for _ in range(height - len(rows))]
+        return rows, cursor_row - lost
+
+    def snapshot(self, row_start=False):
+        """Copy of the screen to restore later
+
+        With row_start, the copy is of the screen with the cursor's row
+        cleared and the cursor at the start of it."""
+        rows = [row.copy() for row in self.rows]
+        cursor_col = self.cursor_col
+        if row_start:
+            rows[self.cursor_row] = Row(self.width)
+            cursor_col = 0
+        return Snapshot(rows, self.cursor_row, cursor_col, self.attr, self.scrolled,
+                        self.generation if self.synced else None)
+
+    def display(self):
+        """Visible text of each row, without trailing spaces"""
+        return [row.text().rstrip() for row in self.rows]
+
+    # -------------------------------------------------------------------
+    # Parsing
+
+    def feed(self, data):
+        self.feed_text(self.decoder.decode(data))
+
+    def feed_text(self, text):
+        if self.pending:
+            text = self.pending + text
+            self.pending = u''
+        pos = 0
+        end = len(text)
+        match = _TOKEN.match
+        while pos < end:
+            if text[pos] == u'\x1b':
+                if (end - pos <= MAX_PENDING and
+                        _PARTIAL_ESCAPE.match(text, pos)):
+                    self.pending = text[pos:]
+                    return
+            m = match(text, pos)
+            pos = m.end()
+            kind = m.lastgroup
+            if kind == 'text':
+                self._print_ascii(m.group('text'))
+            elif kind == 'newline':
+                self.cursor_col = 0
+                self.wrap_pending = False
+                self._linefeed()
+            elif kind == 'char':
+                self._print_char(m.group('char'))
+            elif kind == 'control':
+                self._control(m.group('control'))
+            elif kind == 'csi_final':
+                self._csi(m.group('csi_private'), m.group('csi_params'),
+                          m.group('csi_intermediate'), m.group('csi_final'))
+            elif kind == 'esc_final':
+                self._escape(m.group('esc_intermediate'), m.group('esc_final'))
+            # otherwise an OSC string, which doesn't change the screen
+
+    def _print_ascii(self, text):
+        attr = self.attr
+        start = 0
+        while start < len(text):
+            if self.wrap_pending:
+                self._wrap()
+            row = self.rows[self.cursor_row]
+            col = self.cursor_col
+            n = min(len(text) - start, self.width - col)
+            row.write(col, text[start:start + n], attr)
+            start += n
+            if col + n == self.width:
+                self.cursor_col = self.width - 1
+                self.wrap_pending = True
+            else:
+                self.cursor_col = col + n
+
+    def _print_char(self, c):
+        width = _char_width(c)
+        if width == 0:
+            return
+        if self.wrap_pending or self.cursor_col + width > self.width:
+            self._wrap()
+        row = self.rows[self.cursor_row]
+        row.write(self.cursor_col, [c] if width == 1 else [c, u''], self.attr)
+        if self.cursor_col + width >= self.width:
+            self.cursor_col = self.width - 1
+            self.wrap_pending = True
+        else:
+            self.cursor_col += width
+
+    def _wrap(self):
+        self.wrap_pending = False
+        self.cursor_col = 0
+        self._linefeed()
+
+    def _linefeed(self):
+        if self.cursor_row == self.bottom:
+            self._scroll_up(1)
+        elif self.cursor_row < self.height - 1:
+            self.cursor_row += 1
+
+    def _reverse_linefeed(self):
+        if self.cursor_row == self.top:
+            self._scroll_down(1)
+        elif self.cursor_row > 0:
+            self.cursor_row -= 1
+
+    def _scroll_up(self, n, top=None):
+        top = self.top if top is None else top
+        for _ in range(min(n, self.bottom - top + 1)):
+            row = self.rows.pop(top)
+            self.rows.insert(self.bottom, Row(self.width))
+            if top == 0 and self.main_screen is None:
+                self.history.append(row)
+                self.scrolled += 1
+
+    def _scroll_down(self, n, top=None):
+        top = self.top if top is None else top
+        for _ in range(min(n, self.bottom - top + 1)):
+            del self.rows[self.bottom]
+            self.rows.insert(top, Row(self.width))
+
+    def _control(self, c):
+        if c == u'\r':
+            self.cursor_col = 0
+            self.wrap_pending = False
+        elif c in u'\n\x0b\x0c':
+            self.wrap_pending = False
+            self._linefeed()
+        elif c == u'\b':
+            if self.wrap_pending:
+                self.wrap_pending = False
+            elif self.cursor_col > 0:
+                self.cursor_col -= 1
+        elif c == u'\t':
+            self.cursor_col = min(self.width - 1, (self.cursor_col // 8 + 1) * 8)
+            self.wrap_pending = False
+
+    def _escape(self, intermediate, final):
+        if intermediate:
+            return  # character set selection and friends
+        if final == u'M':
+            self._reverse_linefeed()
+        elif final == u'D':
+            self._linefeed()
+        elif final == u'E':
+            self.cursor_col = 0
+            self._linefeed()
+        elif final == u'7':
+            self.saved_cursor = (self.cursor_row, self.cursor_col, self.attr)
+        elif final == u'8':
+            self.cursor_row, self.cursor_col, self.attr = self.saved_cursor
+        elif final == u'c':
+            self.rows = [Row(self.width) for _ in range(self.height)]
+            self.cursor_row = self.cursor_col = 0
+            self.attr = u''
+            self.top, self.bottom = 0, self.height - 1
+        self.wrap_pending = False
+
+    def _csi(self, private, params, intermediate, final):
+        if final == u'm':
+            if not private and not intermediate:
+                self.attr = apply_sgr(self.attr, params)
+            return
+        if intermediate:
+            return
+        if private:
+            if private == u'?' and final in u'hl':
+                for mode in params.split(u';'):
+                    if mode in (u'47', u'1047', u'1049'):
+                        self._alternate_screen(final == u'h')
+            return
+        args = [int(p) if p.isdigit() else 0 for p in params.split(u';')]
+        n = max(1, args[0])
+        self.wrap_pending = False
+        if final == u'A':
+            self.cursor_row = max(self.top if self.cursor_row >= self.top else 0,
+                                  self.cursor_row - n)
+        elif final in u'Be':
+            self.cursor_row = min(self.bottom if self.cursor_row <= self.bottom
+                                  else self.height - 1, self.cursor_row + n)
+        elif final in u'Ca':
+            self.cursor_col = min(self.width - 1, self.cursor_col + n)
+        elif final == u'D':
+            self.cursor_col = max(0, self.cursor_col - n)
+        elif final == u'E':
+            self.cursor_row = min(self.height - 1, self.cursor_row + n)
+            self.cursor_col = 0
+        elif final == u'F':
+            self.cursor_row = max(0, self.cursor_row - n)
+            self.cursor_col = 0
+        elif final in u'G`':
+            self.cursor_col = min(self.width - 1, n - 1)
+        elif final == u'd':
+            self.cursor_row = min(self.height - 1, n - 1)
+        elif final in u'Hf':
+            col = args[1] if len(args) > 1 else 0
+            self.cursor_row = min(self.height - 1, n - 1)
+            self.cursor_col = min(self.width - 1, max(1, col) - 1)
+        elif final == u'J':
+            self._erase_display(args[0])
+        elif final == u'K':
+            self._erase_line(args[0])
+        elif final == u'X':
+            end = min(self.width, self.cursor_col + n)
+            self.rows[self.cursor_row].erase(self.cursor_col, end)
+        elif final == u'P':
+            n = min(n, self.width - self.cursor_col)
+            self.rows[self.cursor_row].delete(self.cursor_col, n)
+        elif final == u'@':
+            n = min(n, self.width - self.cursor_col)
+            self.rows[self.cursor_row].insert(self.cursor_col, n)
+        elif final in u'LM':
+            if self.top <= self.cursor_row <= self.bottom:
+                if final == u'L':
+                    self._scroll_down(n, top=self.cursor_row)
+                else:
+                    # deleted lines don't go into scrollback
+                    for _ in range(min(n, self.bottom - self.cursor_row + 1)):
+                        del self.rows[self.cursor_row]
+                        self.rows.insert(self.bottom, Row(self.width))
+                self.cursor_col = 0
+        elif final == u'S':
+            self._scroll_up(n)
+        elif final == u'T':
+            self._scroll_down(n)
+        elif final == u'r':
+            top = n - 1
+            bottom = (args[1] if len(args) > 1 and args[1] else self.height) - 1
+            if top < bottom < self.height:
+                self.top, self.bottom = top, bottom
+                self.cursor_row = self.cursor_col = 0
+
+    def _erase_line(self, mode):
+        row = self.rows[self.cursor_row]
+        if mode == 0:
+            row.erase(self.cursor_col, self.width)
+        elif mode == 1:
+            row.erase(0, self.cursor_col + 1)
+        elif mode == 2:
+            row.erase(0, self.width)
+
+    def _erase_display(self, mode):
+        if mode == 0:
+            self._erase_line(0)
+            for i in range(self.cursor_row + 1, self.height):
+                self.rows[i] = Row(self.width)
+        elif mode == 1:
+            self._erase_line(1)
+            for i in range(self.cursor_row):
+                self.rows[i] = Row(self.width)
+        elif mode == 2:
+            self.rows = [Row(self.width) for _ in range(self.height)]
+        elif mode == 3:
+            self.history.clear()
+
+    def _alternate_screen(self, on):
+        if on and self.main_screen is None:
+            self.main_screen = (self.rows, self.cursor_row, self.cursor_col)
+            self.rows = [Row(self.width) for _ in range(self.height)]
+        elif not on and self.main_screen is not None:
+            self.rows, self.cursor_row, self.cursor_col = self.main_screen
+            self.main_screen = None
+
+    # -------------------------------------------------------------------
+    # Restoring
+
+    def restore(self, snapshot, header=u''):
+        """Escape sequences that turn the screen back into snapshot
+
+        Returns None if the snapshot can't be restored exactly, because it
+        was taken before the model was last reset or while the alternate
+        screen was in use. If the cursor position at the time of the
+        snapshot has since scrolled off the screen, a header row is
+        scrolled just out of view and the screen is repainted with half a
+        screen of the rows leading up to that position.
+        The model is updated to match the new screen."""
+        if (snapshot is None or not self.synced or
+                snapshot.generation != self.generation or
+                self.main_screen is not None):
+            return None
+        scrolled = self.scrolled - snapshot.scrolled
+        cursor_row = snapshot.cursor_row - scrolled
+        out = u''
+        if cursor_row >= 0:
+            target = snapshot.rows[scrolled:]
+        else:
+            earlier = list(self.history)[:max(0, len(self.history) - scrolled)]
+            rows = earlier + snapshot.rows[:snapshot.cursor_row]
+            rows = rows[len(rows) - self.height // 2:]
+            target = rows + [snapshot.rows[snapshot.cursor_row]]
+            cursor_row = len(rows)
+            out = (sgr(u'') + _move(self.cursor_row, 0, 0) + u'\x1b[K' +
+                   header[:self.width] + _move(0, self.height - 1, 0) + u'\n')
+            self.feed_text(out)
+        target += [Row(self.width)] * (self.height - len(target))
+
+        diff = self._diff(target, cursor_row, snapshot.cursor_col, snapshot.attr)
+        self.feed_text(diff)
+        return out + diff
+
+    def redraw(self):
+        """Escape sequences that paint the screen onto a blank terminal"""
+        out = Screen(self.width, self.height)._diff(
+            self.rows, self.cursor_row, self.cursor_col, self.attr)
+        alternate = u'\x1b[?1049h' if self.main_screen is not None else u''
+        return alternate + u'\x1b[H\x1b[2J' + out
+
+    def _diff(self, target, cursor_row, cursor_col, attr):
+        out = []
+        row, current_attr = self.cursor_row, self.attr
+        for r, (current, expected) in enumerate(zip(self.rows, target)):
+            if current == expected:
+                continue
+            first = next(i for i, cells in enumerate(zip(
+                current.chars, expected.chars, current.attrs, expected.attrs))
+                if cells[0] != cells[1] or cells[2] != cells[3])
+            while first and expected.chars[first] == u'':
+                first -= 1
+            end_expected = expected.content_end()
+            out.append(_move(row, r, first))
+            row = r
+            for i in range(first, end_expected):
+                c, cell_attr = expected.chars[i], expected.attrs[i]
+                if c == u'':
+                    continue
+                if cell_attr != current_attr:
+                    out.append(sgr(cell_attr))
+                    current_attr = cell_attr
+                out.append(c)
+            if current.content_end() > max(end_expected, first):
+                if current_attr:
+                    out.append(sgr(u''))
+                    current_attr = u''
+                out.append(u'\x1b[K')
+        out.append(_move(row, cursor_row, cursor_col))
+        if current_attr != attr:
+            out.append(sgr(attr))
+        return u''.join(out)
+
+
+def _move(from_row, to_row, to_col):
+    """Move the cursor between rows and to a column"""
+    if to_row < from_row:
+        vertical = u'\x1b[%dA' % (from_row - to_row, )
+    elif to_row > from_row:
+        vertical = u'\x1b[%dB' % (to_row - from_row, )
+    else:
+        vertical = u''
+    return vertical + u'\r' + (u'\x1b[%dC' % (to_col, ) if to_col else u'')
@@ -0,0 +1,502 @@
+"""
+rlundo server: hosts many undoable interpreters in one process.
+
+    python -m rlundo.server serve [--socket PATH]
+    python -m rlundo.server new python      # prints the new session's id
+    python -m rlundo.server attach ID       # ctrl-\\ detaches
+    python -m rlundo.server list
+    python -m rlundo.server ps ID           # the session's undo processes
+
+Each session has its own pty, output journal and screen model, all served
+by one asyncio event loop. Clients talk to the server over a UNIX socket
+using the frames in rlundo.protocol. Anyone who can connect can run
+commands as the server's user, so by default the socket is in
+$XDG_RUNTIME_DIR or a directory in the temp directory only its user can
+get into, and the socket itself is only readable and writable by them.
+Requests are objects like
+
+    {"op": "new", "argv": ["python"], "size": [80, 24]} -> {"session": 1}
+    {"op": "attach", "session": 1}                      -> {"ok": true}
+    {"op": "detach"}                                    -> {"ok": true}
+    {"op": "resize", "size": [100, 30]}                 -> {"ok": true}
+    {"op": "list"}                                      -> {"sessions": [...]}
+    {"op": "kill", "session": 1}                        -> {"ok": true}
+    {"op": "ps", "session": 1}                          -> {"processes": [...]}
+
+where ps describes the session's chain of undo processes (see rlundo.ps),
+and failed requests are answered with {"error": message}. While attached,
+a client's INPUT frames go to the session and the session's output comes
+back as OUTPUT frames, starting with a redraw of its screen. When a
+session's interpreter exits, attached clients get an "exit" EVENT.
+"""
+
+import argparse
+import asyncio
+import os
+import select
+import shutil
+import signal
+import socket
+import stat
+import tempfile
+import tty
+
+from . import apity
+from . import control
+from . import forking
+from . import interps
+from . import journal
+from . import pity
+from . import protocol
+from . import ps
+from . import termrewrite
+from . import trace
+from .trace import INFO
+
+SOCKET_NAME = 'rlundo-server'
+
+# clients this far behind a session's output are disconnected
+MAX_CLIENT_BACKLOG = 1024 * 1024
+
+DETACH_KEY = b'\x1c'  # ctrl-\
+
+
+def socket_directory():
+    """A directory for the server's socket that only this user can get into
+
+    $XDG_RUNTIME_DIR if it's set, otherwise rlundo-UID in the temp
+    directory, made if it doesn't exist and refused if it isn't private."""
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return runtime
+    path = os.path.join(tempfile.gettempdir(), 'rlundo-%d' % (os.getuid(), ))
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 0o077):
+        raise PermissionError('%s is not a directory only you can use' % (path, ))
+    return path
+
+
+def default_socket():
+    return os.path.join(socket_directory(), SOCKET_NAME)
+
+
+def remove_stale_socket(path):
+    """Remove a socket left behind by a server that's gone
+
+    Refuses to remove anything but a socket belonging to this user."""
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        raise PermissionError('not removing %s, which is not a socket of yours' % (path, ))
+    os.remove(path)
+
+
+async def read_frame(reader):
+    """Next (kind, payload) from an asyncio StreamReader, None at EOF"""
+    try:
+        header = await reader.readexactly(protocol.HEADER.size)
+    except EOFError:
+        return None
+    kind, length = protocol.HEADER.unpack(header)
+    protocol.check_length(length)
+    try:
+        payload = await reader.readexactly(length)
+    except EOFError:
+        raise protocol.ProtocolError('connection closed in the middle of a frame')
+    return kind, payload
+
+
+class ServerSession(object):
+    """One interpreter in a pty, and the clients attached to it"""
+
+    def __init__(self, id, argv, size, directory,
+                 max_snapshot_bytes=journal.DEFAULT_MAX_SNAPSHOT_BYTES,
+                 max_session_bytes=journal.DEFAULT_MAX_SESSION_BYTES):
+        self.id = id
+        self.width, self.height = size
+        self.clients = set()
+        self.env = dict(os.environ)
+        self.argv = interps.undoable_command(argv[0], list(argv[1:]), self.env)
+        self.save_addr = os.path.join(directory, '%d-save' % (id, ))
+        self.restore_addr = os.path.join(directory, '%d-restore' % (id, ))
+        self.env['RLUNDO_SAVE'] = self.save_addr
+        self.env['RLUNDO_RESTORE'] = self.restore_addr
+        self.state_dir = ps.new_state_dir()
+        self.env[forking.STATE_DIR_VAR] = self.state_dir
+        self.rewriter = termrewrite.Session(
+            display=self.broadcast, size=lambda: (self.width, self.height),
+            max_snapshot_bytes=max_snapshot_bytes,
+            max_session_bytes=max_session_bytes,
+            markers=bool(self.env.get(control.MARKERS_VAR)))
+        self.listeners = {}
+        self.channel = None
+        self.process = None
+
+    async def start(self):
+        self.listeners = {
+            termrewrite.set_up_listener(self.save_addr): self.rewriter.save,
+            termrewrite.set_up_listener(self.restore_addr): self.rewriter.restore}
+        # made just before the fork, so no other session's interpreter
+        # inherits this one's end
+        self.channel = control.Server(
+            {'save': self.rewriter.save_request, 'restore': self.rewriter.restore,
+             'redo': self.rewriter.redo, 'exit': self.rewriter.drain,
+             'ps': lambda: {'processes': ps.chain(self.state_dir)}},
+            lambda: len(self.rewriter.outputs))
+        self.env.update(self.channel.environ())
+        self.process = await apity.aspawn(
+            self.argv,
+            master_read=self.rewriter.master_read,
+            listeners=self.listeners,
+            channels={self.channel.sock: self.channel.serve},
+            size=(self.height, self.width),
+            output=self.broadcast,
+            env=self.env)
+        self.channel.spawned()
+        self.rewriter.drain_pty = self.process.drain
+
+    def broadcast(self, data):
+        for client in list(self.clients):
+            client.send(protocol.OUTPUT, data)
+
+    def attach(self, client):
+        self.clients.add(client)
+        client.send(protocol.OUTPUT, self.rewriter.screen.redraw().encode(
+            termrewrite.encoding, 'replace'))
+
+    def resize(self, width, height):
+        if (width, height) == (self.width, self.height):
+            return
+        self.width, self.height = width, height
+        self.rewriter.screen.resize(width, height)
+        self.process.resize(height, width)
+        self.broadcast(self.rewriter.screen.redraw().encode(
+            termrewrite.encoding, 'replace'))
+
+    def info(self):
+        return {'session': self.id, 'argv': self.argv, 'pid': self.process.pid,
+                'clients': len(self.clients), 'size': [self.width, self.height],
+                'snapshots': len(self.rewriter.outputs),
+                'journal_bytes': self.rewriter.outputs.size}
+
+    def close(self):
+        for sock in self.listeners:
+            sock.close()
+        if self.channel is not None:
+            self.channel.close()
+        for addr in (self.save_addr, self.restore_addr):
+            if os.path.exists(addr):
+                os.remove(addr)
+        ps.remove_state_dir(self.state_dir)
+
+
+class Client(object):
+    """A connection to the server"""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.session = None
+        self.closed = False
+
+    def send(self, kind, payload):
+        if self.closed:
+            return
+        if self.writer.transport.get_write_buffer_size() > MAX_CLIENT_BACKLOG:
+            if trace.server.info:
+                trace.server.event(INFO, 'client fell too far behind, disconnecting')
+            self.close()
+            return
+        self.writer.write(protocol.frame(kind, payload))
+
+    def reply(self, obj):
+        self.send(protocol.REPLY, protocol.encode(obj))
+
+    def close(self):
+        self.detach()
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+    def detach(self):
+        if self.session is not None:
+            self.session.clients.discard(self)
+            self.session = None
+
+    async def serve(self):
+        try:
+            while True:
+                f = await read_frame(self.reader)
+                if f is None:
+                    break
+                kind, payload = f
+                if kind == protocol.INPUT:
+                    if self.session is not None:
+                        self.session.process.write(payload)
+                elif kind == protocol.REQUEST:
+                    try:
+                        reply = await self.handle(protocol.decode(payload))
+                    except (KeyError, ValueError, TypeError, OSError) as e:
+                        reply = {'error': '%s: %s' % (type(e).__name__, e)}
+                    if reply is not None:
+                        self.reply(reply)
+                else:
+                    raise protocol.ProtocolError('unexpected frame kind %d' % (kind, ))
+        except (protocol.ProtocolError, ConnectionError) as e:
+            if trace.server.info:
+                trace.server.event(INFO, 'dropping client: %s', e)
+        finally:
+            self.close()
+
+    async def handle(self, request):
+        op = request['op']
+        if op == 'new':
+            session = await self.server.new_session(request['argv'],
+                                                    request.get('size', (80, 24)))
+            return {'session': session.id}
+        elif op == 'attach':
+            session = self.server.sessions[int(request['session'])]
+            self.detach()
+            self.reply({'ok': True})  # before the redraw
+            self.session = session
+            session.attach(self)
+            return None
+        elif op == 'detach':
+            self.detach()
+            return {'ok': True}
+        elif op == 'resize':
+            if self.session is None:
+                raise ValueError('not attached to a session')
+            width, height = request['size']
+            self.session.resize(int(width), int(height))
+            return {'ok': True}
+        elif op == 'list':
+            return {'sessions': [s.info() for s in self.server.sessions.values()]}
+        elif op == 'kill':
+            self.server.sessions[int(request['session'])].process.kill()
+            return {'ok': True}
+        elif op == 'ps':
+            return {'processes': ps.chain(self.server.sessions[int(request['session'])].state_dir)}
+        raise ValueError('unknown op %r' % (op, ))
+
+
+class Server(object):
+    """Sessions and the socket clients manage them through"""
+
+    def __init__(self, path=None,
+                 max_snapshot_bytes=journal.DEFAULT_MAX_SNAPSHOT_BYTES,
+                 max_session_bytes=journal.DEFAULT_MAX_SESSION_BYTES):
+        self.path = path or default_socket()
+        self.max_snapshot_bytes = max_snapshot_bytes
+        self.max_session_bytes = max_session_bytes
+        self.sessions = {}
+        self.clients = set()
+        self.next_id = 1
+        self.directory = None
+        self.server = None
+
+    async def start(self):
+        self.directory = tempfile.mkdtemp(prefix='rlundo-server')
+        remove_stale_socket(self.path)
+        # no one else gets to connect, even before a chmod could happen
+        umask = os.umask(0o177)
+        try:
+            self.server = await asyncio.start_unix_server(self._connected, self.path)
+        finally:
+            os.umask(umask)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        for client in list(self.clients):
+            client.close()
+        for session in list(self.sessions.values()):
+            session.process.kill(signal.SIGKILL)
+            session.close()
+        if self.server is not None:
+            self.server.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    async def new_session(self, argv, size):
+        if not argv:
+            raise ValueError('no command given')
+        session = ServerSession(self.next_id, argv, tuple(size), self.directory,
+                                self.max_snapshot_bytes, self.max_session_bytes)
+        self.next_id += 1
+        await session.start()
+        self.sessions[session.id] = session
+        asyncio.ensure_future(self._reap(session))
+        return session
+
+    async def _reap(self, session):
+        status = await session.process.wait()
+        del self.sessions[session.id]
+        session.close()
+        event = protocol.encode({
+            'event': 'exit', 'session': session.id, 'status': status})
+        for client in list(session.clients):
+            client.send(protocol.EVENT, event)
+            client.detach()
+
+    async def _connected(self, reader, writer):
+        client = Client(self, reader, writer)
+        self.clients.add(client)
+        try:
+            await client.serve()
+        finally:
+            self.clients.discard(client)
+
+
+class Connection(object):
+    """Blocking client for the server's socket"""
+
+    def __init__(self, path=None):
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.connect(path or default_socket())
+        self.frames = protocol.FrameReader()
+        self.pending = []  # frames received while waiting for a reply
+
+    def send(self, kind, payload):
+        self.sock.sendall(protocol.frame(kind, payload))
+
+    def request(self, **request):
+        """Send a request and return its reply, keeping any other frames"""
+        self.sock.sendall(protocol.message(protocol.REQUEST, request))
+        while True:
+            frames = self.receive()
+            for i, (kind, payload) in enumerate(frames):
+                if kind == protocol.REPLY:
+                    self.pending.extend(frames[i + 1:])
+                    reply = protocol.decode(payload)
+                    if 'error' in reply:
+                        raise ValueError(reply['error'])
+                    return reply
+                self.pending.append((kind, payload))
+
+    def receive(self):
+        """Frames completed by the next read from the socket"""
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError('server closed the connection')
+        return self.frames.feed(data)
+
+    def close(self):
+        self.sock.close()
+
+
+def terminal_size():
+    size = shutil.get_terminal_size()
+    return [size.columns, size.lines]
+
+
+def attach(conn, session):
+    """Show a session on this terminal until it exits or ctrl-\\ is pressed"""
+    conn.request(op='attach', session=session)
+    conn.request(op='resize', size=terminal_size())
+    # the resize is sent from the loop below, since a frame sent from the
+    # handler could land in the middle of another one
+    resized, notify = os.pipe()
+    for fd in (resized, notify):
+        pity.set_nonblocking(fd)
+
+    def on_resize(signum, frame):
+        try:
+            os.write(notify, b'\0')
+        except BlockingIOError:
+            pass  # the loop hasn't caught up with the last one yet
+    signal.signal(signal.SIGWINCH, on_resize)
+    mode = tty.tcgetattr(pity.STDIN_FILENO)
+    tty.setraw(pity.STDIN_FILENO)
+    try:
+        while True:
+            while conn.pending:
+                kind, payload = conn.pending.pop(0)
+                if kind == protocol.OUTPUT:
+                    pity.write_stdout(payload)
+                elif kind == protocol.EVENT:
+                    return protocol.decode(payload)
+            ready = select.select([conn.sock, pity.STDIN_FILENO, resized], [], [])[0]
+            if resized in ready:
+                os.read(resized, 1024)
+                conn.send(protocol.REQUEST, protocol.encode(
+                    {'op': 'resize', 'size': terminal_size()}))
+            if pity.STDIN_FILENO in ready:
+                data = os.read(pity.STDIN_FILENO, 1024)
+                if not data or DETACH_KEY in data:
+                    conn.send(protocol.INPUT, data.split(DETACH_KEY)[0])
+                    return None
+                conn.send(protocol.INPUT, data)
+            if conn.sock in ready:
+                try:
+                    conn.pending.extend(conn.receive())
+                except EOFError:
+                    return None
+    finally:
+        signal.signal(signal.SIGWINCH, signal.SIG_DFL)
+        tty.tcsetattr(pity.STDIN_FILENO, tty.TCSAFLUSH, mode)
+        os.close(resized)
+        os.close(notify)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='host undoable interpreters in one process')
+    parser.add_argument('--socket', default=None,
+                        help='defaults to %s in $XDG_RUNTIME_DIR, or in a private '
+                        'directory in the temp directory' % (SOCKET_NAME, ))
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve')
+    serve.add_argument('--max-snapshot-bytes', type=int,
+                       default=journal.DEFAULT_MAX_SNAPSHOT_BYTES)
+    serve.add_argument('--max-session-bytes', type=int,
+                       default=journal.DEFAULT_MAX_SESSION_BYTES)
+    new = commands.add_parser('new')
+    new.add_argument('argv', nargs=argparse.REMAINDER)
+    commands.add_parser('attach').add_argument('session', type=int)
+    commands.add_parser('list')
+    commands.add_parser('kill').add_argument('session', type=int)
+    commands.add_parser('ps').add_argument('session', type=int)
+    args = parser.parse_args(args)
+
+    if args.command == 'serve':
+        server = Server(args.socket, args.max_snapshot_bytes, args.max_session_bytes)
+        asyncio.run(server.serve_forever())
+        return
+    conn = Connection(args.socket)
+    if args.command == 'new':
+        print(conn.request(op='new', argv=args.argv, size=terminal_size())['session'])
+    elif args.command == 'attach':
+        event = attach(conn, args.session)
+        if event is not None:
+            print('\r\nsession %d exited with status %d' % (event['session'], event['status']))
+    elif args.command == 'list':
+        for info in conn.request(op='list')['sessions']:
+            print('%(session)d\tpid %(pid)d\t%(clients)d attached\t'
+                  '%(snapshots)d snapshots\t%(journal_bytes)d bytes' % info)
+    elif args.command == 'kill':
+        conn.request(op='kill', session=args.session)
+    elif args.command == 'ps':
+        for line in ps.format_chain(conn.request(op='ps', session=args.session)['processes']):
+            print(line)
+    else:
+        parser.print_help()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
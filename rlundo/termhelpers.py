@@ -29,3 +29,16 @@ class Nonblocking(object):
         fcntl.fcntl(self.fd, fcntl.F_SETFL, self.orig_fl)
 
 
+
+
+class Blocking(object):
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __enter__(self):
+        self.orig_fl = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, self.orig_fl & ~os.O_NONBLOCK)
+
+    def __exit__(self, *args):
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, self.orig_fl)
@@ -4,31 +4,39 @@ terminal state.
 """
 
 import locale
-import logging
 import os
-import re
 import socket
 import sys
 import tempfile
-import threading
-import time
+
+import collections
 
 import blessings
 
+from . import control
+from . import forking
+from . import journal
 from . import pity
-from .findcursor import get_cursor_position
+from . import ps
+from . import retention
+from . import trace
+from .trace import DEBUG, INFO, WARNING
+from .findcursor import Cbreak, CursorPositionTimeout, InputDemux
+from .screen import Screen
 
 # version 1: record sequences, guess how many lines to go back up
 terminal = blessings.Terminal()
-encoding = locale.getdefaultlocale()[1]
+encoding = locale.getdefaultlocale()[1] or 'utf8'
 
-outputs = [b'']
-terminal_output_lock = pity.TerminalLock()
-stdin_lock = threading.Lock()
+# longest to wait for the child's output to stop arriving before a save
+DRAIN_TIMEOUT = .5
 
+# how much of each chunk of output a trace event keeps
+TRACE_BYTES = 200
 
-logger = logging.getLogger(__name__)
-logging.basicConfig(filename='example.log', level=logging.INFO)
+# most output the screen model is left behind by; past this it can't be
+# brought up to date exactly and restores rewind the journal instead
+MAX_UNPARSED_BYTES = 64 * 1024
 
 
 def temp_name(s):
@@ -50,17 +58,31 @@ class UnlinkWrapper(object):
 
 
 def write(data):
-    sys.stdout.write(data)
-    sys.stdout.flush()
+    """Write all of data to the terminal, usually in one syscall"""
+    if not isinstance(data, bytes):
+        data = data.encode(encoding, 'replace')
+    pity.write_all(sys.stdout.fileno(), data)
 
 
-def save():
-    time.sleep(.001)
-    # correct way to do this would be to
-    # wait until there's nothing to read on the pty
+Capabilities = collections.namedtuple('Capabilities', [
+    'carriage_return', 'move_up', 'clear_eol', 'clear_eos', 'move', 'home'])
+_capabilities = []
+
 
-    outputs.append(b'')
-    logger.info('full output stack: %r' % (outputs, ))
+def capabilities():
+    """Terminal escape sequences, looked up in terminfo once
+
+    move is the cup template, called with a row and column to format it."""
+    if not _capabilities:
+        move = terminal.move
+        _capabilities.append(Capabilities(
+            carriage_return=terminal.cr or '\r',
+            move_up=terminal.move_up,
+            clear_eol=terminal.clear_eol,
+            clear_eos=terminal.clear_eos,
+            move=move,
+            home=move(0, 0)))
+    return _capabilities[0]
 
 
 def count_lines(msg, width):
@@ -72,7 +94,7 @@ def count_lines(msg, width):
 
 def _visible_characters(line):
     """Number of characters in string without color escape characters."""
-    line_without_colours = re.sub(u"\x1b[[]0(;\d\d)?m", u"", line)
+    line_without_colours = journal.COLOUR_CODE.sub(u"", line)
     line_without_colours = line_without_colours.strip(u"\n")
     return len(line_without_colours)
 
@@ -96,91 +118,451 @@ def history(sequences):
 HISTORY_BROKEN_MSG = '#<---History contiguity broken by rewind--->'
 
 
+def rewind_sequence(n):
+    """Move the cursor up n lines to the first column and clear below it"""
+    caps = capabilities()
+    return caps.move_up * n + caps.carriage_return + caps.clear_eos
+
+
+def history_broken_sequence(lines_available, lines, width=None, height=None):
+    """Clear the lines above the cursor, mark history as broken and reprint lines
+
+    The mark is scrolled just out of view and lines are printed from the
+    top of the screen."""
+    caps = capabilities()
+    width = width or terminal.width
+    height = height or terminal.height
+    return u''.join([
+        caps.carriage_return + caps.clear_eol,
+        (caps.move_up + caps.clear_eol) * lines_available,
+        HISTORY_BROKEN_MSG[:width] + u'\n',
+        caps.move(height - 1, 0) + u'\n',
+        caps.home,
+        u''.join((line + b'\r\n').decode(encoding, 'replace') for line in lines)])
+
+
+class Session(object):
+    """Output journal and screen model of one child process
+
+    By default a session belongs to the real terminal: restores are written
+    to standard output and the terminal is asked where its cursor is.
+    Sessions shown somewhere else pass display, a function that sends bytes
+    there, and size, a function returning its (width, height). Their screen
+    model sees everything they display, so it's trusted to be accurate.
+
+    Keystrokes for the child go through demux, which picks out the
+    terminal's replies to cursor position queries, and then send_input.
+
+    Output only goes into the journal as it arrives. The screen model is
+    brought up to date when it's looked at, at a save, restore or redraw,
+    and gives up on output longer than MAX_UNPARSED_BYTES, keeping just
+    the end of it, so a program printing a lot isn't slowed down by it.
+
+    With markers, requests written into the child's output are taken out
+    of it and acted on (see rlundo.control); otherwise output that happens
+    to look like one is passed on like any other."""
+
+    def __init__(self, display=None, size=None,
+                 max_snapshot_bytes=journal.DEFAULT_MAX_SNAPSHOT_BYTES,
+                 max_session_bytes=journal.DEFAULT_MAX_SESSION_BYTES,
+                 markers=False):
+        self.display = display
+        self.size = size or terminal_size
+        self.outputs = journal.OutputJournal(max_snapshot_bytes, max_session_bytes,
+                                             encoding=encoding,
+                                             max_snapshots=max_snapshots(retention.policy))
+        width, height = self.size()
+        self._screen = Screen(width, height, encoding=encoding)
+        if display is not None:
+            self._screen.reset()  # starts out in sync with a blank display
+        self.unparsed = collections.deque()  # output the screen hasn't seen
+        self.unparsed_bytes = 0
+        self.unparsed_dropped = False
+        self.drain_pty = None  # drains the child's pty into master_read
+        self.reader = pity.AdaptiveReader()
+        self.markers = control.MarkerParser() if markers else None
+        # segments each restore took off the journal, for redo, and whether
+        # there's been a restore or redo since the last save, without which
+        # a save means new input and the undone segments are dropped
+        self.undone = collections.deque(maxlen=retention.policy.max_redo or 0)
+        self.restored = False
+        self.child_input = pity.ChildInput()
+        self.send_input = self.child_input.send
+        self.demux = InputDemux(lambda data: self.send_input(data))
+
+    def write(self, data):
+        if self.display is None:
+            write(data)
+        elif isinstance(data, bytes):
+            self.display(data)
+        else:
+            self.display(data.encode(encoding, 'replace'))
+
+    def cursor_position(self):
+        """(row, column) of the cursor, asking the terminal if there is one
+
+        Falls back to the screen model if the terminal doesn't answer."""
+        if self.display is None:
+            try:
+                return self.demux.get_cursor_position(pity.STDOUT_FILENO,
+                                                      pity.STDIN_FILENO)
+            except CursorPositionTimeout as e:
+                if trace.restore.warning:
+                    trace.restore.event(WARNING, '%s', e)
+                self.screen.synced = False
+        return self.screen.cursor_row, self.screen.cursor_col
+
+    def master_read(self, fd):
+        data = self.reader(fd)
+        if trace.pty.debug:
+            trace.pty.event(DEBUG, 'read %d bytes: %r', len(data), data[:TRACE_BYTES])
+        if self.markers is None or (control.MARKER[:1] not in data and
+                                    not self.markers.held):
+            self.feed(data)
+            return data
+        output = []
+        for piece in self.markers.feed(data):
+            if isinstance(piece, bytes):
+                self.feed(piece)
+                output.append(piece)
+                continue
+            op, id = piece
+            if trace.snapshot.debug:
+                trace.snapshot.event(DEBUG, 'marker %s %s', op, id)
+            # everything before a marker has been read, so there's nothing to drain
+            if op == 'save':
+                self.save(drain=False)
+            elif op in ('restore', 'redo'):
+                self.write(b''.join(output))
+                output = []
+                getattr(self, op)(drain=False)
+        if self.markers.held and not pity.pending_bytes(fd):
+            # nothing more is coming yet, so it isn't the start of a marker
+            # written in one go, and it may be what the program is waiting on
+            held = self.markers.flush()
+            self.feed(held)
+            output.append(held)
+        return b''.join(output) or None  # not b'', which would mean the pty closed
+
+    def feed(self, data):
+        """Record output from the child"""
+        self.outputs.append(data)
+        unparsed = self.unparsed
+        unparsed.append(data)
+        self.unparsed_bytes += len(data)
+        while self.unparsed_bytes - len(unparsed[0]) >= MAX_UNPARSED_BYTES:
+            self.unparsed_bytes -= len(unparsed.popleft())
+            self.unparsed_dropped = True
+
+    @property
+    def screen(self):
+        """The screen model, brought up to date with the output so far"""
+        if self.unparsed:
+            self.parse()
+        return self._screen
+
+    def parse(self):
+        """Feed the screen model the output it hasn't seen"""
+        data = b''.join(self.unparsed)
+        self.unparsed.clear()
+        self.unparsed_bytes = 0
+        if self.unparsed_dropped:
+            self.unparsed_dropped = False
+            if trace.snapshot.info:
+                trace.snapshot.event(INFO, 'too much output for the screen model')
+            # start from a line of what's left, for a picture of the screen
+            # that's probably right but can't be restored to
+            self._screen.reset(synced=False)
+            data = data[data.find(b'\n') + 1:]
+        self._screen.feed(data)
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """Record and copy everything the child has written so far
+
+        The child writes its output before asking for a save or restore, so
+        once there's nothing left to read on the pty the output belongs before
+        the snapshot boundary."""
+        if self.drain_pty is None:
+            return
+        if not self.drain_pty(timeout):
+            if trace.snapshot.warning:
+                trace.snapshot.event(WARNING, 'pty still has output after %ss', timeout)
+
+    def save(self, drain=True):
+        if drain:
+            self.drain()
+        if not self.restored:
+            self.undone.clear()
+        self.restored = False
+        self.outputs.save()
+        self.check_screen_size()
+        # rewinding counts whole rows, so restores go back to the start of
+        # the row the save was on and the program prints its prompt again
+        self.outputs.segments[-1].snapshot = self.screen.snapshot(row_start=True)
+        if trace.snapshot.info:
+            trace.snapshot.event(INFO, 'saved: %d segments, %d bytes', len(self.outputs),
+                                 self.outputs.size)
+
+    def save_request(self, levels=None):
+        """Save for a request on the control channel
+
+        levels is how many parked processes the sender can release, if it
+        can release any (see forking.save). The answer is how many of the
+        oldest of them to release for memory, and the journal keeps a
+        segment for each of the rest and merges the segments of any
+        released since the last save."""
+        self.save()
+        if levels is None:
+            return None
+        release = 1 if levels and retention.policy.under_pressure() else 0
+        if release and trace.snapshot.warning:
+            trace.snapshot.event(WARNING, 'memory pressure, releasing the oldest undo')
+        # one segment for each parked process, the live one's, the root's
+        # and the one from before the root's first save
+        self.outputs.release(len(self.outputs) - (levels - release + 3))
+        return {'release': release}
+
+    def check_screen_size(self):
+        """Start over with the screen model if the terminal has been resized"""
+        width, height = self.size()
+        if (width, height) != (self.screen.width, self.screen.height):
+            self.screen.reset(width=width, height=height, synced=False)
+
+    def restore(self, drain=True):
+        """Restores the terminal to the state it was in at the second-to-last save
+
+        Uses the screen model if it's in sync with the terminal, otherwise
+        clears as many lines as the rewound output seems to have taken up."""
+        if drain:
+            self.drain()
+        outputs, screen = self.outputs, self.screen
+        if trace.restore.info:
+            trace.restore.event(INFO, 'restoring: %d segments, %d bytes', len(outputs),
+                                outputs.size)
+        segments = [outputs.pop(), outputs.pop()]
+        self.undone.append(segments)
+        self.restored = True
+        lines_available = self.check_cursor()
+        width, height = self.size()
+        if segments[1] is not None:
+            sequence = screen.restore(segments[1].snapshot,
+                                      HISTORY_BROKEN_MSG[:width])
+            if sequence is not None:
+                if trace.restore.debug:
+                    trace.restore.event(DEBUG, 'restoring screen with %d characters: %r',
+                                        len(sequence), sequence[:TRACE_BYTES])
+                self.write(sequence)
+                return
+
+        if None in segments:
+            # output from before the last save was evicted from the journal,
+            # so it's certainly too much to rewind
+            n = sys.maxsize
+        else:
+            n = journal.count_rows([s.index for s in reversed(segments)], width)
+        if trace.restore.info:
+            trace.restore.event(INFO, 'rewinding %d lines of %d available', n, lines_available)
+        if n > lines_available:
+            sequence = history_broken_sequence(
+                lines_available, history(outputs)[:-1][-(height // 2):],
+                width, height)
+            self.write(sequence)
+            if self.display is None:
+                # no idea where the cursor is now
+                screen.reset(synced=False)
+            else:
+                screen.feed_text(sequence)
+        else:
+            sequence = rewind_sequence(n)
+            self.write(sequence)
+            if self.display is None:
+                screen.reset(cursor_row=lines_available - n)
+            else:
+                screen.feed_text(sequence)
+
+    def check_cursor(self):
+        """Rows above the cursor, noting if the screen model disagrees"""
+        screen = self.screen
+        lines_available, column = self.cursor_position()
+        self.check_screen_size()
+        if (screen.cursor_row, screen.cursor_col) != (lines_available, column):
+            if trace.restore.warning:
+                trace.restore.event(WARNING, 'screen model cursor %r out of sync with terminal %r',
+                                    (screen.cursor_row, screen.cursor_col), (lines_available, column))
+            screen.synced = False
+        return lines_available
+
+    def redo(self, drain=True):
+        """Puts back the output and screen the last restore took away
+
+        For a program that carries on from where it was undone instead of
+        running the undone input again. What's been written since that
+        restore, the prompt and whatever was typed at it, is rewound. Does
+        nothing if there's no restore to take back, as when redo is off."""
+        if drain:
+            self.drain()
+        self.restored = True
+        if not self.undone:
+            if trace.restore.warning:
+                trace.restore.event(WARNING, 'nothing to redo')
+            return
+        later, undone = self.undone.pop()
+        current = self.outputs.pop()
+        if undone is not None:
+            self.outputs.push(undone)
+        if trace.restore.info:
+            trace.restore.event(INFO, 'redoing: %d segments, %d bytes', len(self.outputs),
+                                self.outputs.size)
+        lines_available = self.check_cursor()
+        width, height = self.size()
+        if later is not None:
+            sequence = self.screen.restore(later.snapshot, HISTORY_BROKEN_MSG[:width])
+            if sequence is not None:
+                self.write(sequence)
+                return
+
+        # without the screen model, rewind to where the restore left the
+        # cursor and write the undone output again
+        if None in (current, undone) or not (current.complete and undone.complete):
+            return
+        n = journal.count_rows([current.index], width)
+        if n > lines_available:
+            return
+        sequence = rewind_sequence(n)
+        self.write(sequence)
+        if self.display is None:
+            self.screen.reset(cursor_row=lines_available - n)
+        else:
+            self.screen.feed_text(sequence)
+        self.write(undone.bytes())
+        self.screen.feed(undone.bytes())
+
+    def configure_journal(self, max_snapshot_bytes=journal.DEFAULT_MAX_SNAPSHOT_BYTES,
+                          max_session_bytes=journal.DEFAULT_MAX_SESSION_BYTES):
+        """Set the byte caps of the output journal (None means unbounded)"""
+        self.outputs.max_snapshot_bytes = max_snapshot_bytes
+        self.outputs.max_session_bytes = max_session_bytes
+
+
+def terminal_size():
+    return terminal.width or 80, terminal.height or 24
+
+
+def max_snapshots(policy):
+    """Journal segments needed for the undo depth policy allows"""
+    if policy.max_depth is None:
+        return None
+    # the root and max_depth parked processes, each to be undone to
+    return policy.max_depth + 3
+
+
+# the session of the real terminal, used by the functions below
+session = Session(markers=bool(os.environ.get(control.MARKERS_VAR)))
+outputs = session.outputs
+screen = session.screen
+
+
+def drain(timeout=DRAIN_TIMEOUT):
+    session.drain(timeout)
+
+
+def save():
+    session.save()
+
+
 def restore():
-    with terminal_output_lock:
-        _restore()
-
-
-def _restore():
-    """Clears the current line and as many lines above as needed?"""
-    logger.debug('full output stack: %r' % (outputs, ))
-    lines_between_saves = outputs.pop() if outputs else ''
-    lines_after_save = outputs.pop() if outputs else ''
-    lines = lines_between_saves + lines_after_save
-    logger.info('lines to rewind: %r' % (lines, ))
-    n = count_lines(lines.decode(encoding), terminal.width)
-    logger.info('number of lines to rewind %d' % (n, ))
-    with stdin_lock:
-        lines_available, _ = get_cursor_position(sys.stdout, sys.stdin)
-    logger.debug('lines move: %d lines_available: %d' % (n, lines_available))
-    if n > lines_available:
-        for _ in range(200):
-            write(terminal.move_left)
-        write(terminal.clear_eol)
-        for _ in range(lines_available):
-            write(terminal.move_up)
-            write(terminal.clear_eol)
-        write(HISTORY_BROKEN_MSG[:terminal.width])
-        write('\n')
-        for _ in range(terminal.height - 2):
-            write(terminal.move_down)
-        for _ in range(200):
-            write(terminal.move_left)
-        write('\n')
-        for _ in range(terminal.height - 1):
-            write(terminal.move_up)
-        middle = terminal.height // 2
-
-        for line in history(outputs)[:-1][-middle:]:
-            write((line + b'\r\n').decode('utf8'))
-
-    else:
-        logger.debug('moving cursor %d lines up for %r' % (n, lines))
-        for _ in range(n):
-            write(terminal.move_up)
-        for _ in range(200):
-            write(terminal.move_left)
-        write(terminal.clear_eos)
-
-
-def set_up_listener(handler, addr):
-    def forever():
-        while True:
-            conn, addr = sock.accept()
-            handler()
-            conn.close()
+    session.restore()
+
+
+def redo():
+    session.redo()
+
+
+def check_screen_size():
+    session.check_screen_size()
+
+
+def master_read(fd):
+    return session.master_read(fd)
+
 
+def set_up_listener(addr):
     sock = socket.socket(family=socket.AF_UNIX)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind(addr)
-    sock.listen(1)
-    t = threading.Thread(target=forever)
-    t.daemon = True
-    t.start()
-    return sock, t
+    sock.listen(socket.SOMAXCONN)
+    return sock
 
 
-def master_read(fd):
+def stdin_read(fd):
     data = os.read(fd, 1024)
-    logger.info('read data: %r' % data)
-    if outputs:
-        outputs[-1] += data
-    return data
+    if trace.pty.debug:
+        trace.pty.event(DEBUG, 'stdin %r', data[:TRACE_BYTES])
+    if not data:
+        return data
+    data = session.demux.feed(data)
+    if session.demux.parser.held and not pity.pending_bytes(fd):
+        data += session.demux.flush_keys()
+    return data or None
 
 
-def stdin_read(fd):
-    with stdin_lock:
-        data = os.read(fd, 1024)
-        logger.info('read from stdin: %r' % data)
-        return data
+def sync_screen():
+    """Start the screen model from the terminal's cursor position"""
+    if sys.stdin.isatty():
+        width, height = terminal_size()
+        try:
+            with Cbreak(sys.stdin):
+                row, col = session.demux.get_cursor_position(pity.STDOUT_FILENO,
+                                                             pity.STDIN_FILENO)
+        except CursorPositionTimeout:
+            screen.reset(width=width, height=height, synced=False)
+        else:
+            screen.reset(row, col, width=width, height=height)
+
+
+def control_server(state_dir=None):
+    """Control channel for the child to inherit, see rlundo.control
+
+    state_dir is where the child's undo chain is recorded, for ps."""
+    def processes():
+        return {'processes': ps.chain(state_dir) if state_dir else []}
+    return control.Server({'save': session.save_request, 'restore': restore, 'redo': redo,
+                           'exit': session.drain, 'ps': processes},
+                          lambda: len(session.outputs))
 
 
-def run(argv):
+def _channels(channel):
+    return {channel.sock: channel.serve} if channel is not None else None
+
+
+def run(argv, listeners=None, channel=None):
+    """Run argv in a pty, calling listeners[sock]() on each connection to sock
+
+    channel is a control.Server whose child_fd argv inherits."""
+    sync_screen()
+
+    def on_spawn(pid, fd):
+        set_master_fd(pid, fd)
+        if channel is not None:
+            channel.spawned()
     pity.spawn(argv,
                master_read=master_read,
                stdin_read=stdin_read,
                handle_window_size=True,
-               terminal_output_lock=terminal_output_lock)
+               listeners=listeners,
+               on_spawn=on_spawn,
+               child_input=session.child_input,
+               channels=_channels(channel))
+
+
+def set_master_fd(pid, fd):
+    session.drain_pty = lambda timeout: pity.drain(fd, master_read, timeout)
+
+
+def configure_journal(max_snapshot_bytes=journal.DEFAULT_MAX_SNAPSHOT_BYTES,
+                      max_session_bytes=journal.DEFAULT_MAX_SESSION_BYTES):
+    """Set the byte caps of the terminal session's output journal"""
+    session.configure_journal(max_snapshot_bytes, max_session_bytes)
 
 
 def run_with_listeners(args, save_addr=None, restore_addr=None, print_addrs=False):
@@ -193,10 +575,23 @@ def run_with_listeners(args, save_addr=None, restore_addr=None, print_addrs=Fals
         print("trigger these with nc -U <socketname>")
         print("they have been saved in this process's envvars as")
         print("RLUNDO_SAVE and RLUNDO_RESTORE")
-    listeners = [set_up_listener(save, save_addr),
-                 set_up_listener(restore, restore_addr)]
+    listeners = {set_up_listener(save_addr): save,
+                 set_up_listener(restore_addr): restore}
     os.environ["RLUNDO_SAVE"] = save_addr
     os.environ["RLUNDO_RESTORE"] = restore_addr
-    with UnlinkWrapper(save_addr):
-        with UnlinkWrapper(restore_addr):
-            run(args)
+    state_dir = ps.new_state_dir()
+    os.environ[forking.STATE_DIR_VAR] = state_dir
+    channel = control_server(state_dir)
+    os.environ.update(channel.environ())
+    try:
+        with UnlinkWrapper(save_addr):
+            with UnlinkWrapper(restore_addr):
+                run(args, listeners, channel)
+    finally:
+        channel.close()
+        ps.remove_state_dir(state_dir)
+
+
+if sys.version_info >= (3, 7):
+    # the asyncio counterpart of run, in a module only Python 3 can import
+    from .apity import arun
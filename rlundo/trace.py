@@ -0,0 +1,173 @@
+"""
+Tracing for rlundo's subsystems, off unless asked for.
+
+Each subsystem has a Tracer whose level flags are plain attributes, so a
+disabled trace point costs one attribute lookup and builds nothing:
+
+    if pty.debug:
+        pty.event(DEBUG, 'read %r', data)
+
+Events go into an in-memory ring buffer and are only formatted when the
+buffer is dumped: on SIGUSR1, when an exception goes uncaught, or by
+calling dump().
+
+Tracing is configured from the environment when this module is imported:
+
+    RLUNDO_TRACE=pty=debug:0.01,restore=debug   # level and sample rate
+    RLUNDO_TRACE='*=info'                       # every subsystem
+    RLUNDO_TRACE_SIZE=10000                     # events kept
+    RLUNDO_TRACE_FILE=/tmp/trace.log            # where dumps go
+
+Dumps go to rlundo-trace-<pid>.log in the temp directory by default.
+"""
+
+import collections
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+OFF = 100
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'off': OFF}
+LEVEL_NAMES = dict((level, name) for name, level in LEVELS.items())
+
+SUBSYSTEMS = ('pty', 'snapshot', 'restore', 'server')
+
+DEFAULT_SIZE = 10000
+
+events = collections.deque(maxlen=DEFAULT_SIZE)
+dump_path = None
+_hooks_installed = []
+
+
+class Tracer(object):
+    """Trace points of one subsystem"""
+
+    def __init__(self, name):
+        self.name = name
+        self.set_level(OFF)
+
+    def set_level(self, level, rate=1.0):
+        """Record events at level or above, a fraction rate of them"""
+        self.level = level
+        self.rate = rate
+        self.debug = level <= DEBUG
+        self.info = level <= INFO
+        self.warning = level <= WARNING
+
+    def event(self, level, message, *args):
+        """Record message % args, which is only formatted when dumped
+
+        Callers check the level flag first."""
+        if self.rate < 1.0 and random.random() >= self.rate:
+            return
+        events.append((time.time(), self.name, level, message, args))
+
+    def __repr__(self):
+        return '<Tracer %s: %s>' % (self.name, LEVEL_NAMES.get(self.level, self.level))
+
+
+tracers = collections.OrderedDict((name, Tracer(name)) for name in SUBSYSTEMS)
+pty = tracers['pty']
+snapshot = tracers['snapshot']
+restore = tracers['restore']
+server = tracers['server']
+
+
+def parse(spec):
+    """{subsystem: (level, rate)} from a string like 'pty=debug:0.1,restore=info'"""
+    levels = {}
+    for item in spec.replace(' ', '').split(','):
+        if not item:
+            continue
+        name, _, setting = item.partition('=')
+        level, _, rate = (setting or 'debug').partition(':')
+        if name != '*' and name not in tracers:
+            raise ValueError('unknown trace subsystem %r' % (name, ))
+        if level not in LEVELS:
+            raise ValueError('unknown trace level %r' % (level, ))
+        levels[name] = (LEVELS[level], float(rate) if rate else 1.0)
+    return levels
+
+
+def configure(spec, size=None, path=None):
+    """Set levels from a spec string (see parse) and where dumps go"""
+    global events, dump_path
+    levels = parse(spec)
+    for name, tracer in tracers.items():
+        tracer.set_level(*levels.get(name, levels.get('*', (OFF, 1.0))))
+    if size is not None and size != events.maxlen:
+        events = collections.deque(events, maxlen=size)
+    if path is not None:
+        dump_path = path
+    if enabled():
+        install_hooks()
+
+
+def configure_from_env(environ=os.environ):
+    spec = environ.get('RLUNDO_TRACE')
+    if spec:
+        size = environ.get('RLUNDO_TRACE_SIZE')
+        configure(spec, int(size) if size else None, environ.get('RLUNDO_TRACE_FILE'))
+
+
+def enabled():
+    return any(tracer.level < OFF for tracer in tracers.values())
+
+
+def format_event(event):
+    t, name, level, message, args = event
+    try:
+        text = message % args if args else message
+    except Exception as e:
+        text = '%s %% %r (%s)' % (message, args, e)
+    return '%.6f %s %s %s' % (t, name, LEVEL_NAMES.get(level, level), text)
+
+
+def dump(stream=None):
+    """Write and clear the buffered events, to the dump file by default
+
+    Returns the path written to, if any."""
+    recorded = list(events)
+    events.clear()
+    if stream is not None:
+        for event in recorded:
+            stream.write(format_event(event) + '\n')
+        return None
+    path = dump_path or os.path.join(tempfile.gettempdir(),
+                                     'rlundo-trace-%d.log' % (os.getpid(), ))
+    with open(path, 'a') as f:
+        for event in recorded:
+            f.write(format_event(event) + '\n')
+    return path
+
+
+def install_hooks():
+    """Dump on SIGUSR1 and when an exception goes uncaught"""
+    if _hooks_installed:
+        return
+    _hooks_installed.append(True)
+    original_excepthook = sys.excepthook
+
+    def excepthook(*exc_info):
+        if events:
+            events.append((time.time(), 'crash', WARNING, 'uncaught %r', (exc_info[1], )))
+            dump()
+        original_excepthook(*exc_info)
+    sys.excepthook = excepthook
+
+    if hasattr(signal, 'SIGUSR1'):
+        try:
+            if signal.getsignal(signal.SIGUSR1) == signal.SIG_DFL:
+                signal.signal(signal.SIGUSR1, lambda signum, frame: dump())
+        except ValueError:
+            pass  # not the main thread
+
+
+configure_from_env()
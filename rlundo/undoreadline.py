@@ -1,12 +1,10 @@
 import code
-import socket
 import os
 import sys
-from functools import partial
-
-# if this process is a child, this will change from None
-WRITE_TO_PARENT_FD = None
 
+from . import control
+from . import forking
+from .retention import HISTORY_DROPPED_MSG
 
 py2 = False
 if sys.version_info[0] == 2:
@@ -29,29 +27,35 @@ def monkeypatch_readline():
 
 
 def readline_no_rewrite(prompt):
-    global WRITE_TO_PARENT_FD
-
     while True:
         save()
         try:
             s = orig_input(prompt)
         except EOFError:
+            tell_exit()
             die_and_tell_parent(b'exit')
 
         if s == 'undo':
+            if not forking.can_undo():
+                print(HISTORY_DROPPED_MSG)
+                continue
             restore()
-            die_and_tell_parent(b'undo')
-        read_fd, write_fd = os.pipe()
-        pid = os.fork()
+            if not forking.park_for_redo():
+                die_and_tell_parent(b'undo')
+            continue  # redone
+        if forking.can_redo(s):
+            redo()
+            pid = forking.redo()
+        else:
+            pid = forking.fork(s)
         is_child = pid == 0
 
         if is_child:
-            WRITE_TO_PARENT_FD = write_fd
             return s
         else:
-            from_child = os.read(read_fd, 1)
-            if from_child == b'e':
+            if forking.wait_for_child() == b'exit':
                 die_and_tell_parent(b'exit')
+            forking.resume()
             continue
 
 
@@ -63,30 +67,35 @@ def restore():
     pass
 
 
+def redo():
+    pass
+
+
+def tell_exit():
+    pass
+
+
 def init_terminal_rewriting():
     global save
     global restore
+    global redo
+    global tell_exit
     try:
-        save = partial(connect_and_wait_for_close, addr=os.environ['RLUNDO_SAVE'])
-        restore = partial(connect_and_wait_for_close, addr=os.environ['RLUNDO_RESTORE'])
+        control.client()
     except KeyError:
         print(sorted(os.environ.keys()))
         raise
-
-
-def connect_and_wait_for_close(addr):
-    s = socket.socket(family=socket.AF_UNIX)
-    try:
-        s.connect(addr)
-    except ConnectionRefusedError:
-        pass
-    else:
-        assert b'' == s.recv(1024)
+    save = forking.save
+    restore = control.restore
+    redo = control.redo
+    tell_exit = control.exit
 
 
 def die_and_tell_parent(msg):
-    if WRITE_TO_PARENT_FD is not None:
-        os.write(WRITE_TO_PARENT_FD, msg+b'\n')
+    if msg == b'exit':
+        forking.end_chain()
+    else:
+        forking.tell_parent(msg)
     sys.exit()
 
 
@@ -5,6 +5,7 @@
 
 #define _GNU_SOURCE
 
+#include <errno.h>
 #include <stdlib.h>
 #include <dlfcn.h>
 #include <stdio.h>
@@ -20,6 +21,8 @@
 #include<readline/readline.h>
 #include<readline/history.h>
 
+#include "rlundoclient.h"
+
 static char *top_undo_message = "with no command, so exiting";
 static char *last_command;
 static char *(*original_readline)(const char*) = NULL;
@@ -58,27 +61,40 @@ char* readline(const char *prompt){
     original_readline = get_original_readline();
   }
 
-  system("nc -z localhost 4242");
-  value = (*original_readline)(prompt);
-  if(!value){
-    free(last_command);
-    printf("\n");
-    exit(0);
-  }
-  if(!strcmp(value, "undo")){
-    printf("undoing '%s'\n", last_command);
-
-    free(last_command);
-    exit(42);
-  }
-  pid_t pid = fork();
+  // a loop rather than calling readline again after each undo, so undoing
+  // thousands of times doesn't grow the stack
+  while (1){
+    rlundo_save();
+    value = (*original_readline)(prompt);
+    if(!value){
+      free(last_command);
+      rlundo_exit();
+      printf("\n");
+      exit(0);
+    }
+    if(!strcmp(value, "undo")){
+      rlundo_restore();
+      printf("undoing '%s'\n", last_command);
 
-  if (pid == 0) { // child
-    last_command = strdup(value);
-    return value;
-  } else { // parent
+      free(last_command);
+      exit(42);
+    }
+    // ignored from before the fork, so a Ctrl-C can't reach the parent
+    // between the fork and its waiting
+    rlundo_ignore_job_signals();
+    pid_t pid = fork();
+
+    if (pid == 0) { // child
+      rlundo_restore_job_signals();
+      free(last_command);
+      last_command = strdup(value);
+      return value;
+    }
+    // parent
     int status;
-    waitpid(pid, &status, 0);
+    while (waitpid(pid, &status, 0) < 0 && errno == EINTR);
+    rlundo_restore_job_signals();
+    free(value);  // the child has the line now
     int exitstatus = -1;
     if (WIFEXITED(status)){
       exitstatus = WEXITSTATUS(status);
@@ -86,12 +102,9 @@ char* readline(const char *prompt){
       exitstatus = 1; // didn't terminate normally
     }
 
-    if(exitstatus == 42){
-      system("nc -z localhost 4243");
-      system("nc -z localhost 4243");
-      return readline(prompt);
-    } else {
-      exit(exitstatus);
+    if(exitstatus != 42){
+      // the program's exit handlers have already run in the child
+      _exit(exitstatus);
     }
   }
 }
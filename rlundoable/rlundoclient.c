@@ -0,0 +1,195 @@
+/*
+ * Client for the rewriter's control channel, like rlundo/control.py
+ *
+ * Under rlundo the channel is a socket inherited as the file descriptor in
+ * RLUNDO_CONTROL_FD, shared by every process of the undo chain. A request
+ * is a frame written to it and a save waits for the frame answering it, so
+ * a prompt costs a write and a read rather than running a shell and nc.
+ *
+ * With RLUNDO_MARKERS set requests are written into the output instead,
+ * and a rewriter that only listens on the RLUNDO_SAVE and RLUNDO_RESTORE
+ * sockets gets a connection to one of those for each request.
+*/
+
+#include <errno.h>
+#include <signal.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <unistd.h>
+
+#include "rlundoclient.h"
+
+#ifndef MSG_NOSIGNAL
+  #define MSG_NOSIGNAL 0  // osx, where a closed channel raises SIGPIPE
+#endif
+
+// frame kinds and header size from rlundo/protocol.py
+#define REQUEST 1
+#define REPLY 2
+#define HEADER_SIZE 5
+
+#define MAX_PAYLOAD 4096
+
+static int sent = 0;
+
+static int send_all(int fd, const char *buf, size_t len){
+  while (len > 0){
+    ssize_t n = send(fd, buf, len, MSG_NOSIGNAL);
+    if (n < 0){
+      if (errno == EINTR) continue;
+      return -1;
+    }
+    buf += n;
+    len -= n;
+  }
+  return 0;
+}
+
+// reads exactly len bytes, so nothing meant for the next process of the
+// chain is left behind in this one
+static int recv_all(int fd, char *buf, size_t len){
+  while (len > 0){
+    ssize_t n = recv(fd, buf, len, 0);
+    if (n < 0 && errno == EINTR) continue;
+    if (n <= 0) return -1;
+    buf += n;
+    len -= n;
+  }
+  return 0;
+}
+
+// reads and throws away len bytes, to keep the channel at a frame boundary
+static int discard(int fd, size_t len){
+  char buf[1024];
+  while (len > 0){
+    size_t n = len < sizeof(buf) ? len : sizeof(buf);
+    if (recv_all(fd, buf, n) < 0) return -1;
+    len -= n;
+  }
+  return 0;
+}
+
+static void next_id(char *id, size_t size){
+  snprintf(id, size, "%d.%d", (int)getpid(), ++sent);
+}
+
+static int send_request(int fd, const char *op, const char *id){
+  char frame[HEADER_SIZE + MAX_PAYLOAD];
+  int len = snprintf(frame + HEADER_SIZE, MAX_PAYLOAD, "{\"op\": \"%s\", \"id\": \"%s\"}", op, id);
+  if (len < 0 || len >= MAX_PAYLOAD) return -1;
+  frame[0] = REQUEST;
+  frame[1] = (len >> 24) & 0xff;
+  frame[2] = (len >> 16) & 0xff;
+  frame[3] = (len >> 8) & 0xff;
+  frame[4] = len & 0xff;
+  return send_all(fd, frame, HEADER_SIZE + len);
+}
+
+// skips replies to requests nobody waited for, like Client.wait
+static int wait_reply(int fd, const char *id){
+  char needle[64];
+  char payload[MAX_PAYLOAD + 1];
+  unsigned char header[HEADER_SIZE];
+  snprintf(needle, sizeof(needle), "\"id\": \"%s\"", id);
+  while (1){
+    if (recv_all(fd, (char *)header, HEADER_SIZE) < 0) return -1;
+    uint32_t len = ((uint32_t)header[1] << 24) | (header[2] << 16) | (header[3] << 8) | header[4];
+    if (header[0] != REPLY || len > MAX_PAYLOAD){
+      // not a reply this can read, but the rest of the chain still can
+      discard(fd, len);
+      return -1;
+    }
+    if (recv_all(fd, payload, len) < 0) return -1;
+    payload[len] = '\0';
+    if (strstr(payload, needle)){
+      return strstr(payload, "\"error\"") ? -1 : 0;
+    }
+  }
+}
+
+static int channel_request(int fd, const char *op, int wait){
+  char id[32];
+  next_id(id, sizeof(id));
+  if (send_request(fd, op, id) < 0) return -1;
+  return wait ? wait_reply(fd, id) : 0;
+}
+
+static int marker_request(const char *op){
+  char id[32];
+  next_id(id, sizeof(id));
+  printf("\033]7701;%s;%s\007", op, id);
+  return fflush(stdout) ? -1 : 0;
+}
+
+static int address_request(const char *op){
+  char *addr = NULL;
+  if (!strcmp(op, "save")) addr = getenv("RLUNDO_SAVE");
+  if (!strcmp(op, "restore")) addr = getenv("RLUNDO_RESTORE");
+  if (!addr) return 0;  // nothing to tell this rewriter
+
+  struct sockaddr_un sa;
+  memset(&sa, 0, sizeof(sa));
+  sa.sun_family = AF_UNIX;
+  if (strlen(addr) >= sizeof(sa.sun_path)) return -1;
+  strcpy(sa.sun_path, addr);
+
+  int fd = socket(AF_UNIX, SOCK_STREAM, 0);
+  if (fd < 0) return -1;
+  int result = connect(fd, (struct sockaddr *)&sa, sizeof(sa));
+  if (result == 0){
+    char buf[1024];
+    ssize_t n;
+    do {  // closed once the request has been handled
+      n = recv(fd, buf, sizeof(buf), 0);
+    } while (n > 0 || (n < 0 && errno == EINTR));
+  }
+  close(fd);
+  return result;
+}
+
+static int request(const char *op, int wait){
+  char *markers = getenv("RLUNDO_MARKERS");
+  char *fd = getenv("RLUNDO_CONTROL_FD");
+  // output written before the request has to reach the pty first
+  fflush(stdout);
+  fflush(stderr);
+  if (markers && *markers) return marker_request(op);
+  if (fd) return channel_request(atoi(fd), op, wait);
+  return address_request(op);
+}
+
+int rlundo_save(void){
+  return request("save", 1);
+}
+
+int rlundo_restore(void){
+  return request("restore", 0);
+}
+
+int rlundo_exit(void){
+  return request("exit", 0);
+}
+
+static int job_signals[] = {SIGINT, SIGTSTP, SIGWINCH};
+#define JOB_SIGNALS (sizeof(job_signals) / sizeof(job_signals[0]))
+static struct sigaction saved_actions[JOB_SIGNALS];
+
+void rlundo_ignore_job_signals(void){
+  struct sigaction ignore;
+  memset(&ignore, 0, sizeof(ignore));
+  ignore.sa_handler = SIG_IGN;
+  sigemptyset(&ignore.sa_mask);
+  for (size_t i = 0; i < JOB_SIGNALS; i++){
+    sigaction(job_signals[i], &ignore, &saved_actions[i]);
+  }
+}
+
+void rlundo_restore_job_signals(void){
+  for (size_t i = 0; i < JOB_SIGNALS; i++){
+    sigaction(job_signals[i], &saved_actions[i], NULL);
+  }
+}
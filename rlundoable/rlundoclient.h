@@ -0,0 +1,19 @@
+/*
+ * Tells the rlundo rewriter when to save and restore terminal state.
+ *
+ * Each returns 0, or -1 if the rewriter couldn't be told.
+*/
+
+#ifndef RLUNDOCLIENT_H
+#define RLUNDOCLIENT_H
+
+int rlundo_save(void);     // waits until the snapshot has been taken
+int rlundo_restore(void);  // doesn't wait
+int rlundo_exit(void);     // doesn't wait
+
+// a parked parent ignores the signals for the foreground job, which every
+// process of the chain is in, so only the live child wakes up for them
+void rlundo_ignore_job_signals(void);
+void rlundo_restore_job_signals(void);
+
+#endif
@@ -0,0 +1,376 @@
+"""
+Panes without tmux: bash runs in a pty and everything it writes is fed
+through an in-process terminal emulator.
+
+The functions here take the same arguments as those in test/tmux.py, so
+tests written against one work with the other. Output is read on a
+thread as it arrives and waiting is done on a condition rather than by
+polling, so tests don't sleep and don't need a tmux server; several can
+run at once.
+
+The emulator is rlundo's screen model with two things tmux does that the
+diagram tests depend on: it remembers which rows wrapped, so wrapped rows
+can be joined back into lines, and it reflows lines when the width
+changes.
+"""
+import fcntl
+import os
+import pty
+import select
+import signal
+import struct
+import sys
+import tempfile
+import termios
+import threading
+import time
+
+from .context import rlundo
+from rlundo.screen import Row, Screen
+from .tmux import PaneSnapshot
+
+py2 = sys.version_info.major == 2
+
+SCROLLBACK = 10000
+CURSOR_QUERY = b'\x1b[6n'
+
+
+class Terminal(Screen):
+    """Screen that reflows wrapped lines when resized, like tmux"""
+
+    def __init__(self, width, height):
+        self._wrapped = {}  # id(row): row for rows continued on the next
+        self._wrapping = False
+        Screen.__init__(self, width, height, scrollback=SCROLLBACK)
+
+    def wrapped(self, row):
+        return self._wrapped.get(id(row)) is row
+
+    def _wrap(self):
+        self._wrapping = True
+        try:
+            Screen._wrap(self)
+        finally:
+            self._wrapping = False
+
+    def _linefeed(self):
+        row = self.rows[self.cursor_row]
+        if self._wrapping:
+            self._wrapped[id(row)] = row
+        else:
+            self._wrapped.pop(id(row), None)
+        Screen._linefeed(self)
+
+    def _erase_line(self, mode):
+        if mode in (0, 2):
+            self._wrapped.pop(id(self.rows[self.cursor_row]), None)
+        Screen._erase_line(self, mode)
+
+    def resize(self, width, height):
+        """Resize as tmux does: height first, then reflow to the new width"""
+        if self.main_screen is not None:
+            return Screen.resize(self, width, height)
+        if height < self.height:
+            # rows below the cursor go first, then rows at the top into history
+            below = min(self.height - 1 - self.cursor_row, self.height - height)
+            del self.rows[self.height - below:]
+            lost = len(self.rows) - height
+            self.history.extend(self.rows[:lost])
+            del self.rows[:lost]
+            self.cursor_row -= lost
+        elif height > self.height:
+            # rows come back out of history before blank rows are added
+            pulled = min(len(self.history), height - self.height)
+            self.rows[:0] = [self.history.pop() for _ in range(pulled)][::-1]
+            self.cursor_row += pulled
+            self.rows += [Row(self.width) for _ in range(height - len(self.rows))]
+        self.height = height
+        if width != self.width:
+            self._reflow(width)
+        self.cursor_col = min(self.cursor_col, width - 1)
+        self.wrap_pending = False
+        self.top, self.bottom = 0, height - 1
+        self.generation += 1
+
+    def _reflow(self, width):
+        rows = list(self.history) + self.rows
+        cursor = len(self.history) + self.cursor_row
+        lines = []  # (chars, attrs, rows the line needs at least)
+        chars, attrs = [], []
+        for i, row in enumerate(rows):
+            if i == cursor:
+                offset = len(chars) + self.cursor_col
+                cursor_line = len(lines)
+            if self.wrapped(row):
+                chars += row.chars
+                attrs += row.attrs
+                continue
+            end = row.content_end()
+            chars += row.chars[:end]
+            attrs += row.attrs[:end]
+            lines.append((chars, attrs))
+            chars, attrs = [], []
+        if chars:
+            lines.append((chars, attrs))
+
+        new_rows = []
+        self._wrapped = {}
+        for n, (chars, attrs) in enumerate(lines):
+            length = len(chars)
+            if n == cursor_line:
+                cursor = len(new_rows) + offset // width
+                self.cursor_col = offset % width
+                length = max(length, offset + 1)
+            for start in range(0, max(length, 1), width):
+                if start:
+                    self._wrapped[id(new_rows[-1])] = new_rows[-1]
+                new_rows.append(Row(0, chars[start:start + width], attrs[start:start + width])
+                                .resized(width))
+        new_rows += [Row(width) for _ in range(self.height - len(new_rows))]
+
+        history_height = len(new_rows) - self.height
+        self.history.clear()
+        self.history.extend(new_rows[:history_height])
+        self.rows = new_rows[history_height:]
+        self.cursor_row = cursor - history_height
+        if self.cursor_row < 0:
+            self.cursor_row = self.cursor_col = 0
+        self.width = width
+
+    def lines(self):
+        """Text of each line of history and screen, wrapped rows joined"""
+        lines = []
+        current = u''
+        for row in list(self.history) + self.rows:
+            if self.wrapped(row):
+                current += row.text()
+            else:
+                lines.append(current + row.text().rstrip())
+                current = u''
+        return lines
+
+
+def _strip_trailing_blanks(lines):
+    lines = list(lines)
+    while lines and lines[-1] == u'':
+        lines.pop()
+    return lines
+
+
+class HeadlessPane(object):
+    """bash in a pty, read into a Terminal; use as a context manager
+
+    Entering returns the pane, which has send_keys and enter like a tmux
+    pane. Pass it to the functions below."""
+
+    def __init__(self, width=80, height=24):
+        self.width = width
+        self.height = height
+        self.tempfiles_to_close = []
+
+    def bash_config_contents(self):
+        return """export PS1='$'"""
+
+    def tempfile(self, contents, suffix=''):
+        tmp = tempfile.NamedTemporaryFile(suffix=suffix)
+        self.tempfiles_to_close.append(tmp)
+        if py2:
+            tmp.write(contents)
+        else:
+            tmp.write(contents.encode('utf8'))
+        tmp.flush()
+        return tmp
+
+    def __enter__(self):
+        self.bash_config = self.tempfile(self.bash_config_contents())
+        self.terminal = Terminal(self.width, self.height)
+        self.changed = threading.Condition()
+        self.closing = False
+        self.received = 0  # chunks of output read
+        self._held = b''
+        self.pid, self.fd = pty.fork()
+        if self.pid == pty.CHILD:
+            try:
+                fcntl.ioctl(0, termios.TIOCSWINSZ,
+                            struct.pack('HHHH', self.height, self.width, 0, 0))
+                os.environ['TERM'] = 'xterm'
+                os.execvp('bash', ['bash', '--rcfile', self.bash_config.name, '--noprofile'])
+            finally:
+                os._exit(1)
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+        wait_for_prompt(self)
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.closing = True
+        self.reader.join()
+        os.close(self.fd)  # hangs up the pty, which ends what bash was running
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        os.waitpid(self.pid, 0)
+        for file in self.tempfiles_to_close:
+            file.close()
+
+    def _read(self):
+        while not self.closing:
+            if not select.select([self.fd], [], [], .05)[0]:
+                continue
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError:
+                data = b''
+            with self.changed:
+                if data:
+                    self._feed(data)
+                    self.received += 1
+                else:
+                    self.closing = True
+                self.changed.notify_all()
+
+    def _feed(self, data):
+        """Feed output to the terminal, answering cursor position queries"""
+        parts = (self._held + data).split(CURSOR_QUERY)
+        self._held = b''
+        last = parts[-1]
+        for i in range(len(CURSOR_QUERY) - 1, 0, -1):
+            if last.endswith(CURSOR_QUERY[:i]):
+                parts[-1], self._held = last[:-i], last[-i:]
+                break
+        for i, part in enumerate(parts):
+            self.terminal.feed(part)
+            if i < len(parts) - 1:
+                os.write(self.fd, ('\x1b[%d;%dR' % (self.terminal.cursor_row + 1,
+                                                    self.terminal.cursor_col + 1)).encode('ascii'))
+
+    def send_keys(self, cmd, enter=True, suppress_history=True):
+        """Like tmuxp, a leading space keeps cmd out of bash's history"""
+        self._type(((u' ' if suppress_history else u'') + cmd).encode('utf8'))
+        if enter:
+            self.enter()
+
+    def enter(self):
+        self._type(b'\r')
+
+    def _type(self, keys, max=.5):
+        """Write keys and wait for whatever is echoed in response
+
+        tmux is slow enough that an echo has always arrived by the time the
+        cursor is next looked at; here it has to be waited for."""
+        with self.changed:
+            received = self.received
+            os.write(self.fd, keys)
+            deadline = time.time() + max
+            while self.received == received and not self.closing:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.changed.wait(remaining)
+
+    def resize(self, width, height):
+        with self.changed:
+            self.terminal.resize(width, height)
+            fcntl.ioctl(self.fd, termios.TIOCSWINSZ, struct.pack('HHHH', height, width, 0, 0))
+            self.width, self.height = width, height
+
+    def wait(self, query, condition, max=1):
+        """Value of query() once condition(value) is true
+
+        Raises ValueError with the last value if it isn't within max seconds."""
+        deadline = time.time() + max
+        with self.changed:
+            while True:
+                last = query(self)
+                if condition(last):
+                    return last
+                remaining = deadline - time.time()
+                if remaining <= 0 or self.closing:
+                    raise ValueError("condition was never true within max time: %r\n%s" % (
+                        last, '\n'.join(self.terminal.display())))
+                self.changed.wait(remaining)
+
+
+def all_contents(pane):
+    with pane.changed:
+        term = pane.terminal
+        return _strip_trailing_blanks(row.text().rstrip() for row in list(term.history) + term.rows)
+
+
+def all_lines(pane):
+    with pane.changed:
+        return _strip_trailing_blanks(pane.terminal.lines())
+
+
+def scrollback(pane):
+    with pane.changed:
+        return [row.text().rstrip() for row in pane.terminal.history]
+
+
+def visible(pane):
+    with pane.changed:
+        return _strip_trailing_blanks(pane.terminal.display())
+
+
+def cursor_pos(pane):
+    """Returns zero-indexed cursor position"""
+    with pane.changed:
+        return pane.terminal.cursor_row, pane.terminal.cursor_col
+
+
+def snapshot(pane):
+    """Size, cursor and contents of pane, all from the same moment"""
+    with pane.changed:
+        term = pane.terminal
+        contents = all_contents(pane)
+        shown = visible(pane)
+        return PaneSnapshot(term.width, term.height, cursor_pos(pane), shown,
+                            scrollback(pane), contents, all_lines(pane))
+
+
+def width(pane):
+    return pane.terminal.width
+
+
+def height(pane):
+    return pane.terminal.height
+
+
+def wait_for_condition(pane, final, query, condition=lambda x, y: x == y,
+                       interval=None, max=1):
+    """Wait until condition(query(pane), final) is true"""
+    pane.wait(query, lambda last: condition(last, final), max=max)
+
+
+def visible_after_prompt(pane, expected=u'$', interval=None, max=1):
+    """Return the visible region once expected is found on last line"""
+    return pane.wait(visible, lambda screen: screen and screen[-1] == expected, max=max)
+
+
+def wait_for_prompt(pane, expected=u'$', interval=None, max=2):
+    visible_after_prompt(pane, expected=expected, max=max)
+
+
+def wait_until_cursor_moves(pane, row, col, interval=None, max=1):
+    pane.wait(cursor_pos, lambda pos: pos != (row, col), max=max)
+
+
+def send_command(pane, cmd, enter=True, prompt=u'$', maxtime=2):
+    if not isinstance(enter, bool):
+        raise ValueError("enter should be a bool, got %r" % (enter, ))
+    row, col = cursor_pos(pane)
+    pane.send_keys(cmd, enter=False, suppress_history=False)
+    wait_until_cursor_moves(pane, row, col)
+    if enter:
+        pane.enter()
+    wait_for_prompt(pane, expected=prompt, max=maxtime)
+
+
+def resize_width(pane, final_width):
+    pane.resize(final_width, pane.height)
+
+
+def resize_height(pane, final_height):
+    pane.resize(pane.width, final_height)
@@ -108,15 +108,26 @@ class TerminalState(_TerminalStateBase):
     @classmethod
     def from_tmux_pane(cls, pane):
         from . import tmux
-        lines = tmux.all_lines(pane)
-        history_height = len(tmux.scrollback(pane))
-        print('tmux.all_contents:', tmux.all_contents(pane))
-        print('tmux.visible:', tmux.visible(pane))
+        return cls.from_pane(pane, tmux)
+
+    @classmethod
+    def from_headless_pane(cls, pane):
+        from . import headless
+        return cls.from_pane(pane, headless)
+
+    @classmethod
+    def from_pane(cls, pane, term):
+        """State of pane, queried with the functions of module term"""
+        snapshot = term.snapshot(pane)
+        lines = snapshot.lines
+        history_height = len(snapshot.scrollback)
+        print('all_contents:', snapshot.contents)
+        print('visible:', snapshot.visible)
         print('history_height:', history_height)
-        print('tmux.scrollback:', tmux.scrollback(pane))
-        width, height = tmux.width(pane), tmux.height(pane)
+        print('scrollback:', snapshot.scrollback)
+        width, height = snapshot.width, snapshot.height
 
-        cursor_row, cursor_col = tmux.cursor_pos(pane)
+        cursor_row, cursor_col = snapshot.cursor
 
         #TODO deal with cursors not at the bottom
 
@@ -0,0 +1,122 @@
+from __future__ import unicode_literals
+
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from .context import rlundo
+from rlundo import apity
+from rlundo import control
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+async def read_all(proc):
+    chunks = []
+    while True:
+        data = await proc.read()
+        if not data:
+            return b''.join(chunks)
+        chunks.append(data)
+
+
+class TestAspawn(unittest.TestCase):
+    def test_read_write(self):
+        async def session():
+            proc = await apity.aspawn(['sh', '-c', 'read x; echo "got $x"'])
+            proc.write(b'hello\r')
+            output = await read_all(proc)
+            return output, await proc.wait()
+
+        output, status = asyncio.run(session())
+        self.assertIn(b'got hello', output)
+        self.assertEqual(status, 0)
+
+    def test_wait_without_pidfds(self):
+        async def session():
+            proc = await apity.aspawn(['sh', '-c', 'exit 3'])
+            await read_all(proc)
+            return await proc.wait()
+
+        with mock.patch.object(os, 'pidfd_open', side_effect=OSError, create=True):
+            self.assertEqual(os.WEXITSTATUS(asyncio.run(session())), 3)
+        self.assertEqual(apity._sigchld_waiting, {})
+
+    def test_resize(self):
+        async def session():
+            proc = await apity.aspawn(['sh', '-c', 'read x; stty size'],
+                                      size=(24, 80))
+            proc.resize(30, 100)
+            proc.write(b'\r')
+            output = await read_all(proc)
+            await proc.wait()
+            return output
+
+        self.assertIn(b'30 100', asyncio.run(session()))
+
+    def test_master_read_and_listeners(self):
+        addr = os.path.join(tempfile.mkdtemp(), 'save')
+        sock = socket.socket(socket.AF_UNIX)
+        sock.bind(addr)
+        sock.listen(1)
+        seen = []
+        saves = []
+
+        def master_read(fd):
+            data = os.read(fd, 1024)
+            seen.append(data)
+            return data
+
+        async def session():
+            loop = asyncio.get_event_loop()
+            proc = await apity.aspawn(
+                ['sh', '-c', 'printf before; read x; echo after'],
+                master_read=master_read,
+                listeners={sock: lambda: saves.append(proc.drain())})
+
+            client = socket.socket(socket.AF_UNIX)
+            client.setblocking(False)
+            await loop.sock_connect(client, addr)
+            self.assertEqual(await loop.sock_recv(client, 1), b'')
+            client.close()
+            proc.write(b'\r')
+            output = await read_all(proc)
+            await proc.wait()
+            return output
+
+        try:
+            output = asyncio.run(session())
+        finally:
+            sock.close()
+            os.remove(addr)
+        self.assertEqual(saves, [True])
+        self.assertEqual(b''.join(seen), output)
+        self.assertIn(b'after', output)
+
+    def test_channels(self):
+        saves = []
+        server = control.Server({}, lambda: len(saves))
+        program = ('import sys; sys.path.insert(0, %r); from rlundo import control; '
+                   'print("before"); control.save(); print("after")' % (ROOT, ))
+        env = dict(os.environ)
+        env.update(server.environ())
+
+        async def session():
+            proc = await apity.aspawn([sys.executable, '-c', program], env=env,
+                                      channels={server.sock: server.serve})
+            server.spawned()
+            server.handlers['save'] = lambda: saves.append(proc.drain())
+            output = await read_all(proc)
+            await proc.wait()
+            return output
+
+        try:
+            output = asyncio.run(session())
+        finally:
+            server.close()
+        self.assertEqual(saves, [True])
+        self.assertIn(b'after', output)
@@ -0,0 +1,188 @@
+from __future__ import unicode_literals
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from .context import rlundo
+from rlundo import control, protocol
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+RLUNDOABLE = os.path.join(ROOT, 'rlundoable')
+
+
+class TestControl(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.server = control.Server(
+            {'save': lambda: self.calls.append('save'),
+             'restore': lambda: self.calls.append('restore')},
+            lambda: len(self.calls))
+        self.addCleanup(self.server.close)
+
+    def test_pipelined_replies(self):
+        client = control.Client(self.server.child)
+        client.send('save')
+        restore = client.send('restore')
+        self.assertTrue(self.server.serve())
+        # the reply to the save nobody waited for is skipped
+        self.assertEqual(client.wait(restore), {'id': restore, 'snapshots': 2})
+        self.assertEqual(self.calls, ['save', 'restore'])
+
+    def test_request_fields(self):
+        client = control.Client(self.server.child)
+        self.server.handlers['save'] = lambda levels: {'release': levels - 2}
+        id = client.send('save', levels=3)
+        self.server.serve()
+        self.assertEqual(client.wait(id), {'id': id, 'snapshots': 0, 'release': 1})
+
+    def test_unknown_op(self):
+        client = control.Client(self.server.child)
+        id = client.send('rewind')
+        self.server.serve()
+        with self.assertRaises(control.ControlError):
+            client.wait(id)
+
+    def test_reads_one_reply_at_a_time(self):
+        """Replies for the next process to wait are left on the channel"""
+        first, second = control.Client(self.server.child), control.Client(self.server.child)
+        second.sent = 100
+        save, restore = first.send('save'), second.send('restore')
+        self.server.serve()
+        self.assertEqual(first.wait(save), {'id': save, 'snapshots': 1})
+        self.assertEqual(second.wait(restore), {'id': restore, 'snapshots': 2})
+
+    def test_malformed_request(self):
+        self.server.child.sendall(protocol.frame(protocol.REQUEST, b'{"op": "sa'))
+        self.assertTrue(self.server.serve())
+        kind, payload = protocol.recv_frame(self.server.child)
+        self.assertEqual(kind, protocol.REPLY)
+        self.assertIn('not JSON', protocol.decode(payload)['error'])
+
+    def test_handler_error(self):
+        def fail():
+            raise OSError('no terminal')
+        self.server.handlers['restore'] = fail
+        client = control.Client(self.server.child)
+        id = client.send('restore')
+        self.assertTrue(self.server.serve())
+        with self.assertRaises(control.ControlError):
+            client.wait(id)
+        # and the channel still works
+        save = client.send('save')
+        self.server.serve()
+        self.assertEqual(client.wait(save), {'id': save, 'snapshots': 1})
+
+    def test_undo_chain(self):
+        """Processes forked from the interpreter share its end of the channel"""
+        program = ('import os, sys; sys.path.insert(0, %r); from rlundo import control; '
+                   'control.save(); pid = os.fork()\n'
+                   'if pid == 0: control.save(); control.restore(); os._exit(0)\n'
+                   'os.waitpid(pid, 0); control.save()' % (ROOT, ))
+        env = dict(os.environ)
+        env.update(self.server.environ())
+        child = subprocess.Popen([sys.executable, '-c', program], env=env,
+                                 pass_fds=(self.server.child_fd, ))
+        self.server.spawned()
+        while self.server.serve():
+            pass
+        self.assertEqual(child.wait(timeout=10), 0)
+        self.assertEqual(self.calls, ['save', 'save', 'restore', 'save'])
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'LD_PRELOAD interposer')
+class TestNativeClient(unittest.TestCase):
+    """rlundoable.c speaks the control protocol through rlundoclient.c"""
+
+    def setUp(self):
+        self.build = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.build)
+        try:
+            subprocess.check_output(
+                ['gcc', '-Wall', '-fPIC', '-shared', '-o', self.path('librlundoable.so'),
+                 os.path.join(RLUNDOABLE, 'rlundoable.c'),
+                 os.path.join(RLUNDOABLE, 'rlundoclient.c'), '-ldl'],
+                stderr=subprocess.STDOUT)
+            subprocess.check_output(
+                ['gcc', '-o', self.path('test.out'), os.path.join(RLUNDOABLE, 'test.c'),
+                 '-lreadline'], stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.skipTest('could not build rlundoable: %s' % (getattr(e, 'output', e), ))
+
+    def path(self, name):
+        return os.path.join(self.build, name)
+
+    def test_undo_chain(self):
+        calls = []
+        server = control.Server(dict((op, lambda op=op: calls.append(op))
+                                     for op in ('save', 'restore', 'exit')),
+                                lambda: len(calls))
+        self.addCleanup(server.close)
+        env = dict(os.environ, LD_PRELOAD=self.path('librlundoable.so'))
+        env.update(server.environ())
+        child = subprocess.Popen([self.path('test.out')], env=env, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, pass_fds=(server.child_fd, ))
+        server.spawned()
+        child.stdin.write(b'a\nundo\n')
+        child.stdin.close()
+        while server.serve():
+            pass
+        output = child.stdout.read()
+        child.stdout.close()
+        self.assertEqual(child.wait(timeout=10), 0)
+        self.assertEqual(calls, ['save', 'save', 'restore', 'save', 'exit'])
+        self.assertIn(b"undoing 'a'", output)
+
+    def test_reply_too_large(self):
+        source = self.path('saves.c')
+        with open(source, 'w') as f:
+            f.write('#include <stdio.h>\n#include "rlundoclient.h"\n'
+                    'int main(void){ int a = rlundo_save(); int b = rlundo_save(); '
+                    'printf("%d %d", a, b); return 0; }\n')
+        subprocess.check_output(
+            ['gcc', '-I', RLUNDOABLE, '-o', self.path('saves.out'), source,
+             os.path.join(RLUNDOABLE, 'rlundoclient.c')], stderr=subprocess.STDOUT)
+        saves = []
+
+        def save():
+            saves.append(None)
+            if len(saves) == 1:
+                return {'padding': 'x' * 5000}
+        server = control.Server({'save': save}, lambda: len(saves))
+        self.addCleanup(server.close)
+        env = dict(os.environ)
+        env.update(server.environ())
+        child = subprocess.Popen([self.path('saves.out')], env=env,
+                                 stdout=subprocess.PIPE, pass_fds=(server.child_fd, ))
+        server.spawned()
+        while server.serve():
+            pass
+        output = child.stdout.read()
+        child.stdout.close()
+        self.assertEqual(child.wait(timeout=10), 0)
+        # the first reply is too large to read, but it's read past, so the
+        # second save still gets its own reply
+        self.assertEqual(output, b'-1 0')
+
+
+class TestMarkerParser(unittest.TestCase):
+    def test_markers_across_chunks(self):
+        parser = control.MarkerParser()
+        data = b'a' + control.marker('save', '1.1') + b'b\x1b]7701;restore;1.2\x1b\\c'
+        pieces = []
+        for i in range(len(data)):
+            pieces += parser.feed(data[i:i + 1])
+        output = [p for p in pieces if isinstance(p, bytes)]
+        markers = [p for p in pieces if not isinstance(p, bytes)]
+        self.assertEqual(b''.join(output), b'abc')
+        self.assertEqual(markers, [('save', '1.1'), ('restore', '1.2')])
+
+    def test_other_sequences_pass_through(self):
+        parser = control.MarkerParser()
+        title = b'\x1b]0;title\x07\x1b[1mbold'
+        self.assertEqual(parser.feed(title), [title])
+        unterminated = control.MARKER + b'x' * control.MAX_MARKER
+        self.assertEqual(b''.join(parser.feed(unterminated)), unterminated)
@@ -0,0 +1,115 @@
+from __future__ import unicode_literals
+
+import os
+import pty
+import select
+import threading
+import tty
+import unittest
+
+from .context import rlundo
+from rlundo.findcursor import (CursorPositionTimeout, CursorReportParser,
+                               InputDemux)
+
+
+class TestCursorReportParser(unittest.TestCase):
+    def test_split_everywhere(self):
+        data = b'ab\x1b[A\x1b[12;40Rcd\x1b'
+        for i in range(len(data) + 1):
+            parser = CursorReportParser()
+            first, reports = parser.feed(data[:i])
+            rest, more = parser.feed(data[i:])
+            self.assertEqual((first + rest, reports + more),
+                             (b'ab\x1b[Acd', [(11, 39)]))
+            self.assertEqual(parser.flush(), b'\x1b')
+
+    def test_other_escape_sequences(self):
+        parser = CursorReportParser()
+        self.assertEqual(parser.feed(b'\x1b[1;5C\x1b[2'), (b'\x1b[1;5C', []))
+        self.assertEqual(parser.feed(b'~'), (b'\x1b[2~', []))
+
+
+class TestInputDemux(unittest.TestCase):
+    def setUp(self):
+        self.forwarded = []
+        self.demux = InputDemux(self.forwarded.append)
+
+    def test_passes_everything_when_not_expecting(self):
+        self.assertEqual(self.demux.feed(b'\x1b[1;2R'), b'\x1b[1;2R')
+
+    def test_keystrokes_around_reply(self):
+        terminal, app = pty.openpty()
+        tty.setraw(app)
+
+        def reply():
+            self.assertEqual(os.read(terminal, 4), b'\x1b[6n')
+            os.write(terminal, b'ls\x1b[3;')
+            os.write(terminal, b'7Rx\x1b[D')
+        thread = threading.Thread(target=reply)
+        thread.start()
+        try:
+            self.assertEqual(self.demux.get_cursor_position(app, app), (2, 6))
+            thread.join()
+            # whatever the demux didn't read is still waiting
+            while select.select([app], [], [], 0)[0]:
+                self.forwarded.append(os.read(app, 10))
+            self.assertEqual(b''.join(self.forwarded), b'lsx\x1b[D')
+            self.assertEqual(self.demux.feed(b'\x1b[3;7R'), b'\x1b[3;7R')
+        finally:
+            thread.join()
+            os.close(terminal)
+            os.close(app)
+
+    def test_timeout(self):
+        terminal, app = pty.openpty()
+        tty.setraw(app)
+        os.write(terminal, b'q\x1b[')
+        try:
+            with self.assertRaises(CursorPositionTimeout):
+                self.demux.get_cursor_position(app, app, timeout=.05)
+            self.assertEqual(b''.join(self.forwarded), b'q\x1b[')
+            # the late reply is still recognized
+            self.assertEqual(self.demux.feed(b'\x1b[1;1Rz'), b'z')
+        finally:
+            os.close(terminal)
+            os.close(app)
+
+    def test_escape_key_while_late_reply_may_come(self):
+        terminal, app = pty.openpty()
+        tty.setraw(app)
+        try:
+            with self.assertRaises(CursorPositionTimeout):
+                self.demux.get_cursor_position(app, app, timeout=.05)
+            # held back in case it's the reply, until there's nothing more to read
+            self.assertEqual(self.demux.feed(b'\x1b'), b'')
+            self.assertEqual(self.demux.flush_keys(), b'\x1b')
+            self.assertEqual(self.demux.feed(b'\x1b['), b'')
+            self.assertEqual(self.demux.flush_keys(), b'\x1b[')
+            # more of a report than a key sends is still waited on
+            self.assertEqual(self.demux.feed(b'\x1b[1;'), b'')
+            self.assertEqual(self.demux.flush_keys(), b'')
+            self.assertEqual(self.demux.feed(b'1Rz'), b'z')
+        finally:
+            os.close(terminal)
+            os.close(app)
+
+    def test_late_reply_doesnt_answer_next_query(self):
+        terminal, app = pty.openpty()
+        tty.setraw(app)
+
+        def reply():
+            self.assertEqual(os.read(terminal, 4), b'\x1b[6n')
+            # the first query's reply arrives only after the second query
+            os.write(terminal, b'\x1b[1;1R\x1b[5;9R')
+        try:
+            with self.assertRaises(CursorPositionTimeout):
+                self.demux.get_cursor_position(app, app, timeout=.05)
+            self.assertEqual(os.read(terminal, 4), b'\x1b[6n')
+            thread = threading.Thread(target=reply)
+            thread.start()
+            self.assertEqual(self.demux.get_cursor_position(app, app), (4, 8))
+            thread.join()
+            self.assertEqual(b''.join(self.forwarded), b'')
+        finally:
+            os.close(terminal)
+            os.close(app)
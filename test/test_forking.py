@@ -0,0 +1,312 @@
+from __future__ import unicode_literals
+
+import fcntl
+import gc
+import json
+import os
+import pty
+import signal
+import struct
+import subprocess
+import sys
+import termios
+import unittest
+
+from .context import rlundo
+from rlundo import forking
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# undoes UNDOS commands, then runs DEPTH commands deep; the last process
+# prints the file descriptors and resident pages of the root after the
+# undos and of every process of the chain
+CHAIN = """
+import json, os, sys
+sys.path.insert(0, %r)
+from rlundo import forking
+
+def usage():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return len(os.listdir('/proc/self/fd')), pages
+
+before = usage()
+for i in range(%d):
+    if forking.fork() == 0:
+        forking.tell_parent(b'undo')
+        os._exit(0)
+    assert forking.wait_for_child() == b'undo'
+    forking.resume()
+usages = [before, usage()]
+for i in range(%d):
+    if forking.fork() != 0:
+        forking.tell_parent(forking.wait_for_child())
+        os._exit(0)
+    usages.append(usage())
+print(json.dumps(usages))
+sys.stdout.flush()
+forking.tell_parent(b'exit')
+os._exit(0)
+"""
+
+
+class TestFork(unittest.TestCase):
+    def tearDown(self):
+        gc.enable()
+        gc.unfreeze()
+
+    def test_parked_parent_does_not_collect(self):
+        read_fd, write_fd = os.pipe()
+        pid = forking.fork()
+        if pid == 0:
+            os.write(write_fd, b'y' if gc.isenabled() else b'n')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read_fd, 1), b'y')
+        os.close(read_fd)
+        os.close(write_fd)
+        self.assertFalse(gc.isenabled())
+        self.assertGreater(gc.get_freeze_count(), 0)
+        forking.resume()
+        self.assertTrue(gc.isenabled())
+
+    def test_only_the_root_freezes(self):
+        read_fd, write_fd = os.pipe()
+        pid = forking.fork()
+        if pid == 0:
+            frozen = gc.get_freeze_count()
+            lines = [[line] for line in range(1000)]
+            if forking.fork() == 0:
+                os.write(write_fd, b'y' if gc.get_freeze_count() == frozen else b'n')
+                os._exit(0)
+            os.wait()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read_fd, 1), b'y')
+        os.close(read_fd)
+        os.close(write_fd)
+        forking.resume()
+
+# runs DEPTH commands deep with handlers that print the pid of whichever
+# process runs them, and waits for a line of input at the bottom
+SIGNALS = """
+import os, signal, sys
+sys.path.insert(0, %r)
+from rlundo import forking
+
+def handler(sig, frame):
+    os.write(1, ('%%d\\n' %% (os.getpid(), )).encode('ascii'))
+
+signal.signal(signal.SIGINT, handler)
+signal.signal(signal.SIGWINCH, handler)
+for i in range(%d):
+    if forking.fork() != 0:
+        forking.tell_parent(forking.wait_for_child())
+        os._exit(0)
+os.write(1, ('ready %%d %%s\\n' %% (os.getpid(), ' '.join(map(str, forking.ancestors)))
+          ).encode('ascii'))
+sys.stdin.readline()
+forking.tell_parent(b'exit')
+os._exit(0)
+"""
+
+# parks the root for a child that waits for a line, then undoes it; the
+# SIGWINCH handler prints the pid that runs it and the size it sees
+RESIZE = """
+import fcntl, os, signal, struct, sys, termios
+sys.path.insert(0, %r)
+from rlundo import forking
+
+def handler(sig, frame):
+    rows, columns = struct.unpack('hh', fcntl.ioctl(0, termios.TIOCGWINSZ, b'\\0' * 4))
+    os.write(1, ('%%d %%dx%%d\\n' %% (os.getpid(), columns, rows)).encode('ascii'))
+
+signal.signal(signal.SIGWINCH, handler)
+if forking.fork() == 0:
+    os.write(1, ('ready %%d\\n' %% (os.getpid(), )).encode('ascii'))
+    sys.stdin.readline()
+    forking.tell_parent(b'undo')
+    os._exit(0)
+assert forking.wait_for_child() == b'undo'
+forking.resume()
+os.write(1, b'resumed\\n')
+"""
+
+# runs DEPTH commands deep and exits, printing the pid of every process
+# that runs interpreter shutdown
+EXIT = """
+import atexit, os, sys
+sys.path.insert(0, %r)
+from rlundo import forking
+
+atexit.register(lambda: os.write(1, ('%%d\\n' %% (os.getpid(), )).encode('ascii')))
+for i in range(%d):
+    if forking.fork() != 0:
+        assert forking.wait_for_child() == b'exit'
+        sys.exit()
+forking.end_chain()
+sys.exit()
+"""
+
+
+class TestExit(unittest.TestCase):
+    def test_chain_exits_at_once(self):
+        chain = subprocess.Popen([sys.executable, '-c', EXIT % (ROOT, 300)],
+                                 stdout=subprocess.PIPE)
+        output, _ = chain.communicate(timeout=60)
+        self.assertEqual(chain.returncode, 0)
+        shut_down = [int(pid) for pid in output.split()]
+        # the last process and the root, in either order, not the 299
+        # parked in between
+        self.assertEqual(len(shut_down), 2)
+        self.assertIn(chain.pid, shut_down)
+
+
+# reads a line at a time from stdin, forking to "run" it like the shims,
+# and prints its pid and the lines it has run at each prompt
+REDO = """
+import json, os, sys
+sys.path.insert(0, %r)
+from rlundo import forking
+
+def readline():
+    line = b''
+    while not line.endswith(b'\\n'):
+        c = os.read(0, 1)  # unbuffered, since every process reads stdin
+        if not c:
+            return None
+        line += c
+    return line.strip().decode('ascii')
+
+ran = []
+while True:
+    os.write(1, (json.dumps([os.getpid(), ran]) + '\\n').encode('ascii'))
+    line = readline()
+    if line is None:
+        forking.end_chain()
+        os._exit(0)
+    if line == 'undo':
+        if not forking.park_for_redo():
+            forking.tell_parent(b'undo')
+            os._exit(0)
+        continue
+    if forking.can_redo(line):
+        pid = forking.redo()
+    else:
+        pid = forking.fork(line)
+    if pid == 0:
+        ran.append(line)
+        continue
+    if forking.wait_for_child() == b'exit':
+        os._exit(0)
+    forking.resume()
+"""
+
+
+class TestRedo(unittest.TestCase):
+    def prompts(self, lines, max_redo):
+        env = dict(os.environ, RLUNDO_MAX_REDO=str(max_redo))
+        chain = subprocess.Popen([sys.executable, '-c', REDO % (ROOT, )], env=env,
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        stdin = ''.join(line + '\n' for line in lines).encode('ascii')
+        output, _ = chain.communicate(stdin, timeout=30)
+        self.assertEqual(chain.returncode, 0)
+        return [json.loads(line) for line in output.decode('ascii').splitlines()]
+
+    def test_redo_resumes_undone_process(self):
+        prompts = self.prompts(['a', 'b', 'undo', 'undo', 'redo', 'b', 'undo', 'c',
+                                'undo', 'undo', 'd'], max_redo=2)
+        pids = [pid for pid, ran in prompts]
+        self.assertEqual([ran for pid, ran in prompts],
+                         [[], ['a'], ['a', 'b'], ['a'], [], ['a'], ['a', 'b'], ['a'],
+                          ['a', 'c'], ['a'], [], ['d']])
+        # redo, and entering the undone line again, resume the same processes
+        self.assertEqual(pids[5], pids[1])
+        self.assertEqual(pids[6], pids[2])
+        # new input runs
+        self.assertNotIn(pids[8], pids[:8])
+        self.assertNotIn(pids[11], pids[:11])
+
+    def test_redo_is_bounded(self):
+        prompts = self.prompts(['a', 'b', 'undo', 'undo', 'a', 'b'], max_redo=1)
+        pids = [pid for pid, ran in prompts]
+        self.assertEqual([ran for pid, ran in prompts],
+                         [[], ['a'], ['a', 'b'], ['a'], [], ['a'], ['a', 'b']])
+        self.assertEqual(pids[5], pids[1])
+        # the first undone was let go to keep one
+        self.assertNotEqual(pids[6], pids[2])
+
+    def test_redo_off(self):
+        prompts = self.prompts(['a', 'undo', 'a'], max_redo=0)
+        self.assertEqual([ran for pid, ran in prompts], [[], ['a'], [], ['a']])
+        self.assertNotEqual(prompts[3][0], prompts[1][0])
+
+
+def context_switches(pid):
+    """Times pid has been switched to, so how often it has woken up"""
+    with open('/proc/%d/status' % (pid, )) as f:
+        return sum(int(line.split()[1]) for line in f if 'ctxt_switches:' in line)
+
+
+class TestSignals(unittest.TestCase):
+    def test_only_live_child_handles_job_signals(self):
+        chain = subprocess.Popen([sys.executable, '-c', SIGNALS % (ROOT, 200)],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 start_new_session=True)
+        ready = chain.stdout.readline().split()
+        self.assertEqual(ready[0], b'ready')
+        parked = [chain.pid] + [int(pid) for pid in ready[2:]]
+        self.assertEqual(len(parked), 200)
+        if os.path.exists('/proc/self/status'):
+            before = [context_switches(pid) for pid in parked]
+        for _ in range(10):
+            os.killpg(chain.pid, signal.SIGINT)
+            os.killpg(chain.pid, signal.SIGWINCH)
+        if os.path.exists('/proc/self/status'):
+            # what the signals cost the parked processes: they never ran
+            self.assertEqual([context_switches(pid) for pid in parked], before)
+        output, _ = chain.communicate(b'\n', timeout=30)
+        handled = output.split()
+        self.assertTrue(handled)
+        # one process woke up, not the 200 parked above it
+        self.assertEqual(set(handled), set([ready[1]]))
+
+    def test_resized_while_parked(self):
+        master, slave = pty.openpty()
+        set_size = lambda rows, columns: fcntl.ioctl(
+            master, termios.TIOCSWINSZ, struct.pack('HHHH', rows, columns, 0, 0))
+        set_size(24, 80)
+        # a session of its own, with the pty as its controlling terminal
+        chain = subprocess.Popen([sys.executable, '-c', RESIZE % (ROOT, )],
+                                 stdin=slave, stdout=subprocess.PIPE,
+                                 start_new_session=True,
+                                 preexec_fn=lambda: os.close(os.open(os.ttyname(0), os.O_RDWR)))
+        os.close(slave)
+        try:
+            ready = chain.stdout.readline().split()
+            self.assertEqual(ready[0], b'ready')
+            set_size(30, 100)
+            self.assertEqual(chain.stdout.readline().split(), [ready[1], b'100x30'])
+            os.write(master, b'\n')  # undo
+            output, _ = chain.communicate(timeout=30)
+        finally:
+            os.close(master)
+        # the root, resumed, handles the resize it missed while parked
+        self.assertEqual(output.splitlines(),
+                         [('%d 100x30' % (chain.pid, )).encode('ascii'), b'resumed'])
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/fd'), 'needs /proc')
+class TestChainResources(unittest.TestCase):
+    def test_constant_per_level(self):
+        output = subprocess.check_output([sys.executable, '-c', CHAIN % (ROOT, 10000, 500)],
+                                         timeout=300)
+        usages = json.loads(output.decode('ascii'))
+        (before_fds, before_pages), (after_fds, after_pages) = usages[:2]
+        self.assertEqual(after_fds, before_fds)
+        self.assertLess(after_pages - before_pages, 1024)  # 4MB
+        # below the first level, which shares the pipe to its parent with the root
+        chain_fds = [fds for fds, pages in usages[3:]]
+        self.assertEqual(min(chain_fds), max(chain_fds))
+        chain_pages = [pages for fds, pages in usages[2:]]
+        self.assertLess(chain_pages[-1] - chain_pages[0], 1024)
@@ -0,0 +1,90 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from . import headless
+from . import terminal_dsl
+
+
+def terminal(width=10, height=10, output=b''):
+    t = headless.Terminal(width, height)
+    t.reset(0, 0)
+    t.feed(output)
+    return t
+
+
+class TestTerminal(unittest.TestCase):
+    def test_wrapped_rows_are_joined(self):
+        t = terminal(output=b'$true 123456789\r\n$')
+        self.assertEqual(t.display()[:3], ['$true 1234', '56789', '$'])
+        self.assertEqual(t.lines()[:3], ['$true 123456789', '$', ''])
+
+    def test_newline_at_the_edge_does_not_wrap(self):
+        t = terminal(output=b'0123456789\r\nabc')
+        self.assertEqual(t.lines()[:2], ['0123456789', 'abc'])
+
+    def test_erasing_ends_a_wrapped_row(self):
+        t = terminal(output=b'0123456789abc\x1b[A\x1b[5G\x1b[K')
+        self.assertEqual(t.lines()[:2], ['0123', 'abc'])
+
+    def test_narrowing_keeps_the_cursor_row(self):
+        """The front of the current line retains its position, as in tmux"""
+        t = terminal(output=b'$true 123456789\r\n$')
+        t.resize(5, 10)
+        self.assertEqual([r.text().rstrip() for r in t.history], ['$true'])
+        self.assertEqual(t.display()[:3], [' 1234', '56789', '$'])
+        self.assertEqual((t.cursor_row, t.cursor_col), (2, 1))
+
+    def test_widening_pulls_rows_out_of_history(self):
+        t = terminal(5, 3, b'$true 123456789\r\n$')
+        self.assertEqual(len(t.history), 1)
+        t.resize(10, 3)
+        self.assertEqual(list(t.history), [])
+        self.assertEqual(t.display(), ['$true 1234', '56789', '$'])
+        self.assertEqual((t.cursor_row, t.cursor_col), (2, 1))
+
+    def test_shrinking_drops_rows_below_the_cursor_first(self):
+        t = terminal(10, 5, b'a\r\nb\r\nc')
+        t.resize(10, 3)
+        self.assertEqual(list(t.history), [])
+        t.resize(10, 2)
+        self.assertEqual([r.text().rstrip() for r in t.history], ['a'])
+        self.assertEqual(t.display(), ['b', 'c'])
+        t.resize(10, 4)
+        self.assertEqual(t.display(), ['a', 'b', 'c', ''])
+        self.assertEqual((t.cursor_row, t.cursor_col), (2, 1))
+
+
+class TestHeadlessPane(unittest.TestCase):
+    def test_contents(self):
+        with headless.HeadlessPane(20, 5) as t:
+            headless.send_command(t, 'echo 01234567890123456789')
+            headless.send_command(t, 'echo 01234567890123456789')
+            self.assertEqual(headless.all_contents(t),
+                             ['$echo 01234567890123',
+                              '456789',
+                              '01234567890123456789',
+                              '$echo 01234567890123',
+                              '456789',
+                              '01234567890123456789',
+                              '$'])
+            self.assertEqual(headless.all_lines(t),
+                             ['$echo 01234567890123456789',
+                              '01234567890123456789',
+                              '$echo 01234567890123456789',
+                              '01234567890123456789',
+                              '$'])
+
+    def test_terminal_state(self):
+        with headless.HeadlessPane(10, 10) as t:
+            headless.send_command(t, 'true 12345')
+            self.assertEqual(headless.visible(t), ['$true 1234',
+                                                   '5',
+                                                   '$'])
+            headless.send_command(t, 'true 1234')
+            termstate = terminal_dsl.TerminalState.from_headless_pane(t)
+        expected = terminal_dsl.TerminalState(
+            lines=['$true 12345', '$true 1234', '$'],
+            cursor_line=2, cursor_offset=1, width=10, height=10,
+            history_height=0)
+        self.assertEqual(expected, termstate, expected.visible_diff(termstate))
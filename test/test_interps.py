@@ -0,0 +1,48 @@
+from __future__ import unicode_literals
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from .context import rlundo
+from rlundo import interps
+
+
+class TestInterps(unittest.TestCase):
+    def test_python_names(self):
+        for name in ['python3', 'python3.11', '/usr/bin/python3']:
+            self.assertEqual(interps.find_shim(name).module,
+                             'rlundo.interps.undoablepython')
+        for name in ['pythonista', 'python2', 'python2.7', '/usr/bin/python2']:
+            self.assertIsNone(interps.find_shim(name))
+        self.assertEqual(interps.find_shim('ipython3').module,
+                         'rlundo.interps.undoableipython')
+
+    def test_python_by_version(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        python = os.path.join(directory, 'python')
+        for version, matches in [('2', False), ('3', True)]:
+            with open(python, 'w') as f:
+                f.write('#!/bin/sh\necho %s\n' % (version, ))
+            os.chmod(python, 0o755)
+            self.assertEqual(interps.is_python(python), matches)
+        self.assertFalse(interps.is_python(os.path.join(directory, 'missing', 'python')))
+
+    def test_shim_command(self):
+        env = {'PYTHONPATH': 'elsewhere'}
+        command = interps.undoable_command('/usr/bin/python3', ['-i', 'x.py'], env)
+        self.assertEqual(command, ['/usr/bin/python3', '-m', 'rlundo.interps.undoablepython',
+                                   '-i', 'x.py'])
+        self.assertTrue(env['PYTHONPATH'].endswith('elsewhere'))
+
+    def test_shims_not_imported(self):
+        program = ('from rlundo import interps; import sys; '
+                   'interps.undoable_command("ipython", [], {}); '
+                   'print(sorted(m for m in sys.modules if "IPython" in m or "undoable" in m))')
+        output = subprocess.check_output([sys.executable, '-c', program],
+                                         cwd=interps.ROOT)
+        self.assertEqual(output.strip(), b'[]')
@@ -0,0 +1,116 @@
+import re
+import unittest
+
+from .context import rlundo
+from rlundo import termrewrite
+from rlundo.journal import (OutputJournal, LineIndex, count_rows,
+                            MAX_INDEXED_LINES)
+
+
+class TestOutputJournal(unittest.TestCase):
+    def test_segments(self):
+        j = OutputJournal()
+        j.append(b'>>> 1')
+        j.append(b' + 1\n2\n')
+        j.save()
+        j.append(b'>>> ')
+        self.assertEqual(list(j), [b'>>> 1 + 1\n2\n', b'>>> '])
+        self.assertEqual(j.segments[1].offset, 12)
+        self.assertEqual(j.pop().bytes(), b'>>> ')
+        self.assertEqual(j.pop().bytes(), b'>>> 1 + 1\n2\n')
+        self.assertEqual(j.pop(), None)
+        j.append(b'abc')
+        self.assertEqual(list(j), [b'abc'])
+
+    def test_snapshot_cap(self):
+        j = OutputJournal(max_snapshot_bytes=4, max_session_bytes=None)
+        j.append(b'ab')
+        j.append(b'cdef')
+        j.append(b'g')
+        segment = j.pop()
+        self.assertEqual(segment.bytes(), b'defg')
+        self.assertFalse(segment.complete)
+        self.assertEqual(segment.dropped, 3)
+
+    def test_session_cap(self):
+        j = OutputJournal(max_snapshot_bytes=None, max_session_bytes=5)
+        j.append(b'12')
+        j.save()
+        j.append(b'34')
+        j.save()
+        j.append(b'56')
+        self.assertEqual(list(j), [b'34', b'56'])
+        self.assertEqual(j.evicted, 1)
+        j.append(b'789')
+        self.assertEqual(list(j), [b'56789'])
+        self.assertEqual(j.size, 5)
+        j.append(b'0')
+        self.assertEqual(list(j), [b'67890'])
+        self.assertFalse(j.segments[0].complete)
+
+    def test_snapshot_count_cap(self):
+        j = OutputJournal(max_snapshots=3)
+        for line in [b'1\n', b'2\n', b'3\n']:
+            j.append(line)
+            j.segments[-1].snapshot = line
+            j.save()
+        j.append(b'4')
+        self.assertEqual(list(j), [b'1\n2\n', b'3\n', b'4'])
+        self.assertEqual(j.released, 1)
+        self.assertEqual(j.segments[0].snapshot, None)
+        self.assertEqual(j.segments[0].index.lines, 2)
+        self.assertEqual(j.segments[1].snapshot, b'3\n')
+        j.release(5)
+        self.assertEqual(list(j), [b'1\n2\n3\n', b'4'])
+
+
+class TestLineIndex(unittest.TestCase):
+    samples = [
+        u"1234\n123456",
+        u"> undo\r\n> 1\r\n1\r\n",
+        u"\x01\x1b[0;32m\x02In [\x01\x1b[1;32m\x021\x01\x1b[0;32m\x02]: 1\n\x01\x1b[0m\x02\x1b[0;31mOut[\x1b[1;31m1\x1b[0;31m]: \x1b[0m1\n\n",
+        u"caf\xe9 ☃\n\x1b[0;32m☃☃\x1b[0m",
+    ]
+
+    def indexes(self, data, *splits):
+        """Index data, starting a new segment at each split"""
+        bounds = (0, ) + splits + (len(data), )
+        indexes = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            index = LineIndex()
+            for i in range(start, end):
+                index.feed(data[i:i+1])
+            indexes.append(index)
+        return indexes
+
+    def test_matches_count_lines(self):
+        for msg in self.samples:
+            data = msg.encode('utf8')
+            for width in (3, 4, 10, 40):
+                expected = termrewrite.count_lines(msg, width)
+                self.assertEqual(count_rows(self.indexes(data), width), expected)
+                # segments never begin inside an escape sequence or a character
+                inside = set(i for m in re.finditer(b'\x1b\\[[\\d;]*[A-Za-z]', data)
+                             for i in range(m.start() + 1, m.end()))
+                inside.update(i for i, b in enumerate(bytearray(data)) if 0x80 <= b < 0xc0)
+                for split in set(range(len(data))) - inside:
+                    self.assertEqual(count_rows(self.indexes(data, split), width),
+                                     expected, (msg, split, width))
+
+    def test_cursor_motion(self):
+        # a prompt, a line entered and a blank row made below the prompt
+        data = b'>3\r\n3\r\n>' + b'1c1\r\n\x1bM' + b'\x08' * 20 + b'\x1b[C\x1b[J'
+        for width in (10, 14):
+            self.assertEqual(count_rows(self.indexes(data), width), 2)
+            self.assertEqual(count_rows(self.indexes(data, 10), width), 2)
+            self.assertEqual(count_rows(self.indexes(data, 15), width), 2)
+        self.assertEqual(count_rows(self.indexes(b'abc\x1b[2A'), 10), 0)
+        self.assertEqual(count_rows(self.indexes(b'abcdef\x08\x08\x1b[D'), 4), 1)
+        self.assertEqual(count_rows(self.indexes(b'a\nbcd\nef\x1b[Fghijk'), 4), 2)
+
+    def test_forgotten_lines(self):
+        index = LineIndex()
+        index.feed(b'abcdef\n' * (MAX_INDEXED_LINES + 5) + b'abc')
+        self.assertEqual(index.lines, MAX_INDEXED_LINES + 5)
+        self.assertEqual(index.forgotten, 5)
+        self.assertEqual(count_rows([index], 3), 2 * MAX_INDEXED_LINES + 5 + 1 - 1)
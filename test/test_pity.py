@@ -0,0 +1,45 @@
+from __future__ import unicode_literals
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from .context import rlundo
+from rlundo import pity
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+class TestAdaptiveReader(unittest.TestCase):
+    def test_read_size_adapts(self):
+        reader = pity.AdaptiveReader(minimum=4, maximum=16)
+        r, w = os.pipe()
+        try:
+            os.write(w, b'x' * 28)
+            self.assertEqual(bytes(reader.readinto(r)), b'xxxx')
+            self.assertEqual(reader(r), b'x' * 8)
+            self.assertEqual(len(reader(r)), 16)
+            self.assertEqual(reader.size, 16)
+            os.write(w, b'y')
+            self.assertEqual(reader(r), b'y')
+            self.assertEqual(reader.size, 8)
+        finally:
+            os.close(r)
+            os.close(w)
+
+
+class TestSpawn(unittest.TestCase):
+    def test_file_as_stdin(self):
+        # epoll can't wait on regular files, which select could
+        with tempfile.TemporaryFile() as stdin:
+            stdin.write(b'hello\n')
+            for master_read in ['None', '__import__("pty")._read']:
+                stdin.seek(0)
+                program = ('import sys; sys.path.insert(0, %r); from rlundo import pity; '
+                           'pity.spawn(["sh", "-c", "read x; echo got $x"], master_read=%s)'
+                           % (ROOT, master_read))
+                output = subprocess.check_output([sys.executable, '-c', program],
+                                                 stdin=stdin, timeout=10)
+                self.assertTrue(output.endswith(b'got hello\r\n'), output)
@@ -0,0 +1,59 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from .context import rlundo
+from rlundo import ps, retention
+
+
+class TestPolicy(unittest.TestCase):
+    def test_from_env(self):
+        policy = retention.Policy.from_env({'RLUNDO_MAX_UNDO': '50',
+                                            'RLUNDO_MAX_UNDO_MEMORY': '1.5G',
+                                            'RLUNDO_MIN_AVAILABLE': '200M',
+                                            'RLUNDO_MAX_REDO': '3'})
+        self.assertEqual(policy.max_depth, 50)
+        self.assertEqual(policy.max_memory, 3 * 512 * 1024 * 1024)
+        self.assertEqual(policy.min_available, 200 * 1024 * 1024)
+        self.assertEqual(policy.max_pressure, None)
+        self.assertEqual(policy.max_redo, 3)
+        self.assertEqual(retention.Policy.from_env({}).min_available, .05)
+
+    def test_excess_depth(self):
+        policy = retention.Policy(max_depth=3)
+        self.assertEqual(policy.excess([11, 12]), 0)
+        self.assertEqual(policy.excess([11, 12, 13, 14, 15]), 2)
+
+    def test_pressure_releases_one_at_a_time(self):
+        policy = retention.Policy()
+        margins = []
+
+        def memory_short(margin=1):
+            margins.append(margin)
+            return True
+        policy.memory_short = memory_short
+        self.assertEqual(policy.excess([11, 12, 13], pressure=False), 0)
+        self.assertEqual(policy.excess([11, 12, 13]), 1)
+        # /proc isn't read again straight away
+        self.assertEqual(policy.excess([12, 13]), 0)
+        self.assertEqual(margins, [1])
+        # and once memory is short, it has to get past the limit to be enough
+        policy.checked -= retention.PRESSURE_CHECK_SECONDS
+        self.assertEqual(policy.excess([12, 13]), 1)
+        self.assertEqual(margins, [1, retention.RECOVERED])
+
+    def test_private_memory_of_parked_processes_looked_up_once(self):
+        policy = retention.Policy(max_memory=3 * 1024)
+        looked_up = []
+
+        def memory(pid):
+            looked_up.append(pid)
+            return {'uss': 2}
+        self.addCleanup(setattr, ps, 'memory', ps.memory)
+        ps.memory = memory
+        self.assertEqual(policy.excess([11, 12]), 1)
+        self.assertEqual(policy.excess([11, 12, 13]), 2)
+        # only the newest is looked up again, the rest stay parked
+        self.assertEqual(looked_up, [11, 12, 13])
+        self.assertEqual(policy.excess([13]), 0)
+        self.assertEqual(sorted(policy.uss), [13])
@@ -6,10 +6,13 @@ import socket
 import time
 import unittest
 
-import nose
-from flaky import flaky
+try:
+    from flaky import flaky
+except ImportError:
+    flaky = lambda cls: cls
 
 from . import terminal_dsl
+from . import headless
 from . import tmux
 from . import scenarioscript
 
@@ -28,20 +31,25 @@ def restore(t):
     s = socket.socket(family=socket.AF_UNIX)
     s.connect(os.environ['RLUNDO_RESTORE'])
     assert b'' == s.recv(100)
-    t.cmd('send-keys', '>')
+    t.send_keys('>', enter=False, suppress_history=False)
     time.sleep(.1)
 
 
 class DiagramsWithTmux(object):
     maxDiff = 10000
+    term = tmux
+
+    def scenario(self, termstate):
+        return UndoScenario(termstate)
 
     def assert_undo(self, diagram, slow=False):
         states = [terminal_dsl.parse_term_state(x)[1]
                   for x in terminal_dsl.divide_term_states(diagram)]
         if len(states) < 2:
             raise ValueError("Diagram has only one state")
-        with UndoScenario(states[0]) as t:
-            UndoScenario.initialize(t, states[0])
+        scenario = self.scenario(states[0])
+        with scenario as t:
+            scenario.initialize(t, states[0])
             if slow: time.sleep(1)
             for before, after in zip(states[:-1], states[1:]):
                 self.resize(before, after, t)
@@ -49,19 +57,26 @@ class DiagramsWithTmux(object):
                 if self.should_undo(before, after):
                     restore(t)
                     if slow: time.sleep(1)
-                actual = terminal_dsl.TerminalState.from_tmux_pane(t)
+                actual = terminal_dsl.TerminalState.from_pane(t, self.term)
                 self.assertEqual(after, actual, after.visible_diff(actual))
-                self.assertEqual(tmux.all_contents(t),
+                self.assertEqual(self.term.all_contents(t),
                                  termrewrite.linesplit(after.lines, after.width))
 
     def resize(self, before, after, t):
-        tmux.stepwise_resize_width(t, after.width)
-        tmux.stepwise_resize_height(t, after.height)
+        self.term.resize_width(t, after.width)
+        self.term.resize_height(t, after.height)
 
     def should_undo(self, s1, s2):
         return (len(s1.lines) > len(s2.lines) or
                 s1.lines.count('>undo') > s2.lines.count('>undo'))
 
+
+class DiagramsHeadless(DiagramsWithTmux):
+    term = headless
+
+    def scenario(self, termstate):
+        return HeadlessUndoScenario(termstate)
+
 @flaky
 class TestDiagramsWithTmux(unittest.TestCase, DiagramsWithTmux):
     def test_simple_undo(self):
@@ -93,10 +108,11 @@ class TestDiagramsWithTmux(unittest.TestCase, DiagramsWithTmux):
         termstate = terminal_dsl.TerminalState(
             lines=lines, cursor_line=7, cursor_offset=1, width=11,
             height=6, history_height=3)
-        with UndoScenario(termstate) as t:
-            UndoScenario.initialize(t, termstate)
-            tmux.stepwise_resize_width(t, 11)
-            self.assertEqual(tmux.all_contents(t), lines)
+        scenario = self.scenario(termstate)
+        with scenario as t:
+            scenario.initialize(t, termstate)
+            self.term.resize_width(t, 11)
+            self.assertEqual(self.term.all_contents(t), lines)
 
     def test_simple_resize(self):
         self.assert_undo('''
@@ -346,10 +362,12 @@ class TestWrappedLines(unittest.TestCase, DiagramsWithTmux):
         """)
 
 
-class UndoScenario(tmux.TmuxPane):
+class UndoScenarioMixin(object):
     """
     A series of prompts, inputs, and associated outputs.
     Final line must have a cursor on it.
+
+    Mixed into a pane class, with term the module of functions for it.
     """
     def bash_config_contents(self):
         save_addr = termrewrite.temp_name('save')
@@ -367,7 +385,7 @@ class UndoScenario(tmux.TmuxPane):
     def __init__(self, termstate):
         self.validate_termstate(termstate)
         self.termstate = termstate
-        tmux.TmuxPane.__init__(self, termstate.width, termstate.height)
+        super(UndoScenarioMixin, self).__init__(termstate.width, termstate.height)
 
     @classmethod
     def validate_termstate(cls, termstate):
@@ -405,74 +423,86 @@ class UndoScenario(tmux.TmuxPane):
         True
         """
         self.python_script = self.tempfile(self.python_script_contents())
-        return tmux.TmuxPane.__enter__(self)
+        return super(UndoScenarioMixin, self).__enter__()
 
     @classmethod
     def initialize(cls, pane, termstate):
-
+        term = cls.term
         lines = termstate.lines[:]
         assert lines.pop(0) == '$rw'
-        tmux.send_command(pane, 'rw', prompt=u'>')
+        term.send_command(pane, 'rw', prompt=u'>')
         save()
         first_line = lines.pop(0)
         assert first_line.startswith('>')
-        pane.cmd('send-keys', first_line[1:])
+        pane.send_keys(first_line[1:], enter=False, suppress_history=False)
         pane.enter()
-        tmux.wait_until_cursor_moves(pane, 1, 1)
+        term.wait_until_cursor_moves(pane, 1, 1)
         for i, line in enumerate(lines):
             if i == termstate.cursor_line:
                 assert len(lines) == i - 1
-                pane.cmd('send-keys', line)
+                pane.send_keys(line, enter=False, suppress_history=False)
             elif line.startswith('>'):
-                tmux.send_command(pane, '>', enter=False, prompt=u'>')
+                term.send_command(pane, '>', enter=False, prompt=u'>')
                 save()
-                pane.cmd('send-keys', line[1:])
+                pane.send_keys(line[1:], enter=False, suppress_history=False)
                 if i != len(lines) - 1:
                     pane.enter()
             else:
                 if line != '':
-                    row, col = tmux.cursor_pos(pane)
-                    pane.cmd('send-keys', line)
-                    tmux.wait_until_cursor_moves(pane, row, col)
+                    row, col = term.cursor_pos(pane)
+                    pane.send_keys(line, enter=False, suppress_history=False)
+                    term.wait_until_cursor_moves(pane, row, col)
                 if i != len(lines) - 1:
                     pane.enter()
-        row, col = tmux.cursor_pos(pane)
+        row, col = term.cursor_pos(pane)
 
         additional_required_blank_rows = (
-            termstate.history_height - len(tmux.scrollback(pane)) +
+            termstate.history_height - len(term.scrollback(pane)) +
             termstate.height - row - 1)
         assert additional_required_blank_rows >= 0
         assert col == len(line) % termstate.width, 'col: %r len(line): %r termstate.width: %r' % (col, len(line), termstate.width)  # TODO allow other columns
         if additional_required_blank_rows == 1:
-            pane.cmd('1c'+str(col))
+            pane.send_keys('1c'+str(col), enter=False, suppress_history=False)
             pane.enter()
         elif additional_required_blank_rows > 1:
             for _ in range(additional_required_blank_rows - 1):
                 pane.enter()
             for _ in range(additional_required_blank_rows - 2):
-                pane.cmd('send-keys', 'up2')
+                pane.send_keys('up2', enter=False, suppress_history=False)
                 pane.enter()
-            pane.cmd('send-keys', 'uc'+str(col))
+            pane.send_keys('uc'+str(col), enter=False, suppress_history=False)
             pane.enter()
+        term.wait_for_condition(pane, (termstate.cursor_row - 1, termstate.cursor_column - 1),
+                                term.cursor_pos)
+
+
+class UndoScenario(UndoScenarioMixin, tmux.TmuxPane):
+    term = tmux
+
 
+class HeadlessUndoScenario(UndoScenarioMixin, headless.HeadlessPane):
+    term = headless
 
-class TestUndoScenario(unittest.TestCase):
+
+class TestUndoScenario(unittest.TestCase, DiagramsWithTmux):
     def test_initialize(self):
         lines = ['$rw', '>a', 'b', 'c', '>d', 'e', '>']
         termstate = terminal_dsl.TerminalState(
             lines, cursor_line=6, cursor_offset=1,
             width=10, height=10, history_height=0)
-        with UndoScenario(termstate) as t:
-            UndoScenario.initialize(t, termstate)
-            output = tmux.visible(t)
+        scenario = self.scenario(termstate)
+        with scenario as t:
+            scenario.initialize(t, termstate)
+            output = self.term.visible(t)
             self.assertEqual(output, lines)
 
     def assertRoundtrip(self, diagram):
         (before, ) = [terminal_dsl.parse_term_state(x)[1]
                       for x in terminal_dsl.divide_term_states(diagram)]
-        with UndoScenario(before) as t:
-            UndoScenario.initialize(t, before)
-            after = terminal_dsl.TerminalState.from_tmux_pane(t)
+        scenario = self.scenario(before)
+        with scenario as t:
+            scenario.initialize(t, before)
+            after = terminal_dsl.TerminalState.from_pane(t, self.term)
 
         self.assertEqual(before, after, before.visible_diff(after))
 
@@ -504,5 +534,20 @@ class TestUndoScenario(unittest.TestCase):
         +------+
         """)
 
+
+
+class TestDiagramsHeadless(DiagramsHeadless, TestDiagramsWithTmux):
+    pass
+
+
+class TestWrappedLinesHeadless(DiagramsHeadless, TestWrappedLines):
+    pass
+
+
+class TestUndoScenarioHeadless(DiagramsHeadless, TestUndoScenario):
+    pass
+
+
 if __name__ == '__main__':
+    import nose
     nose.run(defaultTest=__name__)
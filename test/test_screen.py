@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import unittest
+
+from .context import rlundo
+from rlundo.screen import Screen, apply_sgr
+
+
+def screen(width=10, height=4):
+    s = Screen(width, height)
+    s.reset(0, 0)
+    return s
+
+
+class TestScreen(unittest.TestCase):
+    def test_wrapping_and_scrolling(self):
+        s = screen()
+        s.feed(b'1234567890abc\r\nfoo\r\nbar\r\nbaz')
+        self.assertEqual(s.display(), ['abc', 'foo', 'bar', 'baz'])
+        self.assertEqual(s.scrolled, 1)
+        self.assertEqual((s.cursor_row, s.cursor_col), (3, 3))
+
+    def test_cursor_movement_and_erasing(self):
+        s = screen()
+        s.feed(b'hello\r\nworld\x1b[A\x1b[2D\x1b[K\x1b[3;2HX\x1b[1;1H\x1b[P')
+        self.assertEqual(s.display(), ['el', 'world', ' X', ''])
+        s.feed(b'\x1b[2J')
+        self.assertEqual(s.display(), ['', '', '', ''])
+
+    def test_split_escape_sequences(self):
+        s = screen()
+        for c in '\x1b[0;32mab\x1b[0m\xe2\x98\x83'.encode('latin1'):
+            s.feed(bytes(bytearray([c])))
+        self.assertEqual(s.display(), ['ab☃', '', '', ''])
+        self.assertEqual(s.rows[0].attrs[:3], ['32', '32', ''])
+
+    def test_wide_characters(self):
+        s = screen(width=5)
+        s.feed('ab\u4e2d\u6587x'.encode('utf8'))
+        self.assertEqual(s.display(), ['ab\u4e2d', '\u6587x', '', ''])
+        self.assertEqual(s.rows[0].chars, ['a', 'b', '\u4e2d', '', ' '])
+
+    def test_alternate_screen(self):
+        s = screen()
+        s.feed(b'$ less\r\n\x1b[?1049hpager\x1b[?1049l')
+        self.assertEqual(s.display(), ['$ less', '', '', ''])
+
+    def test_sgr(self):
+        self.assertEqual(apply_sgr('', '1;31'), '1;31')
+        self.assertEqual(apply_sgr('1;31', '32'), '1;32')
+        self.assertEqual(apply_sgr('1;31', '0;4'), '4')
+        self.assertEqual(apply_sgr('1;31', ''), '')
+        self.assertEqual(apply_sgr('', '38;5;0'), '38;5;0')
+
+
+class TestRestore(unittest.TestCase):
+    def assert_restores(self, before, after, width=10, height=4):
+        """The screen model and a second model fed what a terminal would
+        receive should both end up as they were before after"""
+        model, terminal = screen(width, height), screen(width, height)
+        for s in (model, terminal):
+            s.feed(before)
+        snapshot = model.snapshot()
+        expected = model.display()
+        for s in (model, terminal):
+            s.feed(after)
+        sequence = model.restore(snapshot, '#broken')
+        terminal.feed_text(sequence)
+        for s in (model, terminal):
+            self.assertEqual(s.display(), expected)
+            self.assertEqual((s.cursor_row, s.cursor_col),
+                             (snapshot.cursor_row, snapshot.cursor_col))
+        return sequence
+
+    def test_simple(self):
+        sequence = self.assert_restores(b'> ', b'1 + 1\r\n2\r\n> ')
+        self.assertEqual(sequence, '\x1b[2A\r\x1b[2C\x1b[K\x1b[1B\r\x1b[K'
+                                   '\x1b[1B\r\x1b[K\x1b[2A\r\x1b[2C')
+
+    def test_redraws(self):
+        self.assert_restores(b'one\r\n> ', b'\x1b[H\x1b[2Jcleared\r\n> ')
+        self.assert_restores(b'one\r\n> \x1b[32m', b'xx\rabc\x1b[0m\x1b[1Ay')
+
+    def test_scrolled(self):
+        model = screen()
+        model.feed(b'a\r\nb\r\n> ')
+        snapshot = model.snapshot()
+        model.feed(b'1\r\n2\r\n> ')
+        model.restore(snapshot, '#broken')
+        self.assertEqual(model.display(), ['b', '>', '', ''])
+        self.assertEqual((model.cursor_row, model.cursor_col), (1, 2))
+
+    def test_scrolled_off(self):
+        model = screen()
+        model.feed(b'a\r\nb\r\n> ')
+        snapshot = model.snapshot()
+        model.feed(b'1\r\n2\r\n3\r\n4\r\n> ')
+        model.restore(snapshot, '#broken')
+        self.assertEqual(list(model.history)[-1].text().rstrip(), '#broken')
+        self.assertEqual(model.display(), ['a', 'b', '>', ''])
+        self.assertEqual((model.cursor_row, model.cursor_col), (2, 2))
+
+    def test_row_start(self):
+        model = screen()
+        model.feed(b'a\r\n> ')
+        snapshot = model.snapshot(row_start=True)
+        model.feed(b'1 + 1\r\n2\r\n> ')
+        model.restore(snapshot)
+        self.assertEqual(model.display(), ['a', '', '', ''])
+        self.assertEqual((model.cursor_row, model.cursor_col), (1, 0))
+
+    def test_stale_snapshot(self):
+        model = screen()
+        snapshot = model.snapshot()
+        model.reset(0, 0)
+        self.assertEqual(model.restore(snapshot), None)
+
+    def test_redraw(self):
+        model = screen()
+        model.feed(b'a\r\n\x1b[31mb\x1b[0m\r\n> ')
+        terminal = screen()
+        terminal.feed(b'junk\r\njunk')
+        terminal.feed(model.redraw().encode('utf8'))
+        self.assertEqual(terminal.rows, model.rows)
+        self.assertEqual((terminal.cursor_row, terminal.cursor_col), (2, 2))
+
+    def test_resize(self):
+        model = screen()
+        model.feed(b'1\r\n2\r\n3\r\n4567890123')
+        snapshot = model.snapshot()
+        model.resize(5, 2)
+        self.assertEqual(model.display(), ['3', '45678'])
+        self.assertEqual((model.cursor_row, model.cursor_col), (1, 4))
+        self.assertEqual(model.restore(snapshot), None)
@@ -0,0 +1,139 @@
+from __future__ import unicode_literals
+
+import asyncio
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from .context import rlundo
+from rlundo import protocol, server
+from rlundo.screen import Screen
+from rlundo.server import Server
+
+
+class TestFrameReader(unittest.TestCase):
+    def test_split_frames(self):
+        data = (protocol.frame(protocol.OUTPUT, b'hello') +
+                protocol.message(protocol.REQUEST, {'op': 'list'}))
+        reader = protocol.FrameReader()
+        frames = []
+        for i in range(len(data)):
+            frames.extend(reader.feed(data[i:i + 1]))
+        self.assertEqual(frames, [(protocol.OUTPUT, b'hello'),
+                                  (protocol.REQUEST, b'{"op": "list"}')])
+
+    def test_too_large(self):
+        reader = protocol.FrameReader()
+        with self.assertRaises(protocol.ProtocolError):
+            reader.feed(protocol.HEADER.pack(protocol.OUTPUT, protocol.MAX_PAYLOAD + 1))
+
+
+class Client(object):
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+        self.screen = Screen(40, 10)
+        self.screen.reset()
+        self.events = []
+
+    async def request(self, **request):
+        self.writer.write(protocol.message(protocol.REQUEST, request))
+        while True:
+            kind, payload = await server.read_frame(self.reader)
+            if kind == protocol.REPLY:
+                return protocol.decode(payload)
+            self.handle(kind, payload)
+
+    def handle(self, kind, payload):
+        if kind == protocol.OUTPUT:
+            self.screen.feed(payload)
+        elif kind == protocol.EVENT:
+            self.events.append(protocol.decode(payload))
+
+    async def type(self, keys, until):
+        """Send keys, then wait until until(screen text) is true"""
+        self.writer.write(protocol.frame(protocol.INPUT, keys))
+        while not until('\n'.join(self.screen.display())):
+            self.handle(*await asyncio.wait_for(server.read_frame(self.reader), 10))
+
+
+class TestServer(unittest.TestCase):
+    def test_undo_in_session(self):
+        path = os.path.join(tempfile.mkdtemp(), 'server')
+
+        async def scenario():
+            server = Server(path)
+            await server.start()
+            try:
+                client = Client(*await asyncio.open_unix_connection(path))
+                session = (await client.request(op='new', argv=['python'],
+                                                size=[40, 10]))['session']
+                self.assertEqual(await client.request(op='attach', session=session),
+                                 {'ok': True})
+                await client.type(b'', lambda text: '>>>' in text)
+                await client.type(b'6 * 7\r', lambda text: '42\n>>>' in text)
+                forked = (await client.request(op='ps', session=session))['processes']
+                # the result's line, since the banner's pid could have 42 in it
+                await client.type(b'undo\r', lambda text: '42' not in text.split('\n') and
+                                  text.rstrip().endswith('>>>'))
+                undone = (await client.request(op='ps', session=session))['processes']
+                sessions = (await client.request(op='list'))['sessions']
+                await client.request(op='kill', session=session)
+                client.writer.close()
+                return client.screen.display(), sessions, forked, undone
+            finally:
+                server.close()
+
+        display, sessions, forked, undone = asyncio.run(scenario())
+        self.assertEqual([s['session'] for s in sessions], [1])
+        self.assertEqual([(p['depth'], p['line']) for p in forked],
+                         [(0, None), (1, '6 * 7')])
+        self.assertEqual([p['depth'] for p in undone], [0])
+        self.assertNotIn('42', display)
+        self.assertEqual([line for line in display if line.startswith('>>>')],
+                         ['>>>'])
+
+
+class TestSocket(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_private_directory(self):
+        with mock.patch.dict(os.environ), \
+                mock.patch.object(tempfile, 'tempdir', self.directory):
+            os.environ.pop('XDG_RUNTIME_DIR', None)
+            path = server.socket_directory()
+            self.assertEqual(stat.S_IMODE(os.lstat(path).st_mode), 0o700)
+            os.chmod(path, 0o755)
+            with self.assertRaises(PermissionError):
+                server.socket_directory()
+
+    def test_runtime_directory(self):
+        with mock.patch.dict(os.environ, XDG_RUNTIME_DIR=self.directory):
+            self.assertEqual(server.default_socket(),
+                             os.path.join(self.directory, server.SOCKET_NAME))
+
+    def test_only_user_can_connect(self):
+        path = os.path.join(self.directory, 'server')
+
+        async def start():
+            s = Server(path)
+            await s.start()
+            try:
+                return stat.S_IMODE(os.lstat(path).st_mode)
+            finally:
+                s.close()
+        self.assertEqual(asyncio.run(start()), 0o600)
+
+    def test_leaves_other_files_alone(self):
+        path = os.path.join(self.directory, 'server')
+        with open(path, 'w') as f:
+            f.write('not a socket')
+        s = Server(path)
+        with self.assertRaises(PermissionError):
+            asyncio.run(s.start())
+        s.close()
+        self.assertTrue(os.path.exists(path))
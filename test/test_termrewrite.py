@@ -2,10 +2,12 @@ from __future__ import unicode_literals
 
 import ast
 import os
+import threading
+import tty
 import unittest
 
 from .context import rlundo
-from rlundo import termrewrite
+from rlundo import control, forking, pity, ps, retention, termrewrite
 
 class TestRewriteHelpers(unittest.TestCase):
     def test_history(self):
@@ -50,3 +52,190 @@ class TestRewriteHelpers(unittest.TestCase):
         self.assertEqual(termrewrite._rows_required(u"1234", 2), 2)
         self.assertEqual(termrewrite._rows_required(u"1234", 1), 4)
         self.assertEqual(termrewrite._rows_required(u"\x1b[0;32m1234", 2), 2)
+
+    def test_history_broken_sequence_uses_cached_capabilities(self):
+        caps = termrewrite.capabilities()
+        expected = termrewrite.history_broken_sequence(1, [b'>>> 1'], 80, 24)
+        self.addCleanup(setattr, termrewrite, 'terminal', termrewrite.terminal)
+        termrewrite.terminal = None  # nothing more to look up in terminfo
+        self.assertEqual(termrewrite.history_broken_sequence(
+            1, [b'>>> 1'], 80, 24), expected)
+        self.assertIn(caps.move(23, 0) + u'\n' + caps.home, expected)
+
+
+class TestDrain(unittest.TestCase):
+    def setUp(self):
+        self.master, self.slave = pity.openpty()
+        tty.setraw(self.slave)
+        termrewrite.set_master_fd(None, self.master)
+
+    def tearDown(self):
+        termrewrite.session.drain_pty = None
+        os.close(self.master)
+        os.close(self.slave)
+
+    def test_pending_bytes(self):
+        self.assertEqual(pity.pending_bytes(self.master), 0)
+        os.write(self.slave, b'hello')
+        self.assertEqual(pity.pending_bytes(self.master), 5)
+        os.read(self.master, 5)
+        self.assertEqual(pity.pending_bytes(self.master), 0)
+
+    def test_drain_records_pending_output(self):
+        os.write(self.slave, b'hello')
+        termrewrite.drain()
+        self.assertEqual(pity.pending_bytes(self.master), 0)
+        self.assertTrue(b''.join(termrewrite.outputs).endswith(b'hello'))
+
+    def test_drain_past_reads_with_nothing_to_pass_on(self):
+        """Like a read of only a marker, which master_read takes out"""
+        os.write(self.slave, b'12345hello')
+        reads = []
+
+        def master_read(fd):
+            reads.append(os.read(fd, 5))
+            return None if len(reads) == 1 else reads[-1]
+        copied = []
+        self.assertTrue(pity.drain(self.master, master_read, output=copied.append))
+        self.assertEqual(copied, [b'hello'])
+        self.assertEqual(pity.pending_bytes(self.master), 0)
+
+    def test_write_all_nonblocking(self):
+        pity.set_nonblocking(self.master)
+        data = b'x' * 100000
+        received = []
+
+        def reader():
+            while sum(len(r) for r in received) < len(data):
+                received.append(os.read(self.slave, 65536))
+
+        t = threading.Thread(target=reader)
+        t.start()
+        pity.write_all(self.master, data)
+        t.join()
+        self.assertEqual(b''.join(received), data)
+
+
+class TestMarkers(unittest.TestCase):
+    def setUp(self):
+        self.shown = []
+        self.session = termrewrite.Session(display=self.shown.append, size=lambda: (20, 5),
+                                           markers=True)
+        self.read_fd, self.write_fd = os.pipe()
+        self.addCleanup(os.close, self.read_fd)
+        self.addCleanup(os.close, self.write_fd)
+
+    def read(self, data):
+        os.write(self.write_fd, data)
+        return self.session.master_read(self.read_fd)
+
+    def test_markers_are_snapshot_boundaries(self):
+        self.assertEqual(self.read(b'hi\r\n>' + control.marker('save', '1.1') + b'a\r\n>'),
+                         b'hi\r\n>a\r\n>')
+        self.assertEqual(len(self.session.outputs), 2)
+        # a marker split across reads is held back until it's complete
+        os.write(self.write_fd, control.marker('save', '1.2') + b'b')
+        self.session.reader = lambda fd: os.read(fd, 5)
+        self.assertEqual(self.session.master_read(self.read_fd), None)
+        self.session.reader = lambda fd: os.read(fd, 1024)
+        self.assertEqual(self.session.master_read(self.read_fd), b'b')
+        self.assertEqual(len(self.session.outputs), 3)
+        self.assertEqual(self.read(b'\r\n' + control.marker('restore', '2.1')), None)
+        # output before the restore marker is shown before the restore
+        self.assertEqual(self.shown[0], b'\r\n')
+        self.assertEqual(len(self.session.outputs), 1)
+        # back to the row of the first prompt, for the interpreter to print again
+        self.assertEqual(self.session.screen.display()[:2], ['hi', ''])
+        self.assertEqual((self.session.screen.cursor_row, self.session.screen.cursor_col), (1, 0))
+
+    def test_markers_only_in_marker_mode(self):
+        self.session = termrewrite.Session(display=self.shown.append, size=lambda: (20, 5))
+        data = b'>' + control.marker('save', '1.1') + b'a'
+        self.assertEqual(self.read(data), data)
+        self.assertEqual(len(self.session.outputs), 1)
+
+    def test_held_back_only_while_output_is_coming(self):
+        # an escape at the end of output, like an echoed keystroke, isn't
+        # held back when nothing follows it
+        self.assertEqual(self.read(b'c\x1b'), b'c\x1b')
+        self.assertEqual(self.read(b'[Kd'), b'[Kd')
+
+    def test_redo_puts_back_the_restored_output(self):
+        self.addCleanup(setattr, retention, 'policy', retention.policy)
+        retention.policy = retention.Policy(max_redo=2)
+        self.session = termrewrite.Session(display=self.shown.append, size=lambda: (20, 5),
+                                           markers=True)
+
+        def save():
+            return control.marker('save', '1.1')
+        self.read(save() + b'>a\r\nran a\r\n' + save() + b'>undo\r\n' +
+                  control.marker('restore', '2.1') + save() + b'>')
+        self.assertEqual(self.session.screen.display()[:2], ['>', ''])
+        self.read(b'redo\r\n' + control.marker('redo', '1.2') + save() + b'>')
+        self.assertEqual(self.session.screen.display()[:4], ['>a', 'ran a', '>', ''])
+        self.assertEqual((self.session.screen.cursor_row, self.session.screen.cursor_col), (2, 1))
+        # and undo still goes back to before a
+        self.read(b'undo\r\n' + control.marker('restore', '2.2'))
+        self.assertEqual(self.session.screen.display()[:2], ['', ''])
+        self.assertEqual((self.session.screen.cursor_row, self.session.screen.cursor_col), (0, 0))
+
+
+class TestScreenModel(unittest.TestCase):
+    def setUp(self):
+        self.session = termrewrite.Session(display=lambda data: None, size=lambda: (20, 5))
+
+    def test_output_is_parsed_when_the_screen_is_looked_at(self):
+        parsed = []
+        self.session._screen.feed = parsed.append
+        self.session.feed(b'hi\r\n')
+        self.session.feed(b'there')
+        self.assertEqual(parsed, [])
+        del self.session._screen.feed
+        self.assertEqual(self.session.screen.display()[:2], ['hi', 'there'])
+        self.assertTrue(self.session.screen.synced)
+
+    def test_too_much_output_for_the_screen(self):
+        line = b'x' * 19 + b'\r\n'
+        for _ in range(termrewrite.MAX_UNPARSED_BYTES // len(line) + 10):
+            self.session.feed(line)
+        self.session.feed(b'end')
+        self.assertLessEqual(self.session.unparsed_bytes,
+                             termrewrite.MAX_UNPARSED_BYTES + len(line))
+        screen = self.session.screen
+        self.assertEqual(screen.display()[-2:], ['x' * 19, 'end'])
+        # the journal can be rewound, but the screen can't be restored to
+        self.assertFalse(screen.synced)
+
+
+class TestControlServer(unittest.TestCase):
+    def test_save_says_what_to_release(self):
+        self.addCleanup(setattr, retention, 'policy', retention.policy)
+        retention.policy = retention.Policy()
+        retention.policy.under_pressure = lambda: False
+        session = termrewrite.Session(display=lambda data: None, size=lambda: (20, 5))
+        # the root, then processes 1 to 3 deep, each with the ones after
+        # the root parked above it
+        for levels in (0, 0, 1):
+            self.assertEqual(session.save_request(levels), {'release': 0})
+        self.assertEqual(len(session.outputs), 4)
+        retention.policy.under_pressure = lambda: True
+        self.assertEqual(session.save_request(2), {'release': 1})
+        # what came before the released process can't be restored to
+        self.assertEqual(len(session.outputs), 4)
+        self.assertEqual(session.outputs.segments[0].snapshot, None)
+        self.assertNotEqual(session.outputs.segments[1].snapshot, None)
+        # without levels the sender can't release anything, so nothing goes
+        self.assertEqual(session.save_request(), None)
+        self.assertEqual(len(session.outputs), 5)
+
+    def test_ps(self):
+        state_dir = ps.new_state_dir()
+        self.addCleanup(ps.remove_state_dir, state_dir)
+        forking.write_record(state_dir, os.getpid(), None, 0, None, None)
+        server = termrewrite.control_server(state_dir)
+        self.addCleanup(server.close)
+        client = control.Client(server.child)
+        id = client.send('ps')
+        server.serve()
+        (record, ) = client.wait(id)['processes']
+        self.assertEqual((record['pid'], record['depth']), (os.getpid(), 0))
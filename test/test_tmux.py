@@ -113,8 +113,8 @@ class TestTmux(unittest.TestCase):
             self.assertEqual(tmux.cursor_pos(t), (2, 1))
             self.assertEqual(tmux.visible_after_prompt(t),
                              [' 1234', '56789', '$'])
-            tmux.stepwise_resize_width(t, 20)
-            tmux.stepwise_resize_height(t, 20)
+            tmux.resize_width(t, 20)
+            tmux.resize_height(t, 20)
 
     def test_initial_size(self):
         tmux.assert_terminal_wide_enough(70)
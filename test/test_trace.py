@@ -0,0 +1,44 @@
+from __future__ import unicode_literals
+
+import io
+import unittest
+
+from .context import rlundo
+from rlundo import trace
+
+
+class TestTrace(unittest.TestCase):
+    def tearDown(self):
+        trace.configure('')
+        trace.events.clear()
+
+    def test_off_by_default(self):
+        self.assertFalse(any(t.debug or t.info or t.warning
+                             for t in trace.tracers.values()))
+
+    def test_parse(self):
+        self.assertEqual(trace.parse('pty=debug:0.5, restore=info,*=warning'),
+                         {'pty': (trace.DEBUG, 0.5), 'restore': (trace.INFO, 1.0),
+                          '*': (trace.WARNING, 1.0)})
+        self.assertRaises(ValueError, trace.parse, 'tty=debug')
+        self.assertRaises(ValueError, trace.parse, 'pty=loud')
+
+    def test_levels_and_dump(self):
+        trace.configure('*=info,pty=debug', size=3)
+        self.assertTrue(trace.pty.debug)
+        self.assertFalse(trace.restore.debug)
+        self.assertTrue(trace.restore.info)
+        for i in range(5):
+            trace.pty.event(trace.DEBUG, 'read %d bytes', i)
+        out = io.StringIO()
+        trace.dump(out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split(' ', 1)[1] for line in lines],
+                         ['pty debug read 2 bytes', 'pty debug read 3 bytes',
+                          'pty debug read 4 bytes'])
+        self.assertEqual(len(trace.events), 0)
+
+    def test_sampling(self):
+        trace.configure('snapshot=info:0')
+        trace.snapshot.event(trace.INFO, 'saved')
+        self.assertEqual(len(trace.events), 0)
@@ -1,21 +1,46 @@
+from collections import namedtuple
 from functools import partial
+import fcntl
 import os
+import struct
 import sys
 import tempfile
+import termios
 import time
+import unittest
 
-import tmuxp
-import blessings
+from . import tmux_control
 
 py2 = sys.version_info.major == 2
 
+PANE_INFO = '#{pane_height} #{pane_width} #{cursor_x} #{cursor_y}'
 
-def assert_terminal_wide_enough(width=70):
-    term = blessings.Terminal()
-    required_width = width + 3
-    msg = ("Terminal is too narrow. "
-           "Please make it %s columns or wider and rerun tests." % width)
-    assert term.width >= required_width, msg
+PaneSnapshot = namedtuple('PaneSnapshot', [
+    'width', 'height', 'cursor', 'visible', 'scrollback', 'contents', 'lines'])
+
+
+def require_tmux():
+    if not any(os.access(os.path.join(d, 'tmux'), os.X_OK)
+               for d in os.environ.get('PATH', '').split(os.pathsep)):
+        raise unittest.SkipTest('tmux is needed to test with tmux')
+
+
+def assert_terminal_wide_enough(width=70, use_existing_session=None):
+    """Fail loudly if tmux won't give a pane width columns
+
+    Narrower panes wrap what the tests type, which shows up as confusing
+    mismatches in the diagrams instead."""
+    require_tmux()
+    if use_existing_session is None:
+        use_existing_session = 'RLUNDO_USE_EXISTING_TMUX_SESSION' in os.environ
+    pane = tmux_control.connection(use_existing_session).new_pane('cat', width, 3)
+    try:
+        actual = pane_info(pane)[1]
+    finally:
+        pane.kill()
+    msg = ("Terminal is too narrow (%s columns). "
+           "Please make it %s columns or wider and rerun tests." % (actual, width))
+    assert actual >= width, msg
 
 
 def all_contents(pane):
@@ -23,7 +48,12 @@ def all_contents(pane):
 
 
 def all_lines(pane):
-    return pane.cmd('capture-pane', '-epJS', '-10000').stdout
+    return _joined(pane.cmd('capture-pane', '-epJS', '-10000').stdout)
+
+
+def _joined(lines):
+    """Lines of capture-pane -J, which keeps trailing spaces"""
+    return [line.rstrip() for line in lines]
 
 
 def scrollback(pane):
@@ -35,6 +65,19 @@ def visible(pane):
     return pane.cmd('capture-pane', '-ep').stdout
 
 
+def snapshot(pane):
+    """Size, cursor and contents of pane, queried in one round trip"""
+    info, shown, contents, lines = pane.batch(
+        ['display-message', '-p', PANE_INFO],
+        ['capture-pane', '-ep'],
+        ['capture-pane', '-epS', '-10000'],
+        ['capture-pane', '-epJS', '-10000'])
+    height, width, x, y = [int(n) for n in info.stdout[0].split()]
+    return PaneSnapshot(width, height, (y, x), shown.stdout,
+                        contents.stdout[:len(contents.stdout) - len(shown.stdout)],
+                        contents.stdout, _joined(lines.stdout))
+
+
 def visible_without_formatting(pane):
     return pane.cmd('capture-pane', '-p').stdout
 
@@ -72,60 +115,60 @@ def wait_for_condition(pane, final, query, condition=lambda x, y: x == y,
         time.sleep(interval)
 
 
+def pane_info(pane):
+    """(height, width, cursor_x, cursor_y)"""
+    process = pane.cmd('display-message', '-p', PANE_INFO)
+    return tuple(int(x) for x in process.stdout[0].split())
+
+
 def cursor_pos(pane):
     """Returns zero-indexed cursor position"""
-    process = pane.cmd('list-panes', '-F', '#{pane_height} #{pane_width} #{cursor_x} #{cursor_y}')
-    height, width, x, y = [int(x) for x in process.stdout[0].split()]
+    height, width, x, y = pane_info(pane)
     return y, x
 
 
 def width(pane):
-    process = pane.cmd('list-panes', '-F', '#{pane_height} #{pane_width} #{cursor_x} #{cursor_y}')
-    height, width, x, y = [int(x) for x in process.stdout[0].split()]
-    return width
+    return pane_info(pane)[1]
 
 
 def height(pane):
-    process = pane.cmd('list-panes', '-F', '#{pane_height} #{pane_width} #{cursor_x} #{cursor_y}')
-    height, width, x, y = [int(x) for x in process.stdout[0].split()]
-    return height
+    return pane_info(pane)[0]
 
 
-wait_for_width = partial(wait_for_condition, query=width)
-wait_for_height = partial(wait_for_condition, query=height)
+def pty_size(pane):
+    """(width, height) of the pty of the pane, as the program in it sees it
 
+    tmux passes a new size on to the pty a moment after the pane has it."""
+    (tty, ) = pane.cmd('display-message', '-p', '#{pane_tty}').stdout
+    fd = os.open(tty, os.O_RDWR | os.O_NOCTTY)
+    try:
+        rows, cols = struct.unpack('HHHH', fcntl.ioctl(fd, termios.TIOCGWINSZ, b'\0' * 8))[:2]
+    finally:
+        os.close(fd)
+    return cols, rows
 
-def stepwise_resize_width(pane, final_width):
 
-    initial = width(pane)
-    if initial < final_width:
-        for _ in range(final_width - initial):
-            pane.cmd('resize-pane', '-R', str(1))
-    elif initial > final_width:
-        for _ in range(initial - final_width):
-            pane.cmd('resize-pane', '-L', str(1))
-    else:
-        return
-    wait_for_width(pane, final_width)
+wait_for_width = partial(wait_for_condition, query=width)
+wait_for_height = partial(wait_for_condition, query=height)
+wait_for_pty_size = partial(wait_for_condition, query=pty_size)
 
 
-def stepwise_resize_height(pane, final_height):
+def resize_width(pane, final_width):
+    if width(pane) != final_width:
+        pane.set_width(final_width)
+        wait_for_width(pane, final_width)
+        wait_for_pty_size(pane, (final_width, height(pane)))
 
-    initial = height(pane)
-    if initial < final_height:
-        for _ in range(final_height - initial):
-            pane.cmd('resize-pane', '-D', str(1))
-    elif initial > final_height:
-        for _ in range(initial - final_height):
-            pane.cmd('resize-pane', '-U', str(1))
-    else:
-        return
-    wait_for_height(pane, final_height)
+
+def resize_height(pane, final_height):
+    if height(pane) != final_height:
+        pane.set_height(final_height)
+        wait_for_height(pane, final_height)
+        wait_for_pty_size(pane, (width(pane), final_height))
 
 
 def window_name(pane):
-    """Returns zero-indexed cursor position"""
-    process = pane.cmd('list-panes', '-F', '#{window_name}')
+    process = pane.cmd('display-message', '-p', '#{window_name}')
     (name, ) = process.stdout[0].split()
     return name
 
@@ -154,9 +197,9 @@ def send_command(pane, cmd, enter=True, prompt=u'$', maxtime=2):
 
 class TmuxPane(object):
     def __init__(self, width=None, height=None, use_existing_session=None):
+        require_tmux()
         self.width = width
         self.height = height
-        assert_terminal_wide_enough(width)
         self.tempfiles_to_close = []
         if use_existing_session is not None:
             self.use_existing_session = use_existing_session
@@ -185,45 +228,24 @@ class TmuxPane(object):
         self.tmux_config = self.tempfile(self.tmux_config_contents())
         self.bash_config = self.tempfile(self.bash_config_contents())
 
-        self.server = tmuxp.Server()
-        if self.use_existing_session:
-            try:
-                session_dict = self.server.attached_sessions()  # until tmuxp bug is fixed
-                if session_dict is None:
-                    raise tmuxp.exc.TmuxpException
-                self.session = tmuxp.Session(self.server, **session_dict[0])
-            except tmuxp.exc.TmuxpException:
-                self.session = self.server.new_session(session_name='rlundotesting')
-        else:
-            self.session = self.server.new_session(session_name='rlundotesting', kill_session=True)
-
-        self.window = self.session.new_window(attach=False)
+        client = tmux_control.connection(self.use_existing_session)
+        # Without readline the tty echoes what's typed. Readline redraws a
+        # line that exactly fills a row in a way that leaves tmux thinking
+        # the row wrapped, so capture-pane -J would join it to the next.
+        self.pane = client.new_pane('bash --rcfile %s --noprofile --noediting' % (self.bash_config.name, ),
+                                    self.width or 80, self.height or 24)
         try:
-            output = self.window.panes[0].cmd('respawn-pane', '-k', 'bash --rcfile %s --noprofile' % (self.bash_config.name, ))
-            if output.stderr:
-                raise ValueError(repr(output.stderr) + " " +  repr(self.window.panes))
-            (pane, ) = self.window.panes
-            output = pane.cmd('respawn-pane', '-k', 'bash --rcfile %s --noprofile' % (self.bash_config.name, ))
-            if output.stderr:
-                raise ValueError(repr(output.stderr) + " " +  repr(self.window.panes))
-            pane.cmd('split-window', '-h', 'bash --rcfile %s --noprofile' % (self.bash_config.name, ))
-            pane.cmd('split-window', '-v', 'bash --rcfile %s --noprofile' % (self.bash_config.name, ))
-            if self.width is not None:
-                pane.set_width(self.width)
-                wait_for_width(pane, self.width)
-            if self.height is not None:
-                pane.set_height(self.height)
-                wait_for_height(pane, self.height)
-            wait_for_prompt(pane)
-            return pane
+            wait_for_pty_size(self.pane, (self.width or 80, self.height or 24))
+            wait_for_prompt(self.pane)
+            return self.pane
         except:
-            self.window.kill_window()
+            self.pane.kill()
             raise
 
     def __exit__(self, type, value, tb):
         for file in self.tempfiles_to_close:
             file.close()
-        self.window.kill_window()
+        self.pane.kill()
 
 if __name__ == '__main__':
     with TmuxPane(10, 10) as t:
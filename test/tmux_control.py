@@ -0,0 +1,211 @@
+"""
+A tmux control mode (tmux -C) client that stays connected for a test run.
+
+Starting a tmux process for every command made the tmux tests slow; a
+control mode client is one tmux process that reads commands on stdin and
+writes each one's output on stdout between %begin and %end (or %error)
+lines, so commands can be written several at a time and their output read
+back in order in one round trip.
+
+By default the tests get a tmux server of their own, killed when they
+finish. With RLUNDO_USE_EXISTING_TMUX_SESSION set they attach to the
+running tmux server instead, so windows can be watched as tests use them.
+
+Each pane lives in a window of its own whose size is set with
+resize-window, so panes can be any size and resize in one step.
+"""
+import atexit
+import collections
+import os
+import re
+import select
+import subprocess
+import time
+
+TIMEOUT = 10
+
+_BLOCK_END = re.compile(r'%(end|error) (\d+ \d+ \d+)$')
+
+Result = collections.namedtuple('Result', ['stdout', 'stderr'])
+
+
+class TmuxError(Exception):
+    pass
+
+
+def quote(arg):
+    """arg as a single tmux command argument"""
+    return "'" + arg.replace("'", "'\\''") + "'"
+
+
+class ControlClient(object):
+    """A tmux -C process, with the output of each command read in order"""
+
+    def __init__(self, socket_name=None):
+        args = ['tmux']
+        if socket_name is not None:
+            args += ['-L', socket_name, '-f', os.devnull]
+        env = dict(os.environ)
+        env.pop('TMUX', None)  # tmux won't start a client inside another otherwise
+        self.owns_server = socket_name is not None
+        self.process = subprocess.Popen(
+            args + ['-C', 'new-session', '-A', '-s', 'rlundotesting'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        self.buffered = b''
+        self.output_seen = collections.Counter()  # %output notifications by pane id
+        self._read_result()  # from new-session
+
+    def run(self, *commands):
+        """Results of commands, lists of arguments, written all at once"""
+        lines = [u' '.join(quote(arg) for arg in command) + u'\n' for command in commands]
+        try:
+            self.process.stdin.write(u''.join(lines).encode('utf8'))
+            self.process.stdin.flush()
+        except (IOError, OSError) as e:
+            raise TmuxError('tmux control client has gone: %s' % (e, ))
+        return [self._read_result() for _ in commands]
+
+    def _read_result(self):
+        output = None
+        while True:
+            line = self._read_line()
+            if output is None:
+                if line.startswith(u'%begin '):
+                    output, tag = [], line.split(u' ', 1)[1]
+                else:
+                    self._notification(line)
+                continue
+            end = _BLOCK_END.match(line)
+            if end and end.group(2) == tag:
+                while output and output[-1] == u'':
+                    output.pop()
+                if end.group(1) == u'error':
+                    return Result([], output)
+                return Result(output, [])
+            output.append(line)
+
+    def _notification(self, line):
+        if line.startswith(u'%output '):
+            self.output_seen[line.split(u' ', 2)[1]] += 1
+        elif line.startswith(u'%exit'):
+            raise TmuxError('tmux control client exited: %s' % (line, ))
+
+    def wait_for_output(self, pane_id, seen, max=.5, quiet=.02):
+        """Wait for output from a pane after seen notifications of it
+
+        Returns once output has arrived and then none for quiet seconds,
+        or after max seconds."""
+        deadline = time.time() + max
+        while self.output_seen[pane_id] == seen:
+            if not self._read_notification(deadline - time.time()):
+                return
+        while self._read_notification(min(quiet, deadline - time.time())):
+            pass
+
+    def _read_notification(self, timeout):
+        """Whether a notification was read within timeout"""
+        if timeout <= 0 or (b'\n' not in self.buffered and
+                            not select.select([self.process.stdout], [], [], timeout)[0]):
+            return False
+        self._notification(self._read_line())
+        return True
+
+    def _read_line(self):
+        fd = self.process.stdout.fileno()
+        while b'\n' not in self.buffered:
+            if not select.select([fd], [], [], TIMEOUT)[0]:
+                raise TmuxError('no reply from tmux in %ss' % (TIMEOUT, ))
+            data = os.read(fd, 65536)
+            if not data:
+                raise TmuxError('tmux control client exited')
+            self.buffered += data
+        line, self.buffered = self.buffered.split(b'\n', 1)
+        return line.decode('utf8', 'replace')
+
+    def new_pane(self, command, width=80, height=24):
+        """A pane running command in a new window of the given size"""
+        (result, ) = self.run(['new-window', '-d', '-c', os.getcwd(), '-P', '-F',
+                               '#{window_id} #{pane_id}', command])
+        if result.stderr:
+            raise TmuxError(u'\n'.join(result.stderr))
+        window_id, pane_id = result.stdout[0].split()
+        pane = ControlPane(self, window_id, pane_id)
+        self.run(['set-option', '-w', '-t', window_id, 'window-size', 'manual'])
+        pane.resize(width, height)
+        return pane
+
+    def close(self):
+        try:
+            if self.owns_server:
+                self.run(['kill-server'])
+            self.process.stdin.close()
+        except (IOError, OSError, TmuxError):
+            pass
+        self.process.wait()
+
+
+class ControlPane(object):
+    """A pane of a ControlClient, with the methods tests use of a tmuxp pane"""
+
+    def __init__(self, client, window_id, pane_id):
+        self.client = client
+        self.window_id = window_id
+        self.pane_id = pane_id
+
+    def cmd(self, name, *args):
+        """Result of a tmux command targeting this pane"""
+        (result, ) = self.client.run([name, '-t', self.pane_id] + list(args))
+        return result
+
+    def batch(self, *commands):
+        """Results of several commands targeting this pane, in one round trip"""
+        return self.client.run(*[[name, '-t', self.pane_id] + list(args)
+                                 for name, args in ((c[0], c[1:]) for c in commands)])
+
+    def send_keys(self, cmd, enter=True, suppress_history=True):
+        """Like tmuxp, a leading space keeps cmd out of bash's history"""
+        self._type((u' ' if suppress_history else u'') + cmd)
+        if enter:
+            self.enter()
+
+    def enter(self):
+        self._type('Enter')
+
+    def _type(self, key):
+        """Send a key or keys and wait for whatever is echoed in response
+
+        tmuxp ran a tmux process for each command, slow enough that an
+        echo had always arrived by the time the pane was next looked at;
+        here it has to be waited for."""
+        self.cmd('send-keys', key)
+        # tmux finishes replying to a command before it reads the pane's
+        # response, so output seen by now isn't one
+        self.client.wait_for_output(self.pane_id, self.client.output_seen[self.pane_id])
+
+    def clear(self):
+        self.send_keys('reset')
+
+    def resize(self, width, height):
+        self.client.run(['resize-window', '-t', self.window_id,
+                         '-x', str(width), '-y', str(height)])
+
+    def set_width(self, width):
+        self.client.run(['resize-window', '-t', self.window_id, '-x', str(width)])
+
+    def set_height(self, height):
+        self.client.run(['resize-window', '-t', self.window_id, '-y', str(height)])
+
+    def kill(self):
+        self.client.run(['kill-window', '-t', self.window_id])
+
+
+_clients = {}
+
+
+def connection(use_existing_session=False):
+    """The control client of this test run, started on first use"""
+    if use_existing_session not in _clients:
+        socket_name = None if use_existing_session else 'rlundo-testing-%d' % (os.getpid(), )
+        client = _clients[use_existing_session] = ControlClient(socket_name)
+        atexit.register(client.close)
+    return _clients[use_existing_session]